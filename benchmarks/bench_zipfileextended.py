@@ -0,0 +1,293 @@
+"""
+Benchmarks for ZipFileExtended's remove, rename, clone, commit and
+read_compressed over synthetic archives of different shapes.
+
+Each archive shape (entry count, member size, compression, hidden data) is
+generated once into a work directory, then every operation is timed in a
+fresh process against its own copy of the archive, so peak RSS and bytes
+written are those of the operation alone. Results are written as JSON and
+can be compared against those of another version:
+
+    python benchmarks/bench_zipfileextended.py -o new.json
+    python benchmarks/bench_zipfileextended.py --preset full -o new.json
+    python benchmarks/bench_zipfileextended.py --compare old.json new.json
+"""
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from zipextended import zipfileextended  # noqa: E402
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+COMPRESSION = {
+    "stored": zipfile.ZIP_STORED,
+    "deflated": zipfile.ZIP_DEFLATED,
+    "bzip2": zipfile.ZIP_BZIP2,
+    "lzma": zipfile.ZIP_LZMA,
+}
+
+# no hidden data, a block of hidden data between every pair of members, or
+# a single block of hidden data before the first member
+HIDDEN = ("none", "between", "leading")
+
+OPERATIONS = ("remove_clone", "remove_inplace", "remove_append",
+              "rename_clone", "rename_inplace", "clone_quick",
+              "clone_filtered", "read_compressed")
+
+PRESETS = {
+    # (entry counts, member sizes, compression, hidden)
+    "quick": ((10, 1000), (100, 64 * 1024), ("stored", "deflated"),
+              ("none", "between")),
+    "full": ((10, 1000, 100000, 1000000),
+             (10, 64 * 1024, 16 * 1024 * 1024, 1024 * 1024 * 1024),
+             tuple(COMPRESSION), HIDDEN),
+}
+
+# Cases whose archive would exceed this many bytes of member data are
+# skipped unless --max-bytes is raised
+MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+# Member data is made of blocks of this size, half random and half zeros so
+# that it compresses like typical data
+BLOCK_SIZE = 64 * 1024
+
+
+def _block():
+    random = os.urandom(BLOCK_SIZE // 2)
+    return random + bytes(BLOCK_SIZE - len(random))
+
+
+def generate(path, entries, size, compression, hidden):
+    """Write a synthetic archive to path"""
+    block = _block()
+    with zipfileextended.ZipFileExtended(path, "w",
+                                         COMPRESSION[compression]) as zf:
+        if hidden == "leading":
+            zf.fp.write(block)
+            zf.start_dir = zf.fp.tell()
+        for i in range(entries):
+            name = "dir{}/member{:07d}".format(i % 100, i)
+            if size <= BLOCK_SIZE:
+                zf.writestr(name, block[i % BLOCK_SIZE:][:size].ljust(size,
+                                                                      b"\0"))
+            else:
+                with zf.open(name, "w", force_zip64=size >= zipfile.ZIP64_LIMIT) as f:
+                    remaining = size
+                    while remaining > 0:
+                        f.write(block[:remaining])
+                        remaining -= BLOCK_SIZE
+            if hidden == "between":
+                zf.fp.write(block[:min(size, BLOCK_SIZE) // 2 + 1])
+                zf.start_dir = zf.fp.tell()
+
+
+def _bytes_written():
+    """Bytes this process has asked the kernel to write, where the platform
+    reports it"""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _peak_rss():
+    """Peak resident set size of this process in bytes"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def run_operation(op, archive, workdir):
+    """Time op against a copy of archive, run in a fresh process"""
+    path = os.path.join(workdir, "work.zip")
+    shutil.copyfile(archive, path)
+    target = os.path.join(workdir, "clone.zip")
+    timings = {}
+    written = _bytes_written()
+
+    def timed(phase, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        timings[phase] = time.perf_counter() - start
+        return result
+
+    kind, _, mode = op.partition("_")
+    with zipfileextended.ZipFileExtended(path, "a") as zf:
+        names = zf.namelist()
+        # every tenth member
+        chosen = names[::10]
+        if kind == "remove":
+            timed("remove", lambda: [zf.remove(name) for name in chosen])
+            timed("commit", zf.commit, mode)
+        elif kind == "rename":
+            # same length names can be patched in place, the rest can't
+            timed("rename", lambda: [
+                zf.rename(name, name[:-1] + ("x" if i % 2 else "xx"))
+                for i, name in enumerate(chosen)])
+            timed("commit", zf.commit, mode)
+        elif op == "clone_quick":
+            timed("clone", lambda: zf.clone(target).close())
+        elif op == "clone_filtered":
+            timed("clone", lambda: zf.clone(target, names[::2]).close())
+        elif op == "read_compressed":
+            timed("read_compressed",
+                  lambda: [zf.read_compressed(name) for name in names])
+        else:
+            raise ValueError("Unknown operation: {}".format(op))
+
+    if written is not None:
+        written = _bytes_written() - written
+    return {"seconds": sum(timings.values()), "timings": timings,
+            "peak_rss": _peak_rss(), "bytes_written": written}
+
+
+def run(args):
+    preset = PRESETS[args.preset]
+    entries = args.entries or preset[0]
+    sizes = args.sizes or preset[1]
+    compressions = args.compression or preset[2]
+    hiddens = args.hidden or preset[3]
+    operations = args.operations or OPERATIONS
+
+    results = []
+    workdir = tempfile.mkdtemp(dir=args.workdir)
+    try:
+        for count, size, compression, hidden in itertools.product(
+                entries, sizes, compressions, hiddens):
+            case = {"entries": count, "member_size": size,
+                    "compression": compression, "hidden": hidden}
+            if count * size > args.max_bytes:
+                print("skipping {} (over --max-bytes)".format(case),
+                      file=sys.stderr)
+                continue
+            archive = os.path.join(workdir, "source.zip")
+            start = time.perf_counter()
+            generate(archive, count, size, compression, hidden)
+            case["archive_size"] = os.path.getsize(archive)
+            print("generated {} in {:.2f}s".format(
+                case, time.perf_counter() - start), file=sys.stderr)
+            for op in operations:
+                samples = []
+                for _ in range(args.repeat):
+                    # a new process for each run so peak RSS is its own
+                    with concurrent.futures.ProcessPoolExecutor(1) as executor:
+                        samples.append(executor.submit(
+                            run_operation, op, archive, workdir).result())
+                best = min(samples, key=lambda sample: sample["seconds"])
+                result = dict(case, operation=op, **best)
+                result["samples"] = [sample["seconds"] for sample in samples]
+                results.append(result)
+                print("  {:<16} {:10.4f}s".format(op, best["seconds"]),
+                      file=sys.stderr)
+            os.unlink(archive)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {"version": _version(), "python": platform.python_version(),
+              "platform": platform.platform(), "preset": args.preset,
+              "repeat": args.repeat, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+def _version():
+    """The git revision of the code being benchmarked, if known"""
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True,
+            text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path, threshold):
+    """Print the change in time of each benchmark in new relative to old,
+    returning the number that got slower by more than threshold"""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    def key(result):
+        return (result["entries"], result["member_size"],
+                result["compression"], result["hidden"], result["operation"])
+
+    baseline = {key(result): result for result in old["results"]}
+    regressions = 0
+    print("{} -> {}".format(old.get("version"), new.get("version")))
+    for result in new["results"]:
+        before = baseline.get(key(result))
+        if before is None or not before["seconds"]:
+            continue
+        ratio = result["seconds"] / before["seconds"]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  SLOWER"
+            regressions += 1
+        print("{:>8} x {:>10} {:<8} {:<7} {:<16} {:9.4f}s {:9.4f}s {:6.2f}x{}"
+              .format(*key(result), before["seconds"], result["seconds"],
+                      ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark ZipFileExtended operations")
+    parser.add_argument("--preset", choices=PRESETS, default="quick",
+                        help="the matrix of archive shapes to run")
+    parser.add_argument("--entries", type=int, nargs="+",
+                        help="entry counts, overriding the preset")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        help="member sizes in bytes, overriding the preset")
+    parser.add_argument("--compression", choices=COMPRESSION, nargs="+",
+                        help="compression types, overriding the preset")
+    parser.add_argument("--hidden", choices=HIDDEN, nargs="+",
+                        help="hidden data layouts, overriding the preset")
+    parser.add_argument("--operations", choices=OPERATIONS, nargs="+",
+                        help="operations to time, defaults to all")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs of each operation, the fastest is kept")
+    parser.add_argument("--max-bytes", type=int, default=MAX_BYTES,
+                        help="skip archives with more member data than this")
+    parser.add_argument("--workdir", help="where to generate archives")
+    parser.add_argument("-o", "--output", help="write the JSON report here")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two JSON reports instead of running")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="slowdown flagged as a regression by --compare")
+    args = parser.parse_args(argv)
+    if args.compare:
+        return 1 if compare(*args.compare, args.threshold) else 0
+    run(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
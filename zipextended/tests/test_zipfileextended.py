@@ -6,6 +6,10 @@ from random import randint, random, getrandbits
 from tempfile import NamedTemporaryFile
 import io
 import os
+import tempfile
+import asyncio
+import struct
+from unittest import mock
 
 from .support import (TESTFN, TESTFN2, TESTFN3, unlink, get_files, requires_zlib,
                       requires_gzip, requires_bz2, requires_lzma, findfile)
@@ -178,6 +182,1044 @@ class AbstractZipExtTestWithSourceFile:
             # Check that testzip doesn't raise an exception
             zipfp.testzip()
 
+    def test_inplace_remove_and_rename(self):
+        for f in get_files(self):
+            self.zip_inplace_remove_and_rename_test(f, self.compression)
+
+    def zip_inplace_remove_and_rename_test(self, f, compression):
+        self.make_test_archive(f, compression)
+
+        with zipfileextended.ZipFileExtended(
+                f, "a", compression,
+                commit_mode=zipfileextended.COMMIT_INPLACE) as zipfp:
+            first = zipfp.getinfo("another.name")
+            offset = first.header_offset
+            zipfp.remove(TESTFN)
+            zipfp.rename("strfile", "s")
+            zipfp.commit()
+            self.assertEqual(first.header_offset, offset)
+            self.assertEqual(zipfp.namelist(), ["another.name", "s"])
+            self.assertEqual(zipfp.read("another.name"), self.data)
+            self.assertEqual(zipfp.read("s"), self.data)
+            self.assertIsNone(zipfp.testzip())
+
+        with zipfileextended.ZipFileExtended(f, "r", compression) as zipfp:
+            self.assertEqual(zipfp.namelist(), ["another.name", "s"])
+            self.assertEqual(zipfp.read("another.name"), self.data)
+            self.assertEqual(zipfp.read("s"), self.data)
+            self.assertEqual(len(zipfp._hidden_files()), 0)
+            self.assertIsNone(zipfp.testzip())
+
+    def test_inplace_rename_leaves_data_in_place(self):
+        for f in get_files(self):
+            self.make_test_archive(f, self.compression)
+            with zipfileextended.ZipFileExtended(
+                    f, "a", self.compression,
+                    commit_mode=zipfileextended.COMMIT_INPLACE) as zipfp:
+                # same length, so only the header is rewritten
+                zipfp.rename("another.name", "renamed.name")
+                zipfp.remove("strfile")
+                zipfp.commit(verify=zipfileextended.VERIFY_NONE)
+                stats = zipfp.last_commit_stats
+                self.assertEqual(stats.path, "inplace")
+                self.assertEqual(stats.bytes_read, 0)
+                self.assertEqual(zipfp.read("renamed.name"), self.data)
+                self.assertIsNone(zipfp.testzip())
+            with zipfile.ZipFile(f) as zipfp:
+                self.assertEqual(zipfp.namelist(), ["renamed.name", TESTFN])
+                self.assertIsNone(zipfp.testzip())
+
+    def test_append_commit(self):
+        for f in get_files(self):
+            self.make_test_archive(f, self.compression)
+            with zipfileextended.ZipFileExtended(
+                    f, "a", self.compression,
+                    commit_mode=zipfileextended.COMMIT_APPEND) as zipfp:
+                self.assertEqual(zipfp.dead_space(), 0)
+                offsets = {zinfo.filename: zinfo.header_offset
+                           for zinfo in zipfp.infolist()}
+                removed = zipfp.getinfo(TESTFN).compress_size
+                zipfp.remove(TESTFN)
+                # pending removals count as dead space
+                self.assertGreater(zipfp.dead_space(), removed)
+                zipfp.rename("another.name", "a.much.longer.name")
+                zipfp.commit()
+                self.assertEqual(zipfp.getinfo("strfile").header_offset,
+                                 offsets["strfile"])
+                self.assertGreater(zipfp.getinfo("a.much.longer.name").header_offset,
+                                   offsets["strfile"])
+                dead = zipfp.dead_space()
+                self.assertGreater(dead, 2 * removed)
+                self.assertEqual(sum(h.length for h in zipfp._hidden_files()),
+                                 dead)
+                self.assertEqual(zipfp.read("a.much.longer.name"), self.data)
+                self.assertIsNone(zipfp.testzip())
+
+            with zipfileextended.ZipFileExtended(f, "a", self.compression) as zipfp:
+                self.assertEqual(sorted(zipfp.namelist()),
+                                 ["a.much.longer.name", "strfile"])
+                self.assertEqual(zipfp.dead_space(), dead)
+                self.assertEqual(zipfp.read("strfile"), self.data)
+                self.assertIsNone(zipfp.testzip())
+                # a compacting commit reclaims the space
+                zipfp.rename("strfile", "s")
+                zipfp.commit(zipfileextended.COMMIT_INPLACE)
+                self.assertEqual(zipfp.dead_space(), dead)
+                zipfp.compact()
+                self.assertTrue(zipfp.last_commit_stats.compacted)
+                self.assertEqual(zipfp.dead_space(), 0)
+                self.assertEqual(zipfp.read("s"), self.data)
+                self.assertIsNone(zipfp.testzip())
+
+    def test_append_commit_auto_compact(self):
+        for f in get_files(self):
+            self.make_test_archive(f, self.compression)
+            with zipfileextended.ZipFileExtended(
+                    f, "a", self.compression,
+                    commit_mode=zipfileextended.COMMIT_APPEND,
+                    compact_threshold=0.5) as zipfp:
+                zipfp.remove(TESTFN)
+                zipfp.commit()
+                # a third of the data is dead, below the threshold
+                self.assertGreater(zipfp.dead_space(), 0)
+                zipfp.remove("strfile")
+                zipfp.commit()
+                self.assertEqual(zipfp.dead_space(), 0)
+                self.assertEqual(zipfp.namelist(), ["another.name"])
+                self.assertEqual(zipfp.read("another.name"), self.data)
+                self.assertIsNone(zipfp.testzip())
+            with zipfileextended.ZipFileExtended(f) as zipfp:
+                self.assertEqual(zipfp.namelist(), ["another.name"])
+                self.assertEqual(len(zipfp._hidden_files()), 0)
+
+    def test_async(self):
+        async def run(f):
+            async with await zipfileextended.AsyncZipFileExtended.open(
+                    f, "a", self.compression, max_workers=2) as zipfp:
+                self.assertEqual(sorted(zipfp.namelist()),
+                                 sorted([TESTFN, "another.name", "strfile"]))
+                data = await asyncio.gather(
+                    *(zipfp.read(name) for name in zipfp.namelist()))
+                self.assertEqual(data, [self.data] * 3)
+                chunk_size = len(self.data) // 4 + 1
+                chunks = [chunk async for chunk in
+                          zipfp.iter_chunks("strfile", chunk_size=chunk_size)]
+                self.assertEqual(b"".join(chunks), self.data)
+                self.assertEqual(len(chunks), 4)
+                compressed = b"".join([chunk async for chunk in
+                                       zipfp.iter_compressed_chunks("strfile")])
+                self.assertEqual(compressed,
+                                 await zipfp.read_compressed("strfile"))
+                await zipfp.remove(TESTFN)
+                await zipfp.rename("strfile", "renamed")
+                await zipfp.writestr("new", self.data)
+                # the commit waits for the reads alongside it
+                results = await asyncio.gather(zipfp.read("another.name"),
+                                               zipfp.commit(),
+                                               zipfp.read("another.name"))
+                self.assertEqual(results[0], self.data)
+                self.assertEqual(results[2], self.data)
+                self.assertIsNone(await zipfp.testzip())
+            self.assertIsNone(zipfp.archive.fp)
+
+        for f in get_files(self):
+            self.make_test_archive(f, self.compression)
+            asyncio.run(run(f))
+            with zipfileextended.ZipFileExtended(f) as zipfp:
+                self.assertEqual(sorted(zipfp.namelist()),
+                                 ["another.name", "new", "renamed"])
+                self.assertEqual(zipfp.read("renamed"), self.data)
+
+    def test_commit_stats(self):
+        for f in get_files(self):
+            if isinstance(f, str):
+                expected_path = "clone-rename"
+            elif isinstance(f, io.BytesIO):
+                # compacted in memory whatever the mode
+                expected_path = "inplace"
+            else:
+                expected_path = "clone-stream"
+            for mode, path in ((zipfileextended.COMMIT_CLONE, expected_path),
+                               (zipfileextended.COMMIT_INPLACE, "inplace"),
+                               (zipfileextended.COMMIT_APPEND, "append")):
+                self.make_test_archive(f, self.compression)
+                events = []
+                with zipfileextended.ZipFileExtended(
+                        f, "a", self.compression, commit_mode=mode,
+                        commit_hook=lambda *args: events.append(args)) as zipfp:
+                    size = zipfp.getinfo("strfile").compress_size
+                    zipfp.remove(TESTFN)
+                    zipfp.rename("strfile", "renamed.longer")
+                    zipfp.writestr("new", self.data)
+                    zipfp.commit(verify=zipfileextended.VERIFY_FULL)
+                    stats = zipfp.last_commit_stats
+                    self.assertEqual(stats.commit_mode, mode)
+                    self.assertEqual(stats.path, path)
+                    self.assertEqual((stats.removed, stats.renamed, stats.added,
+                                      stats.members), (1, 1, 1, 3))
+                    self.assertIn("verify", stats.phases)
+                    # at least the verification read every member
+                    self.assertGreater(stats.bytes_read, 3 * size)
+                    self.assertGreater(stats.bytes_written, 0)
+                    # one event per phase then the commit as a whole
+                    self.assertEqual(events[-1], ("commit", stats.seconds, stats))
+                    self.assertEqual({name for name, _, _ in events[:-1]},
+                                     set(stats.phases))
+                    self.assertAlmostEqual(sum(s for _, s, _ in events[:-1]),
+                                           sum(stats.phases.values()))
+                    self.assertLessEqual(sum(stats.phases.values()),
+                                         stats.seconds)
+
+            # a rename only commit just rewrites the directory
+            with zipfileextended.ZipFileExtended(f, "a", self.compression) as zipfp:
+                zipfp.rename("new", "nex")
+                zipfp.commit()
+                stats = zipfp.last_commit_stats
+                self.assertEqual(stats.path, "renames")
+                self.assertEqual(list(stats.phases),
+                                 ["renames", "directory", "verify"])
+
+    def test_commit_stream_progress(self):
+        for f in get_files(self):
+            self.make_test_archive(f, self.compression)
+            progress = []
+            with zipfileextended.ZipFileExtended(
+                    f, "a", self.compression, fsync=True,
+                    commit_progress=lambda *args: progress.append(args)) as zipfp:
+                zipfp.remove(TESTFN)
+                zipfp.commit()
+                self.assertEqual(zipfp.read("strfile"), self.data)
+            if not isinstance(f, io.BufferedRandom):
+                # renamed into place or compacted in memory, nothing streamed
+                self.assertEqual(progress, [])
+                continue
+            phases = [phase for phase, _, _ in progress]
+            self.assertEqual(phases, sorted(phases))
+            self.assertEqual(set(phases), {"backup", "stream_copy"})
+            done = {phase: (d, t) for phase, d, t in progress}
+            self.assertEqual(done["stream_copy"][0], done["stream_copy"][1])
+            self.assertEqual(done["stream_copy"][1], f.seek(0, os.SEEK_END))
+            with zipfileextended.ZipFileExtended(f) as zipfp:
+                self.assertEqual(sorted(zipfp.namelist()), ["another.name", "strfile"])
+
+    def test_commit_in_memory(self):
+        f = io.BytesIO()
+        self.make_test_archive(f, self.compression)
+        with mock.patch("tempfile.NamedTemporaryFile") as tempfiles:
+            with zipfileextended.ZipFileExtended(f, "a", self.compression) as zipfp:
+                # compacted in place
+                zipfp.remove(TESTFN)
+                zipfp.commit()
+                self.assertEqual(zipfp.last_commit_stats.path, "inplace")
+                # a longer name with no space freed before it needs a clone
+                zipfp.rename("another.name", "a.much.longer.name")
+                zipfp.commit()
+                self.assertEqual(zipfp.last_commit_stats.path, "memory")
+                self.assertEqual(zipfp.read("a.much.longer.name"), self.data)
+                self.assertIsNone(zipfp.testzip())
+            tempfiles.assert_not_called()
+        with zipfile.ZipFile(f) as zipfp:
+            self.assertEqual(zipfp.namelist(), ["a.much.longer.name", "strfile"])
+            self.assertIsNone(zipfp.testzip())
+
+    def test_copy_from(self):
+        source = io.BytesIO()
+        with zipfileextended.ZipFileExtended(source, "w", self.compression) as zipfp:
+            zipfp.writestr("strfile", b"replacement")
+            zipfp.writestr("dir/new.txt", self.data)
+            zipfp.writestr("dir/", b"")
+        for f in get_files(self):
+            for policy, names, strfile in (
+                    (zipfileextended.CONFLICT_SKIP, ["dir/new.txt", "dir/"],
+                     self.data),
+                    (zipfileextended.CONFLICT_REPLACE,
+                     ["strfile", "dir/new.txt", "dir/"], b"replacement"),
+                    (zipfileextended.CONFLICT_RENAME,
+                     ["strfile~1", "dir/new.txt", "dir/"], self.data),
+                    (lambda zinfo, other: "other." + zinfo.filename,
+                     ["other.strfile", "dir/new.txt", "dir/"], self.data)):
+                self.make_test_archive(f, self.compression)
+                with zipfileextended.ZipFileExtended(source) as other, \
+                     zipfileextended.ZipFileExtended(f, "a", self.compression) as zipfp:
+                    with mock.patch("zipfile._get_decompressor") as decompressor:
+                        self.assertEqual(zipfp.copy_from(other, conflict_policy=policy),
+                                         names)
+                        decompressor.assert_not_called()
+                    for name in names:
+                        self.assertEqual(zipfp.read_compressed(name),
+                                         other.read_compressed(name.replace(
+                                             "other.", "").replace("~1", "")))
+                    self.assertEqual(zipfp.read("strfile"), strfile)
+                with zipfile.ZipFile(f) as zipfp:
+                    self.assertEqual(zipfp.read("dir/new.txt"), self.data)
+                    self.assertIsNone(zipfp.testzip())
+
+            self.make_test_archive(f, self.compression)
+            with zipfileextended.ZipFileExtended(f, "a", self.compression) as zipfp:
+                with self.assertRaises(ValueError):
+                    zipfp.copy_from(source)
+                # members can be picked and archives given as files
+                self.assertEqual(zipfp.copy_from(source, ["dir/new.txt"]),
+                                 ["dir/new.txt"])
+
+    def test_merge(self):
+        shards = []
+        for i in range(3):
+            shard = io.BytesIO()
+            with zipfileextended.ZipFileExtended(shard, "w", self.compression) as zipfp:
+                zipfp.writestr("shard%d" % i, self.data)
+                zipfp.writestr("common", b"shard %d" % i)
+            shards.append(shard)
+        for f in get_files(self):
+            with zipfileextended.ZipFileExtended(f, "w", self.compression) as zipfp:
+                names = zipfp.merge(shards, zipfileextended.CONFLICT_RENAME)
+            self.assertEqual(names, ["shard0", "common", "shard1", "common~1",
+                                     "shard2", "common~2"])
+            with zipfile.ZipFile(f) as zipfp:
+                self.assertEqual(zipfp.namelist(), names)
+                self.assertEqual(zipfp.read("common~2"), b"shard 2")
+                self.assertEqual(zipfp.read("shard1"), self.data)
+                self.assertIsNone(zipfp.testzip())
+
+    def test_split(self):
+        for f in get_files(self):
+            with zipfileextended.ZipFileExtended(f, "w", self.compression) as zipfp:
+                for name in ("a/1", "a/2", "b/1", "c/1", "c/2", "c/3"):
+                    zipfp.writestr(name, self.data)
+            with zipfileextended.ZipFileExtended(f, "a") as zipfp:
+                zipfp.remove("b/1")
+                zipfp.rename("c/3", "c/renamed")
+                for kwargs, shards in (
+                        ({"max_entries": 2},
+                         [["a/1", "a/2"], ["c/1", "c/2"], ["c/renamed"]]),
+                        ({"max_entries": 3, "workers": 2},
+                         [["a/1", "a/2", "c/1"], ["c/2", "c/renamed"]]),
+                        ({"max_entries": 3, "group_by_directory": True},
+                         [["a/1", "a/2"], ["c/1", "c/2", "c/renamed"]])):
+                    with mock.patch("zipfile._get_decompressor") as decompressor:
+                        files = zipfp.split(naming=lambda index: io.BytesIO(),
+                                            **kwargs)
+                        decompressor.assert_not_called()
+                    self.assertEqual(len(files), len(shards))
+                    for shard, names in zip(files, shards):
+                        with zipfile.ZipFile(shard) as shardfp:
+                            self.assertEqual(shardfp.namelist(), names)
+                            self.assertEqual(shardfp.read(names[-1]), self.data)
+                            self.assertIsNone(shardfp.testzip())
+
+                # every shard fits max_bytes, with a member each at the least
+                files = zipfp.split(max_bytes=1, naming=lambda index: io.BytesIO())
+                self.assertEqual(len(files), 5)
+                max_bytes = len(files[0].getvalue()) + len(files[1].getvalue())
+                for shard in zipfp.split(max_bytes=max_bytes,
+                                     naming=lambda index: io.BytesIO()):
+                    self.assertLessEqual(len(shard.getvalue()), max_bytes)
+                    with zipfile.ZipFile(shard) as shardfp:
+                        self.assertIn(len(shardfp.namelist()), (1, 2))
+                with self.assertRaises(ValueError):
+                    zipfp.split()
+
+    def test_split_scattered(self):
+        extra = struct.pack('<HH', 0xcafe, 96) + b'x' * 96
+        for f in get_files(self):
+            with zipfileextended.ZipFileExtended(f, "w", self.compression) as zipfp:
+                for name in ("a/1", "b/1", "a/2", "c/1", "b/2"):
+                    zipfp.writestr(name, self.data)
+                # in the central directory only, but written to each shard's
+                # local headers too
+                for zinfo in zipfp.filelist:
+                    zinfo.extra = extra
+            with zipfileextended.ZipFileExtended(f) as zipfp:
+                files = zipfp.split(max_entries=2, group_by_directory=True,
+                                    naming=lambda index: io.BytesIO())
+                shards = []
+                for shard in files:
+                    with zipfile.ZipFile(shard) as shardfp:
+                        shards.append(shardfp.namelist())
+                self.assertEqual(shards, [["a/1", "a/2"], ["b/1", "b/2"],
+                                          ["c/1"]])
+
+                # just short of what a pair of members takes
+                pair = len(zipfp.split(max_entries=2, naming=lambda index:
+                                       io.BytesIO())[0].getvalue())
+                for max_bytes in range(pair - 300, pair, 10):
+                    for shard in zipfp.split(max_bytes=max_bytes,
+                                             naming=lambda index: io.BytesIO()):
+                        with zipfile.ZipFile(shard) as shardfp:
+                            self.assertEqual(len(shardfp.namelist()), 1)
+
+    def test_split_naming(self):
+        self.make_test_archive(TESTFN2, self.compression)
+        try:
+            with zipfileextended.ZipFileExtended(TESTFN2) as zipfp:
+                names = zipfp.split(max_entries=2)
+                self.assertEqual(names, [TESTFN2 + ".001.zip",
+                                         TESTFN2 + ".002.zip"])
+                names = zipfp.split(max_entries=1, naming=TESTFN2 + "-{index}")
+                self.assertEqual(names, [TESTFN2 + "-1", TESTFN2 + "-2",
+                                         TESTFN2 + "-3"])
+            names = []
+            for name in os.listdir():
+                if name.startswith(TESTFN2 + ".") or name.startswith(TESTFN2 + "-"):
+                    names.append(name)
+            with zipfileextended.ZipFileExtended(TESTFN3, "w") as zipfp:
+                zipfp.merge(sorted(names)[:3])
+                self.assertEqual(zipfp.namelist(),
+                                 ["another.name", TESTFN, "strfile"])
+        finally:
+            for name in names:
+                unlink(name)
+            unlink(TESTFN2)
+            unlink(TESTFN3)
+
+    def make_duplicates_archive(self, f):
+        with zipfileextended.ZipFileExtended(f, "w", self.compression) as zipfp:
+            zipfp.writestr("a", self.data)
+            zipfp.writestr("b", b"different data")
+            zipfp.writestr("dir/", b"")
+            zipfp.writestr("dir/a", self.data)
+            zipfp.writestr("c", self.data)
+            zipfp.writestr("dir2/", b"")
+
+    def test_duplicates(self):
+        for f in get_files(self):
+            self.make_duplicates_archive(f)
+            with zipfileextended.ZipFileExtended(f) as zipfp:
+                sets = zipfp.duplicates()
+                self.assertEqual([[zinfo.filename for zinfo in members]
+                                  for members in sets], [["a", "dir/a", "c"]])
+                self.assertEqual(zipfp.duplicates(["a", "b", "c"])[0],
+                                 [zipfp.getinfo("a"), zipfp.getinfo("c")])
+                with io.BytesIO() as clonefp:
+                    with zipfp.clone(clonefp, dedup=zipfileextended.DEDUP_SHARE) as clone:
+                        self.assertTrue(clone.shared_payloads)
+                        self.assertFalse(clone.directory_only_renames)
+                        offsets = {zinfo.header_offset
+                                   for zinfo in clone.infolist()}
+                        self.assertEqual(len(offsets), 4)
+                        for name in ("a", "dir/a", "c"):
+                            self.assertEqual(clone.read(name), self.data)
+                        self.assertIsNone(clone.verify(zipfileextended.VERIFY_FULL))
+                        self.assertLess(clone.start_dir, zipfp.start_dir -
+                                        2 * zipfp.getinfo("c").compress_size)
+                    # other readers reject the shared members
+                    with zipfile.ZipFile(clonefp) as clone:
+                        self.assertEqual(clone.read("a"), self.data)
+                        with self.assertRaises(zipfile.BadZipFile):
+                            clone.read("c")
+
+    def test_commit_dedup(self):
+        for f in get_files(self):
+            self.make_duplicates_archive(f)
+            with zipfileextended.ZipFileExtended(f, "a", self.compression) as zipfp:
+                zipfp.remove("b")
+                zipfp.commit(zipfileextended.COMMIT_INPLACE,
+                             dedup=zipfileextended.DEDUP_REPORT)
+                self.assertEqual(zipfp.last_commit_stats.path, "inplace")
+                self.assertEqual(zipfp.last_commit_stats.duplicates,
+                                 [["a", "dir/a", "c"]])
+                # sharing has to be asked for when opening
+                with self.assertRaises(ValueError):
+                    zipfp.commit(dedup=zipfileextended.DEDUP_SHARE)
+            with zipfileextended.ZipFileExtended(
+                    f, "a", self.compression, shared_payloads=True) as zipfp:
+                size = zipfp.start_dir
+                zipfp.commit(dedup=zipfileextended.DEDUP_SHARE)
+                self.assertEqual(zipfp.last_commit_stats.duplicates,
+                                 [["a", "dir/a", "c"]])
+                self.assertLess(zipfp.start_dir, size)
+                self.assertFalse(zipfp.directory_only_renames)
+                # a rename that can't be patched in place still moves the
+                # member, which stops sharing
+                zipfp.rename("dir/a", "dir/moved")
+                zipfp.commit(zipfileextended.COMMIT_APPEND)
+                self.assertNotEqual(zipfp.getinfo("dir/moved").header_offset,
+                                    zipfp.getinfo("c").header_offset)
+                self.assertEqual(zipfp.read("dir/moved"), self.data)
+                # replacing a shared member leaves the others be
+                zipfp.replace("a", b"replaced")
+                self.assertEqual(zipfp.read("c"), self.data)
+            with zipfile.ZipFile(f) as zipfp:
+                self.assertEqual(zipfp.read("a"), b"replaced")
+                self.assertEqual(zipfp.read("dir/moved"), self.data)
+            with zipfileextended.ZipFileExtended(
+                    f, "a", self.compression, shared_payloads=True) as zipfp:
+                self.assertEqual(zipfp.read("a"), b"replaced")
+                # the shared payload outlives the member it was written for
+                zipfp.remove("a")
+                zipfp.commit(zipfileextended.COMMIT_INPLACE)
+                self.assertEqual(zipfp.read("c"), self.data)
+                self.assertIsNone(zipfp.verify(zipfileextended.VERIFY_FULL))
+                self.assertEqual(zipfp.namelist(), ["dir/", "dir/moved", "c", "dir2/"])
+
+    def test_replace(self):
+        larger = os.urandom(2 * len(self.data))
+        for f in get_files(self):
+            self.make_test_archive(f, self.compression)
+            with zipfileextended.ZipFileExtended(f, "a", self.compression) as zipfp:
+                offsets = {zinfo.filename: zinfo.header_offset
+                           for zinfo in zipfp.infolist()}
+                removed = zipfp.getinfo(TESTFN).compress_size
+                # fits in its old slot
+                zipfp.replace("another.name", b"short")
+                self.assertEqual(zipfp.getinfo("another.name").header_offset,
+                                 offsets["another.name"])
+                self.assertFalse(zipfp.requires_commit)
+                # too big, written after the last member
+                zipfp.replace(TESTFN, io.BytesIO(larger), bufsize=100)
+                self.assertGreater(zipfp.getinfo(TESTFN).header_offset,
+                                   offsets["strfile"])
+                self.assertGreater(zipfp.dead_space(), removed)
+                # the last member can always grow where it is
+                zipfp.replace(TESTFN, larger + larger,
+                              compress_type=zipfile.ZIP_STORED)
+                self.assertGreater(zipfp.getinfo(TESTFN).header_offset,
+                                   offsets["strfile"])
+                self.assertEqual(zipfp.read(TESTFN), larger + larger)
+                self.assertEqual(zipfp.read("another.name"), b"short")
+                self.assertIsNone(zipfp.testzip())
+            with zipfile.ZipFile(f) as zipfp:
+                self.assertEqual(zipfp.namelist(), ["another.name", TESTFN, "strfile"])
+                self.assertEqual(zipfp.getinfo(TESTFN).compress_type,
+                                 zipfile.ZIP_STORED)
+                self.assertEqual(zipfp.read("another.name"), b"short")
+                self.assertEqual(zipfp.read(TESTFN), larger + larger)
+                self.assertEqual(zipfp.read("strfile"), self.data)
+                self.assertIsNone(zipfp.testzip())
+            with zipfileextended.ZipFileExtended(f, "a") as zipfp:
+                # a pending rename is written with the new contents
+                zipfp.rename("strfile", "s")
+                zipfp.replace("s", "text")
+                zipfp.commit(zipfileextended.COMMIT_INPLACE)
+            with zipfile.ZipFile(f) as zipfp:
+                self.assertEqual(zipfp.read("s"), b"text")
+                self.assertIsNone(zipfp.testzip())
+
+    def test_replace_shrink_last(self):
+        # more than zipfile searches for the end of central directory record
+        data = os.urandom(100000)
+        for f in get_files(self):
+            with zipfileextended.ZipFileExtended(f, "w") as zipfp:
+                zipfp.writestr("first", self.data)
+                zipfp.writestr("last", data)
+                zipfp.replace("last", b"short")
+            with zipfile.ZipFile(f) as zipfp:
+                self.assertEqual(zipfp.namelist(), ["first", "last"])
+                self.assertEqual(zipfp.read("first"), self.data)
+                self.assertEqual(zipfp.read("last"), b"short")
+                self.assertIsNone(zipfp.testzip())
+
+    def snapshot_files(self, names):
+        """Copy the files names, with their modification times"""
+        snapshot = {}
+        for name in names:
+            if os.path.exists(name):
+                with open(name, "rb") as f:
+                    snapshot[name] = (f.read(), os.stat(name).st_mtime_ns)
+        return snapshot
+
+    def restore_files(self, snapshot):
+        for name, (data, mtime_ns) in snapshot.items():
+            with open(name, "wb") as f:
+                f.write(data)
+            os.utime(name, ns=(mtime_ns, mtime_ns))
+
+    def test_journal_rollback(self):
+        journal = TESTFN2 + ".journal"
+        snapshots = []
+
+        def crash(phase, seconds, stats):
+            if phase == "move":
+                snapshots.append(self.snapshot_files([TESTFN2, journal]))
+        try:
+            self.make_test_archive(TESTFN2, self.compression)
+            original = self.snapshot_files([TESTFN2])[TESTFN2][0]
+            with zipfileextended.ZipFileExtended(TESTFN2, "a", journal=True,
+                                                 commit_hook=crash) as zipfp:
+                self.assertIsNone(zipfp.recovered)
+                zipfp.remove(TESTFN)
+                zipfp.rename("another.name", "renamed")
+                zipfp.commit(zipfileextended.COMMIT_INPLACE)
+                self.assertEqual(zipfp.last_commit_stats.path, "inplace")
+                self.assertIn("journal", zipfp.last_commit_stats.phases)
+            self.assertFalse(os.path.exists(journal))
+
+            committed = self.snapshot_files([TESTFN2])[TESTFN2][0]
+
+            # a crash after the members were moved finishes the commit
+            self.restore_files(snapshots[0])
+            self.assertNotEqual(snapshots[0][TESTFN2][0], original)
+            with zipfileextended.ZipFileExtended(TESTFN2, journal=True) as zipfp:
+                self.assertEqual(zipfp.recovered, "rollforward")
+                self.assertEqual(zipfp.namelist(), ["renamed", "strfile"])
+                self.assertIsNone(zipfp.testzip())
+            self.assertFalse(os.path.exists(journal))
+            self.assertEqual(self.snapshot_files([TESTFN2])[TESTFN2][0], committed)
+            with open(TESTFN2, "wb") as f:
+                f.write(original)
+
+            # a commit that fails is rolled back straight away
+            with zipfileextended.ZipFileExtended(TESTFN2, "a", journal=True) as zipfp:
+                zipfp.remove(TESTFN)
+                with mock.patch.object(zipfileextended.ZipFileExtended, "verify",
+                                       return_value="strfile"):
+                    with self.assertRaises(zipfile.BadZipFile):
+                        zipfp.commit(zipfileextended.COMMIT_APPEND)
+                self.assertEqual(zipfp.namelist(),
+                                 ["another.name", TESTFN, "strfile"])
+                self.assertEqual(zipfp.read("strfile"), self.data)
+            self.assertFalse(os.path.exists(journal))
+            self.assertEqual(self.snapshot_files([TESTFN2])[TESTFN2][0], original)
+        finally:
+            unlink(TESTFN2)
+            unlink(journal)
+
+    def test_journal_rollforward(self):
+        journal = TESTFN2 + ".journal"
+        first = os.urandom(128 * 1024)
+        big = os.urandom(256 * 1024)
+        sizes = []
+
+        def measure(phase, seconds, stats):
+            if phase == "move":
+                sizes.append(os.path.getsize(journal))
+        try:
+            with zipfile.ZipFile(TESTFN2, "w", self.compression) as zipfp:
+                zipfp.writestr("first", first)
+                zipfp.writestr("big", big)
+                zipfp.writestr("last", b"last")
+            with open(TESTFN2, "rb") as f:
+                original = f.read()
+            with zipfileextended.ZipFileExtended(TESTFN2, "a", journal=True,
+                                                 commit_hook=measure) as zipfp:
+                zipfp.remove("first")
+                zipfp.commit(zipfileextended.COMMIT_INPLACE)
+                self.assertGreater(zipfp.last_commit_stats.bytes_read,
+                                   len(big) // 2)
+            # the moves are planned, not the data they move
+            self.assertLess(sizes[0], 4096)
+            with open(TESTFN2, "rb") as f:
+                committed = f.read()
+
+            # a crash at any checkpoint of the moves, including those saving
+            # a chunk overlapping its own source, finishes the commit
+            snapshots = []
+            checkpoint = zipfileextended._Journal._checkpoint
+
+            def snapshot(*args, **kwargs):
+                checkpoint(*args, **kwargs)
+                snapshots.append(self.snapshot_files([TESTFN2, journal]))
+            with open(TESTFN2, "wb") as f:
+                f.write(original)
+            with mock.patch.object(zipfileextended, "COPY_BUFSIZE", 64 * 1024), \
+                    mock.patch.object(zipfileextended, "_REDO_MIN_CHUNK", 1024 * 1024), \
+                    mock.patch.object(zipfileextended._Journal, "_checkpoint",
+                                      snapshot):
+                with zipfileextended.ZipFileExtended(TESTFN2, "a", journal=True) as zipfp:
+                    zipfp.remove("first")
+                    zipfp.commit(zipfileextended.COMMIT_INPLACE)
+            self.assertGreater(len(snapshots), 2)
+            for files in snapshots:
+                self.restore_files(files)
+                with zipfileextended.ZipFileExtended(TESTFN2, journal=True) as zipfp:
+                    self.assertEqual(zipfp.recovered, "rollforward")
+                    self.assertEqual(zipfp.namelist(), ["big", "last"])
+                    self.assertEqual(zipfp.read("big"), big)
+                self.assertFalse(os.path.exists(journal))
+                with open(TESTFN2, "rb") as f:
+                    self.assertEqual(f.read(), committed)
+        finally:
+            unlink(TESTFN2)
+            unlink(journal)
+
+    def test_journal_clone(self):
+        journal = TESTFN2 + ".journal"
+        snapshots = {}
+
+        def crash(phase, seconds, stats):
+            if phase in ("copy", "journal"):
+                with open(journal, "rb") as f:
+                    clone = os.fsdecode(f.read()[zipfileextended.sizeJournalHeader:])
+                snapshots[phase] = self.snapshot_files([TESTFN2, journal, clone])
+                snapshots["clone"] = clone
+        try:
+            self.make_test_archive(TESTFN2, self.compression)
+            with zipfileextended.ZipFileExtended(TESTFN2, "a", journal=True,
+                                                 commit_hook=crash) as zipfp:
+                zipfp.remove(TESTFN)
+                zipfp.commit(zipfileextended.COMMIT_CLONE)
+                self.assertEqual(zipfp.last_commit_stats.path, "clone-rename")
+                self.assertEqual(zipfp.namelist(), ["another.name", "strfile"])
+            self.assertFalse(os.path.exists(journal))
+            self.assertFalse(os.path.exists(snapshots["clone"]))
+
+            # a crash while the clone was written throws it away
+            self.restore_files(snapshots["copy"])
+            with zipfileextended.ZipFileExtended(TESTFN2, journal=True) as zipfp:
+                self.assertEqual(zipfp.recovered, "rollback")
+                self.assertEqual(zipfp.namelist(),
+                                 ["another.name", TESTFN, "strfile"])
+            self.assertFalse(os.path.exists(snapshots["clone"]))
+
+            # once it was complete the clone is swapped in
+            self.restore_files(snapshots["journal"])
+            with zipfileextended.ZipFileExtended(TESTFN2, journal=True) as zipfp:
+                self.assertEqual(zipfp.recovered, "rollforward")
+                self.assertEqual(zipfp.namelist(), ["another.name", "strfile"])
+                self.assertIsNone(zipfp.testzip())
+            self.assertFalse(os.path.exists(snapshots["clone"]))
+            self.assertFalse(os.path.exists(journal))
+        finally:
+            unlink(TESTFN2)
+            unlink(journal)
+            if "clone" in snapshots:
+                unlink(snapshots["clone"])
+
+    def test_inplace_rename_longer_name(self):
+        for f in get_files(self):
+            self.make_test_archive(f, self.compression)
+            with zipfileextended.ZipFileExtended(f, "a", self.compression) as zipfp:
+                # No space has been freed so falls back to cloning
+                zipfp.rename("another.name", "a.much.longer.name")
+                zipfp.commit(zipfileextended.COMMIT_INPLACE)
+            with zipfileextended.ZipFileExtended(f, "r") as zipfp:
+                self.assertEqual(zipfp.read("a.much.longer.name"), self.data)
+                self.assertIsNone(zipfp.testzip())
+
+    def test_read_compressed(self):
+        for f in get_files(self):
+            self.make_test_archive(f, self.compression)
+            with zipfileextended.ZipFileExtended(f) as zipfp:
+                zinfo = zipfp.getinfo("strfile")
+                data = zipfp.read_compressed("strfile")
+                self.assertEqual(len(data), zinfo.compress_size)
+                if self.compression == zipfile.ZIP_STORED:
+                    self.assertEqual(data, self.data)
+                with zipfp.open_compressed(zinfo) as fp:
+                    self.assertEqual(fp.length, zinfo.compress_size)
+                    buf = bytearray(5)
+                    self.assertEqual(fp.readinto(buf), 5)
+                    self.assertEqual(bytes(buf), data[:5])
+                    self.assertEqual(fp.read(), data[5:])
+                    self.assertEqual(fp.read(), b"")
+
+    def test_verify(self):
+        with io.BytesIO() as f:
+            self.make_test_archive(f, self.compression)
+            with zipfileextended.ZipFileExtended(f) as zipfp:
+                zinfo = zipfp.getinfo("strfile")
+                header = len(zipfp._local_header(zinfo))
+                for level in (zipfileextended.VERIFY_NONE,
+                              zipfileextended.VERIFY_STRUCTURE,
+                              zipfileextended.VERIFY_TOUCHED,
+                              zipfileextended.VERIFY_FULL):
+                    self.assertIsNone(zipfp.verify(level, ["strfile"]))
+
+            # corrupt the data of strfile
+            data = bytearray(f.getvalue())
+            data[zinfo.header_offset + header + zinfo.compress_size // 2] ^= 0xff
+            with zipfileextended.ZipFileExtended(io.BytesIO(data)) as zipfp:
+                self.assertIsNone(zipfp.verify(zipfileextended.VERIFY_STRUCTURE))
+                self.assertIsNone(zipfp.verify(zipfileextended.VERIFY_TOUCHED,
+                                               ["another.name"]))
+                self.assertEqual(zipfp.verify(zipfileextended.VERIFY_TOUCHED,
+                                              ["strfile"]), "strfile")
+                self.assertEqual(zipfp.verify(zipfileextended.VERIFY_FULL),
+                                 "strfile")
+
+            # corrupt the local header of strfile
+            data = bytearray(f.getvalue())
+            data[zinfo.header_offset] ^= 0xff
+            with zipfileextended.ZipFileExtended(io.BytesIO(data)) as zipfp:
+                self.assertEqual(zipfp.verify(zipfileextended.VERIFY_STRUCTURE),
+                                 "strfile")
+
+    def test_verify_report(self):
+        with io.BytesIO() as f:
+            self.make_test_archive(f, self.compression)
+            data = bytearray(f.getvalue())
+            with zipfileextended.ZipFileExtended(f) as zipfp:
+                report = zipfp.verify_report(workers=2)
+                self.assertTrue(report.ok)
+                self.assertIsNone(report.first_bad)
+                self.assertEqual(len(report.checks), 6)
+                self.assertEqual([c.stage for c in report.checks],
+                                 ["structure"] * 3 + ["crc"] * 3)
+                report = zipfp.verify_report(zipfileextended.VERIFY_TOUCHED,
+                                             ["strfile", "missing"])
+                self.assertEqual([(c.name, c.ok) for c in report.bad],
+                                 [("missing", False)])
+                first = zipfp.getinfo(TESTFN)
+                last = zipfp.getinfo("strfile")
+                header = len(zipfp._local_header(last))
+
+        # corrupt the data of one member and the header of another
+        data[last.header_offset + header + last.compress_size // 2] ^= 0xff
+        data[first.header_offset] ^= 0xff
+        with zipfileextended.ZipFileExtended(io.BytesIO(data)) as zipfp:
+            report = zipfp.verify_report()
+            self.assertFalse(report.ok)
+            self.assertEqual([(c.name, c.stage) for c in report.bad],
+                             [(TESTFN, "structure"), ("strfile", "crc")])
+            self.assertTrue(all(c.error for c in report.bad))
+            # the member with a bad header isn't CRC checked
+            self.assertEqual([c.name for c in report.checks if c.stage == "crc"],
+                             ["another.name", "strfile"])
+            self.assertEqual(report.first_bad, TESTFN)
+            self.assertEqual(zipfp.verify(), TESTFN)
+
+    def test_verify_full_commit_in_memory(self):
+        # verification runs while the commit holds the archive's lock
+        f = io.BytesIO()
+        self.make_test_archive(f, self.compression)
+        with zipfileextended.ZipFileExtended(
+                f, "a", self.compression,
+                commit_mode=zipfileextended.COMMIT_INPLACE) as zipfp:
+            zipfp.remove(TESTFN)
+            zipfp.commit(verify=zipfileextended.VERIFY_FULL)
+            self.assertEqual(sorted(zipfp.namelist()), ["another.name", "strfile"])
+            self.assertTrue(zipfp.verify_report().ok)
+
+    def test_rename_same_length_in_place(self):
+        for f in get_files(self):
+            self.make_test_archive(f, self.compression)
+            with zipfileextended.ZipFileExtended(f, "a", self.compression) as zipfp:
+                offsets = [i.header_offset for i in zipfp.infolist()]
+                size = zipfp.start_dir
+                zipfp.rename("strfile", "strfil2")
+                with mock.patch.object(zipfp, "_commit_clone") as commit_clone:
+                    zipfp.commit()
+                    self.assertFalse(commit_clone.called)
+                self.assertEqual([i.header_offset for i in zipfp.infolist()],
+                                 offsets)
+                self.assertEqual(zipfp.start_dir, size)
+            # readable by zipfile too as the local header has been updated
+            with zipfile.ZipFile(f) as zipfp:
+                self.assertEqual(zipfp.read("strfil2"), self.data)
+                self.assertIsNone(zipfp.testzip())
+
+    def test_directory_only_rename(self):
+        for f in get_files(self):
+            self.make_test_archive(f, self.compression)
+            with zipfileextended.ZipFileExtended(
+                    f, "a", self.compression,
+                    directory_only_renames=True) as zipfp:
+                offsets = [i.header_offset for i in zipfp.infolist()]
+                zipfp.rename("strfile", "a.new.longer.name")
+                zipfp.commit()
+                self.assertEqual([i.header_offset for i in zipfp.infolist()],
+                                 offsets)
+                self.assertEqual(zipfp.read("a.new.longer.name"), self.data)
+            with zipfileextended.ZipFileExtended(
+                    f, directory_only_renames=True) as zipfp:
+                self.assertEqual(zipfp.read("a.new.longer.name"), self.data)
+                self.assertIsNone(zipfp.verify(zipfileextended.VERIFY_FULL))
+            with zipfile.ZipFile(f) as zipfp:
+                with self.assertRaises(zipfile.BadZipFile):
+                    zipfp.read("a.new.longer.name")
+
+    def test_batch(self):
+        for f in get_files(self):
+            self.make_test_archive(f, self.compression)
+            with zipfileextended.ZipFileExtended(f, "a", self.compression) as zipfp:
+                with zipfp.batch() as batch:
+                    batch.remove(TESTFN)
+                    # swap names
+                    batch.rename("another.name", "strfile")
+                    batch.rename("strfile", "another.name")
+                    batch.writestr("added", b"new data")
+                    # nothing is applied until the batch exits
+                    self.assertIn(TESTFN, zipfp.namelist())
+                self.assertFalse(zipfp.requires_commit)
+                with zipfp.batch() as batch:
+                    batch.replace("added", b"newer data")
+                self.assertEqual(sorted(zipfp.namelist()),
+                                 ["added", "another.name", "strfile"])
+            with zipfileextended.ZipFileExtended(f) as zipfp:
+                self.assertEqual(sorted(zipfp.namelist()),
+                                 ["added", "another.name", "strfile"])
+                self.assertEqual(zipfp.read("added"), b"newer data")
+                self.assertEqual(zipfp.read("strfile"), self.data)
+                self.assertIsNone(zipfp.testzip())
+
+    def test_batch_discarded_on_error(self):
+        for f in get_files(self):
+            self.make_test_archive(f, self.compression)
+            with zipfileextended.ZipFileExtended(f, "a", self.compression) as zipfp:
+                with self.assertRaises(KeyError):
+                    with zipfp.batch() as batch:
+                        batch.remove(TESTFN)
+                        batch.remove("non.existent.file")
+                self.assertFalse(zipfp.requires_commit)
+                self.assertIn(TESTFN, zipfp.namelist())
+
+    def test_extract_many(self):
+        for f in get_files(self):
+            self.make_test_archive(f, self.compression)
+            with zipfileextended.ZipFileExtended(f, "a", self.compression) as zipfp:
+                zipfp.writestr("sub/dir/nested", self.data)
+                zipfp.writestr("empty/", b"")
+            with zipfileextended.ZipFileExtended(f) as zipfp, \
+                    tempfile.TemporaryDirectory() as path:
+                names = zipfp.namelist()
+                paths = zipfp.extract_many(path=path, workers=4)
+                self.assertEqual(len(paths), len(names))
+                for name, target in zip(names, paths):
+                    if name.endswith("/"):
+                        self.assertTrue(os.path.isdir(target))
+                        continue
+                    self.assertEqual(target, os.path.join(path, *name.split("/")))
+                    with open(target, "rb") as fp:
+                        self.assertEqual(fp.read(), self.data)
+
+    def test_mmap(self):
+        for f in get_files(self):
+            self.make_test_archive(f, self.compression)
+            with zipfileextended.ZipFileExtended(f, use_mmap=True) as zipfp:
+                if not isinstance(f, io.BytesIO):
+                    self.assertIsNotNone(zipfp._mmap)
+                for name in zipfp.namelist():
+                    self.assertEqual(zipfp.read(name), self.data)
+                    self.assertEqual(zipfp.view(name), self.data)
+                    self.assertEqual(zipfp.compressed_view(name),
+                                     zipfp.read_compressed(name))
+                self.assertIsNone(zipfp.testzip())
+            self.assertIsNone(zipfp._mmap)
+            with self.assertRaises(ValueError):
+                zipfileextended.ZipFileExtended(f, "a", use_mmap=True)
+
+    def test_lazy(self):
+        for f in get_files(self):
+            self.make_test_archive(f, self.compression)
+            with zipfileextended.ZipFileExtended(f, "a", self.compression,
+                                                 lazy=True) as zipfp:
+                self.assertEqual(zipfp.read("strfile"), self.data)
+                self.assertEqual(zipfp.getinfo(TESTFN).file_size, len(self.data))
+                with self.assertRaises(KeyError):
+                    zipfp.getinfo("non.existent.file")
+                zipfp.remove(TESTFN)
+                zipfp.rename("strfile", "renamed")
+                with self.assertRaises(KeyError):
+                    zipfp.getinfo(TESTFN)
+                with self.assertRaises(KeyError):
+                    zipfp.getinfo("strfile")
+                self.assertEqual(zipfp.read("renamed"), self.data)
+                # nothing above needed every member
+                self.assertIsNotNone(zipfp._lazy)
+                self.assertEqual(sorted(zipfp.namelist()),
+                                 ["another.name", "renamed"])
+                self.assertIsNone(zipfp._lazy)
+            with zipfileextended.ZipFileExtended(f, lazy=True) as zipfp:
+                self.assertEqual(zipfp.read("renamed"), self.data)
+                self.assertEqual(zipfp.read("another.name"), self.data)
+                with self.assertRaises(KeyError):
+                    zipfp.getinfo(TESTFN)
+                self.assertIsNone(zipfp.testzip())
+
+    def make_overlapped_archive(self, f):
+        """Write an archive whose first member's data, going by the central
+        directory, runs into the next member's local header"""
+        with zipfile.ZipFile(f, "w") as zipfp:
+            zipfp.writestr("a", self.data)
+            zipfp.writestr("b", self.data)
+        with zipfile.ZipFile(f) as zipfp:
+            start_dir = zipfp.start_dir
+        with open(f, "r+b") as fp:
+            # the compressed size of the first central directory record
+            fp.seek(start_dir + 20)
+            fp.write(struct.pack("<L", len(self.data) + 10))
+
+    @unittest.skipUnless(hasattr(zipfile.ZipInfo(), "_end_offset"),
+                         "zipfile doesn't check for overlapped entries")
+    def test_overlapped_entries(self):
+        self.make_overlapped_archive(TESTFN2)
+        self.addCleanup(unlink, TESTFN2 + ".idx")
+        # the second index_cache open loads the cached end offsets
+        for kwargs in ({}, {"lazy": True}, {"index_cache": True},
+                       {"index_cache": True}, {"use_mmap": True}):
+            with zipfileextended.ZipFileExtended(TESTFN2, **kwargs) as zipfp:
+                with self.assertRaisesRegex(zipfile.BadZipFile,
+                                            "Overlapped entries"):
+                    zipfp.open("a")
+                self.assertEqual(zipfp.read("b"), self.data)
+        with zipfileextended.ZipFileExtended(TESTFN2) as zipfp, \
+                tempfile.TemporaryDirectory() as path:
+            with self.assertRaisesRegex(zipfile.BadZipFile,
+                                        "Overlapped entries"):
+                zipfp.extract_many(path=path)
+        # members are bounded as zipfile bounds them
+        self.make_test_archive(TESTFN2, self.compression)
+        with zipfile.ZipFile(TESTFN2) as zipfp:
+            ends = {zinfo.filename: zinfo._end_offset
+                    for zinfo in zipfp.infolist()}
+        with zipfileextended.ZipFileExtended(TESTFN2, lazy=True) as zipfp:
+            self.assertEqual({zinfo.filename: zinfo._end_offset
+                              for zinfo in zipfp.infolist()}, ends)
+
+    def test_unsupported_flags(self):
+        with zipfile.ZipFile(TESTFN2, "w") as zipfp:
+            zipfp.writestr("a", self.data)
+        with zipfile.ZipFile(TESTFN2) as zipfp:
+            start_dir = zipfp.start_dir
+        for flag, message in ((0x20, "compressed patched"),
+                              (0x40, "strong encryption")):
+            with open(TESTFN2, "r+b") as fp:
+                # the general purpose flags of the central directory record
+                fp.seek(start_dir + 8)
+                fp.write(struct.pack("<H", flag))
+            with zipfileextended.ZipFileExtended(TESTFN2, use_mmap=True) as zipfp:
+                with self.assertRaisesRegex(NotImplementedError, message):
+                    zipfp.open("a")
+                with tempfile.TemporaryDirectory() as path, \
+                        self.assertRaisesRegex(NotImplementedError, message):
+                    zipfp.extract_many(path=path)
+
+    def test_index_cache(self):
+        self.make_test_archive(TESTFN2, self.compression)
+        cache = TESTFN2 + ".idx"
+        self.addCleanup(unlink, cache)
+        with zipfileextended.ZipFileExtended(TESTFN2, index_cache=True) as zipfp:
+            self.assertEqual(zipfp.read(TESTFN), self.data)
+        self.assertTrue(os.path.exists(cache))
+        # a second open loads the saved index, end offsets included
+        with mock.patch.object(zipfileextended._LazyDirectory, "save") as save, \
+                mock.patch.object(zipfileextended._LazyDirectory,
+                                  "_end_offsets") as end_offsets:
+            with zipfileextended.ZipFileExtended(TESTFN2, "a", self.compression,
+                                                 index_cache=True) as zipfp:
+                self.assertEqual(sorted(zipfp.namelist()),
+                                 sorted([TESTFN, "another.name", "strfile"]))
+                self.assertEqual(zipfp.read("strfile"), self.data)
+            save.assert_not_called()
+            end_offsets.assert_not_called()
+        # commit brings the cache up to date
+        with zipfileextended.ZipFileExtended(TESTFN2, "a", self.compression,
+                                             index_cache=True,
+                                             commit_mode=zipfileextended.COMMIT_INPLACE) as zipfp:
+            zipfp.remove(TESTFN)
+            zipfp.rename("strfile", "renamed")
+            zipfp.commit()
+        with mock.patch.object(zipfileextended._LazyDirectory, "save") as save:
+            with zipfileextended.ZipFileExtended(TESTFN2, lazy=True,
+                                                 index_cache=True) as zipfp:
+                self.assertEqual(zipfp.read("renamed"), self.data)
+                self.assertEqual(sorted(zipfp.namelist()),
+                                 ["another.name", "renamed"])
+                self.assertIsNone(zipfp.testzip())
+            save.assert_not_called()
+        # a change made without the cache is noticed
+        with zipfileextended.ZipFileExtended(TESTFN2, "a", self.compression) as zipfp:
+            zipfp.writestr("new", self.data)
+        with zipfileextended.ZipFileExtended(TESTFN2, index_cache=True) as zipfp:
+            self.assertEqual(zipfp.read("new"), self.data)
+        # a cache directory
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for _ in range(2):
+                with zipfileextended.ZipFileExtended(TESTFN2,
+                                                     index_cache=cache_dir) as zipfp:
+                    self.assertEqual(zipfp.read("new"), self.data)
+                self.assertEqual(len(os.listdir(cache_dir)), 1)
+
     def test_remove_nonexistent_file(self):
         for f in get_files(self):
             self.zip_remove_nonexistent_file_test(f, self.compression)
@@ -273,6 +1315,74 @@ class AbstractZipExtTestWithSourceFile:
                 for i in infos:
                     self.assertEqual(i.file_size, len(self.data))
 
+    def test_clone_with_filenames_pending_changes(self):
+        for f in get_files(self):
+            self.make_test_archive(f, self.compression)
+            with zipfileextended.ZipFileExtended(f, "a", self.compression) as zipfp:
+                zipfp.writestr("new", b"new data")
+                zipfp.rename("strfile", "renamed")
+                with zipfp.clone(TESTFN3, ["another.name"],
+                                 verify=zipfileextended.VERIFY_TOUCHED) as clone:
+                    self.assertEqual(clone.namelist(), ["another.name"])
+                    self.assertEqual(clone.read("another.name"), self.data)
+                with zipfp.clone(TESTFN3, ["another.name", "renamed"],
+                                 verify=zipfileextended.VERIFY_TOUCHED) as clone:
+                    self.assertEqual(clone.namelist(),
+                                     ["another.name", "renamed"])
+                    self.assertEqual(clone.read("renamed"), self.data)
+
+    def test_clone_with_small_bufsize(self):
+        for f in get_files(self):
+            self.make_test_archive(f, self.compression)
+            with zipfileextended.ZipFileExtended(f) as zipfp:
+                offsets = [i.header_offset for i in zipfp.infolist()]
+                with zipfp.clone(TESTFN3, ["another.name", "strfile"],
+                                 bufsize=7) as clone:
+                    self.assertEqual(clone.read("another.name"), self.data)
+                    self.assertEqual(clone.read("strfile"), self.data)
+                # the source archive is left untouched
+                self.assertEqual([i.header_offset for i in zipfp.infolist()],
+                                 offsets)
+                self.assertEqual(zipfp.read(TESTFN), self.data)
+
+    @requires_zlib
+    def test_clone_recompress(self):
+        for f in get_files(self):
+            self.zip_clone_recompress_test(f, zipfile.ZIP_DEFLATED, None)
+
+    @requires_zlib
+    def test_clone_recompress_in_workers(self):
+        for f in get_files(self):
+            self.zip_clone_recompress_test(f, zipfile.ZIP_DEFLATED, 2)
+
+    def zip_clone_recompress_test(self, f, compress_type, workers):
+        self.make_test_archive(f, self.compression)
+        with zipfileextended.ZipFileExtended(f) as zipfp:
+            with zipfp.clone(TESTFN3, compress_type=compress_type,
+                             compresslevel=1, workers=workers) as clone:
+                self.assertEqual(len(clone.namelist()), 3)
+                for zinfo in clone.infolist():
+                    self.assertEqual(zinfo.compress_type, compress_type)
+                    self.assertEqual(clone.read(zinfo), self.data)
+                self.assertIsNone(clone.testzip())
+            with zipfile.ZipFile(TESTFN3) as clone:
+                self.assertIsNone(clone.testzip())
+
+    @requires_zlib
+    def test_clone_recompress_with_filenames(self):
+        for f in get_files(self):
+            self.make_test_archive(f, zipfile.ZIP_STORED)
+            with zipfileextended.ZipFileExtended(f, "a") as zipfp:
+                zipfp.writestr("new", b"new data")
+                zipfp.rename("strfile", "renamed")
+                # verified as VERIFY_TOUCHED, the pending changes left out
+                with zipfp.clone(TESTFN3, ["another.name"],
+                                 compress_type=zipfile.ZIP_DEFLATED) as clone:
+                    self.assertEqual(clone.namelist(), ["another.name"])
+                    self.assertEqual(clone.getinfo("another.name").compress_type,
+                                     zipfile.ZIP_DEFLATED)
+                    self.assertEqual(clone.read("another.name"), self.data)
+
     def test_clone_with_fileinfos(self):
         for f in get_files(self):
             self.zip_clone_with_fileinfos_test(f, self.compression)
@@ -315,6 +1425,42 @@ class AbstractZipExtTestWithSourceFile:
                 data = file.read(file.length)
                 self.assertEqual(data, hidden)
 
+    def test_hidden_files_local_extra(self):
+        # the local header has an extra field the central directory doesn't
+        with io.BytesIO() as f:
+            with zipfileextended.ZipFileExtended(f, "w") as zipfp:
+                zinfo = zipfile.ZipInfo("extra")
+                zinfo.extra = b"\xfe\xca\x04\x00abcd"
+                zipfp.writestr(zinfo, b"data")
+                zipfp.writestr("other", b"more data")
+                zinfo.extra = b""
+            with zipfileextended.ZipFileExtended(f, "a") as zipfp:
+                self.assertEqual(zipfp._hidden_files(), [])
+                layout = zipfp._get_layout()
+                # new members are added to the same index
+                zipfp.writestr("new", b"new data")
+                self.assertIs(zipfp._get_layout(), layout)
+                self.assertEqual(len(layout.infos), 3)
+                self.assertEqual(zipfp._hidden_files(), [])
+                zipfp.remove("extra")
+                self.assertEqual(zipfp._hidden_files(), [])
+                zipfp.commit(zipfileextended.COMMIT_INPLACE)
+                self.assertEqual(zipfp.read("other"), b"more data")
+                self.assertEqual(zipfp._hidden_files(), [])
+
+    def test_hidden_views(self):
+        f = findfile("zip_hiddenfiles.zip")
+        with zipfileextended.ZipFileExtended(f) as zipfp:
+            hidden_data = [h.read(h.length) for h in zipfp._hidden_files()]
+            self.assertEqual(zipfp.hidden_views(), hidden_data)
+        with zipfileextended.ZipFileExtended(f, use_mmap=True) as zipfp:
+            views = zipfp.hidden_views()
+            self.assertEqual(views, hidden_data)
+            for name in zipfp.namelist():
+                zipfp.read(name)
+        # views outlive the archive
+        self.assertEqual(views, hidden_data)
+
     def test_clone_with_hidden_files(self):
         f = findfile("zip_hiddenfiles.zip")
         hidden_data = [b'This is a prefix.\n',
@@ -352,6 +1498,25 @@ class AbstractZipExtTestWithSourceFile:
                 names = [i.filename for i in infos]
                 self.assertEqual(len(names), 4)
 
+    def test_inplace_commit_with_hidden_files(self):
+        f = findfile("zip_hiddenfiles.zip")
+        with open(f, "rb") as fp:
+            data = fp.read()
+        with io.BytesIO(data) as fp:
+            with zipfileextended.ZipFileExtended(fp, "a") as zipfp:
+                original_files = {fileinfo.filename: zipfp.read(fileinfo.filename)
+                                  for fileinfo in zipfp.infolist()}
+                hidden_data = [h.read(h.length) for h in zipfp._hidden_files()]
+                zipfp.remove("two")
+                zipfp.commit(zipfileextended.COMMIT_INPLACE)
+                self.assertLess(len(fp.getvalue()), len(data))
+            with zipfileextended.ZipFileExtended(fp) as zipfp:
+                self.assertNotIn("two", zipfp.namelist())
+                self.assertEqual([h.read(h.length) for h in zipfp._hidden_files()],
+                                 hidden_data)
+                for name in zipfp.namelist():
+                    self.assertEqual(zipfp.read(name), original_files[name])
+
     def test_clone_ignore_hidden_files(self):
         f = findfile("zip_hiddenfiles.zip")
         with zipfileextended.ZipFileExtended(f) as f:
@@ -409,6 +1574,57 @@ class LzmaTestsWithSourceFile(AbstractZipExtTestWithSourceFile,
                               unittest.TestCase):
     compression = zipfile.ZIP_LZMA
 
+class CopyRangeTests(unittest.TestCase):
+
+    data = bytes(getrandbits(8) for _ in range(10000))
+
+    def copy_range_test(self, src, dst):
+        src.write(self.data)
+        dst.write(b"prefix")
+        zipfileextended._copy_range(src, 100, dst, 5000, bufsize=333)
+        self.assertEqual(dst.tell(), 5006)
+        dst.seek(0)
+        self.assertEqual(dst.read(), b"prefix" + self.data[100:5100])
+
+    def test_copy_range_files(self):
+        with TemporaryFile() as src, TemporaryFile() as dst:
+            self.copy_range_test(src, dst)
+
+    def test_copy_range_streams(self):
+        with io.BytesIO() as src, TemporaryFile() as dst:
+            self.copy_range_test(src, dst)
+        with TemporaryFile() as src, io.BytesIO() as dst:
+            self.copy_range_test(src, dst)
+
+    def test_copy_range_progress(self):
+        class ReadOnly:
+            # a stream without readinto
+            def __init__(self, data):
+                self.f = io.BytesIO(data)
+                self.read = self.f.read
+                self.seek = self.f.seek
+
+        for make_src in (io.BytesIO, lambda data: io.BufferedReader(io.BytesIO(data)),
+                         ReadOnly):
+            src = make_src(self.data)
+            with io.BytesIO() as dst:
+                progress = []
+                zipfileextended._copy_range(src, 100, dst, 5000, bufsize=333,
+                                            progress=lambda *args: progress.append(args))
+                self.assertEqual(dst.getvalue(), self.data[100:5100])
+                self.assertEqual(progress[-1], (5000, 5000))
+                self.assertEqual(progress, sorted(progress))
+                if make_src is not io.BytesIO:
+                    # copied in blocks of bufsize
+                    self.assertEqual(len(progress), 16)
+
+    def test_copy_range_without_kernel_support(self):
+        with mock.patch.object(zipfileextended, "_kernel_copy",
+                               return_value=0):
+            with TemporaryFile() as src, TemporaryFile() as dst:
+                self.copy_range_test(src, dst)
+
+
 class TestsWithLargeSourceFile(unittest.TestCase):
 
     def setUp(self):
@@ -2,12 +2,89 @@ import io
 import os
 import zipfile
 import tempfile
-import types
+import copy
 import shutil
 from zipfile import ZipFile
-from zipfile import (ZIP_DEFLATED, ZIP_STORED, ZIP_LZMA, ZIP64_LIMIT)
+from zipfile import (ZIP_STORED, ZIP_LZMA, ZIP64_LIMIT)
 import struct
 import operator
+import array
+import sys
+import binascii
+import bisect
+import collections
+import concurrent.futures
+import asyncio
+import functools
+import contextlib
+import time
+import posixpath
+import itertools
+import hashlib
+
+# Strategies available to commit() for writing outstanding changes
+COMMIT_CLONE = "clone"
+COMMIT_INPLACE = "inplace"
+COMMIT_APPEND = "append"
+
+# Integrity checks made by clone() and commit() on the archive they write
+VERIFY_NONE = "none"             # no checks
+VERIFY_STRUCTURE = "structure"   # central directory and local headers agree
+VERIFY_TOUCHED = "touched"       # structure plus CRC of renamed/added members
+VERIFY_FULL = "full"             # structure plus CRC of every member
+
+# How copy_from() and merge() resolve a member whose name is already taken
+CONFLICT_ERROR = "error"      # raise ValueError
+CONFLICT_SKIP = "skip"        # keep the existing member
+CONFLICT_REPLACE = "replace"  # remove the existing member
+CONFLICT_RENAME = "rename"    # add the new member as name~1.ext, name~2.ext...
+
+# Deduplication of members with identical contents by clone() and commit()
+DEDUP_REPORT = "report"  # find duplicate sets, recorded in the CommitStats
+DEDUP_SHARE = "share"    # duplicates share the first one's local payload
+
+# Size of the chunks used when moving blocks of data around in an archive
+COPY_BUFSIZE = 1024 * 1024
+
+stringDataDescriptor = b"PK\x07\x08"
+
+# Header of an index cache file: magic, key length, number of members,
+# central directory length, concat
+structIndexHeader = "<8sQQQq"
+stringIndexHeader = b"ZXINDEX\x02"
+sizeIndexHeader = struct.calcsize(structIndexHeader)
+
+# Header of a commit journal: magic, state, the archive's size and
+# modification time when the commit began. Undo journals follow it with
+# (offset, length) regions each followed by the bytes saved from the archive,
+# clone journals with the path of the clone. Redo journals follow it with a
+# checkpoint (the move in progress, the bytes of it done and the length of
+# any chunk of it saved at the end of the journal), the number of moves, the
+# offset and length of the new central directory, each move as (src, dst,
+# length, header length) followed by the local header written just before
+# dst, and the central directory.
+structJournalHeader = "<7sBQq"
+stringJournalHeader = b"ZXJRNL\x01"
+sizeJournalHeader = struct.calcsize(structJournalHeader)
+structJournalRegion = "<QQ"
+sizeJournalRegion = struct.calcsize(structJournalRegion)
+structJournalCheckpoint = "<QQQ"
+sizeJournalCheckpoint = struct.calcsize(structJournalCheckpoint)
+structJournalMoves = "<QQQ"
+sizeJournalMoves = struct.calcsize(structJournalMoves)
+structJournalMove = "<QQQL"
+sizeJournalMove = struct.calcsize(structJournalMove)
+
+# Journal states, the journal is only acted on once its state is set
+_JOURNAL_INCOMPLETE = 0
+_JOURNAL_UNDO = 1           # regions saved before being overwritten in place
+_JOURNAL_CLONE = 2          # a clone is being written
+_JOURNAL_CLONE_READY = 3    # the clone is complete, to be swapped in
+_JOURNAL_REDO = 4           # data moves to make in place, rolled forward
+
+# Moves closer than this to their source are copied through the journal, the
+# rest in chunks no bigger than the distance moved
+_REDO_MIN_CHUNK = 64 * 1024
 
 
 class ZipFileExtended(ZipFile):
@@ -31,58 +108,822 @@ class ZipFileExtended(ZipFile):
                     needed, otherwise it will raise an exception when this would
                     be necessary.
 
+        commit_mode: The strategy used by commit() (and so close()) to write
+                     outstanding changes, either COMMIT_CLONE (rewrite the
+                     archive via a temporary clone), COMMIT_INPLACE (compact
+                     the archive in place) or COMMIT_APPEND (only rewrite the
+                     central directory, leaving removed members as dead
+                     space, see compact()).
+
+        compact_threshold: if set, a COMMIT_APPEND commit that leaves more
+                     than this fraction (0-1) of the archive's data as dead
+                     space, see dead_space(), compacts the archive, dropping
+                     the dead space along with any other hidden files.
+
+        use_mmap: if True, and the archive is opened in read mode from a real
+                     file, members are read from a memory map of the file
+                     rather than through the shared file pointer, so readers
+                     in different threads don't contend for its lock, and
+                     view(), compressed_view() and hidden_views() return
+                     slices of the map without copying.
+
+        lazy: if True the central directory is kept as raw bytes with a
+                     compact index over the member names, and ZipInfo objects
+                     are only created for the members asked for. getinfo(),
+                     read(), open(), remove() and rename() work without
+                     loading every member, anything needing the full list
+                     (e.g. infolist(), writing or committing) loads it.
+
+        index_cache: cache the central directory index used by lazy in a
+                     file so later opens of the unchanged archive load it
+                     rather than parsing the directory. True for a sidecar
+                     file next to the archive (archive name + ".idx"), or the
+                     path of a directory to keep the cache files in. Only
+                     used for archives opened by filename. Without lazy the
+                     members are loaded from the index straight away.
+
+        commit_hook: called as commit_hook(phase, seconds, stats) as each
+                     phase of a commit (e.g. "copy", "verify", "swap")
+                     finishes, and finally with phase "commit" and the
+                     commit's total time. stats is the CommitStats being
+                     gathered, also kept as last_commit_stats.
+
+        fsync: if True a commit flushes what it writes through to disk with
+                     os.fsync() before returning, including the directory
+                     entry when a clone is renamed over the archive.
+
+        commit_progress: called as commit_progress(phase, done, total) while
+                     a commit copies the archive as a stream, i.e. when it
+                     was passed as a file object or the clone lives on
+                     another mount ("backup" then "stream_copy" phases), or
+                     copies an in-memory clone back ("stream_copy").
+
+        journal: if True commits are made crash safe with an intent log kept
+                     next to the archive (archive name + ".journal"). The
+                     headers and directory a commit patches in place are
+                     saved to it first, the data moves an in-place compaction
+                     makes are planned in it, or the clone about to replace
+                     the archive is recorded, and opening the archive with
+                     this flag rolls a commit interrupted by a crash back (or
+                     forward, finishing the moves or swapping in the complete
+                     clone). Only used for archives opened by filename.
+
+        directory_only_renames: if True a rename that can't be patched into
+                     the member's local header in place (the new name has a
+                     different length) is only written to the central
+                     directory, leaving the old name in the local header.
+                     Other zip readers, including zipfile, reject such
+                     members; ZipFileExtended reads them when opened with
+                     this flag set.
+
+        shared_payloads: if True members may share their local header and
+                     contents with others, see DEDUP_SHARE, so a local header
+                     holding another member's name is accepted. Other zip
+                     readers, including zipfile, reject such members.
+
         """
-    def __init__(self, file, mode="r", compression=zipfile.ZIP_STORED, allowZip64=True):
+    def __init__(self, file, mode="r", compression=zipfile.ZIP_STORED,
+                 allowZip64=True, commit_mode=COMMIT_CLONE,
+                 directory_only_renames=False, use_mmap=False, lazy=False,
+                 index_cache=None, compact_threshold=None, commit_hook=None,
+                 fsync=False, commit_progress=None, journal=False,
+                 shared_payloads=False):
+        self._mmap = None
+        self.journal = journal
+        # how a commit interrupted by a crash was recovered, if one was
+        self.recovered = None
+        if journal and isinstance(file, (str, os.PathLike)):
+            file = os.fspath(file)
+            self.recovered = _Journal(file + ".journal").recover(file)
+        self.lazy = lazy
+        self._lazy = None
+        self.index_cache = index_cache
+        if use_mmap and mode != "r":
+            raise ValueError("use_mmap requires mode 'r'")
         super().__init__(file,mode=mode,compression=compression,allowZip64=allowZip64)
         self.requires_commit = False
         self.removed_filelist = []
+        self.commit_mode = commit_mode
+        self.compact_threshold = compact_threshold
+        self.commit_hook = commit_hook
+        self.fsync = fsync
+        self.commit_progress = commit_progress
+        # CommitStats of the last commit, and of the one in progress
+        self.last_commit_stats = None
+        self._stats = None
+        self.directory_only_renames = directory_only_renames
+        self.shared_payloads = shared_payloads
+        # built on demand by _get_layout()
+        self._layout = None
+        if use_mmap:
+            self._open_mmap()
+        # members before this offset were read from the archive, anything
+        # after it has been added since
+        self._loaded_end = self.start_dir
+
+    @property
+    def filelist(self):
+        if self._lazy is not None:
+            self._load_lazy()
+        return self._filelist
+
+    @filelist.setter
+    def filelist(self, filelist):
+        self._filelist = filelist
+
+    @property
+    def NameToInfo(self):
+        if self._lazy is not None:
+            self._load_lazy()
+        return self._NameToInfo
+
+    @NameToInfo.setter
+    def NameToInfo(self, NameToInfo):
+        self._NameToInfo = NameToInfo
+
+    def _load_lazy(self):
+        """Create the ZipInfo for every member of a lazily read archive"""
+        lazy = self._lazy
+        self._lazy = None
+        infos = lazy.infolist()
+        self._filelist.extend(infos)
+        for zinfo in infos:
+            self._NameToInfo[zinfo.filename] = zinfo
+
+    def _RealGetContents(self):
+        """Read in the table of contents for the ZIP file, or with lazy
+        just the raw central directory."""
+        if not self.lazy and not self._index_cache_path():
+            return super()._RealGetContents()
+        fp = self.fp
+        try:
+            endrec = zipfile._EndRecData(fp)
+        except OSError:
+            raise zipfile.BadZipFile("File is not a zip file")
+        if not endrec:
+            raise zipfile.BadZipFile("File is not a zip file")
+        size_cd = endrec[zipfile._ECD_SIZE]      # bytes in central directory
+        offset_cd = endrec[zipfile._ECD_OFFSET]  # offset of central directory
+        self._comment = endrec[zipfile._ECD_COMMENT]    # archive comment
+
+        concat = _concat(endrec)
+        # self.start_dir:  Position of start of central directory
+        self.start_dir = offset_cd + concat
+        if self.start_dir < 0:
+            raise zipfile.BadZipFile("Bad offset for central directory")
+        encoding = getattr(self, 'metadata_encoding', None) or 'cp437'
+        cache_path = self._index_cache_path()
+        if cache_path:
+            key = self._index_cache_key(endrec, encoding)
+            self._lazy = _LazyDirectory.load(cache_path, key, self.start_dir)
+        if self._lazy is None:
+            fp.seek(self.start_dir, 0)
+            data = fp.read(size_cd)
+            self._lazy = _LazyDirectory(data, concat, encoding, self.start_dir)
+            if cache_path:
+                self._save_index_cache(cache_path, key)
+        if not self.lazy:
+            self._load_lazy()
+
+    def _index_cache_path(self):
+        """Return the path of the index cache file for this archive, or None
+        if it isn't cached"""
+        if not self.index_cache or self._filePassed:
+            return None
+        if self.index_cache is True:
+            return self.filename + ".idx"
+        name = hashlib.sha1(os.fsencode(os.path.abspath(self.filename)))
+        return os.path.join(self.index_cache, name.hexdigest() + ".idx")
+
+    def _journal_path(self):
+        """Return the path of the commit journal for this archive, or None
+        if commits aren't journaled"""
+        if not self.journal or self._filePassed:
+            return None
+        return self.filename + ".journal"
+
+    @contextlib.contextmanager
+    def _journaled(self, regions):
+        """
+        Journal the changes made to the archive in place within the context.
+        The regions, (start, end) offsets with end None for the end of the
+        file, are saved to the journal before they're overwritten and the
+        changes are flushed to disk before it's removed. If the context
+        raises the archive is rolled back from the journal and reread.
+        """
+        path = self._journal_path()
+        if path is None:
+            yield
+            return
+        journal = _Journal(path)
+        with self._phase("journal") as stats:
+            saved = journal.save(self.fp, regions)
+            if stats is not None:
+                stats.bytes_read += saved
+                stats.bytes_written += saved
+        try:
+            yield
+            _fsync(self.fp)
+        except BaseException:
+            try:
+                self.fp.flush()
+            except OSError:
+                pass
+            journal.recover(self.filename)
+            # the archive's contents are as they were before the commit
+            self.fp.close()
+            self.fp = io.open(self.filename, "r+b")
+            self._reset()
+            raise
+        journal.remove()
+
+    def _move_data(self, moves):
+        """
+        Make the data moves of an in-place compaction, (src, dst, length,
+        header) tuples in offset order each writing header just before dst
+        then moving length bytes from src down to dst, and write the central
+        directory at start_dir.
+
+        A journaled commit plans the moves, with the new central directory,
+        in a redo journal first, and checkpoints its progress there as each
+        chunk is moved. A move only overwrites its own source, so if the
+        context raises, or after a crash, the moves are finished from the
+        last checkpoint rather than undone, and nothing needs saving from the
+        archive beyond the odd chunk of a move shorter than _REDO_MIN_CHUNK.
+        """
+        path = self._journal_path()
+        journal = None
+        if path is not None:
+            journal = _Journal(path)
+            with self._phase("journal") as stats:
+                saved = journal.save_moves(self.fp, moves, self.start_dir,
+                                           self._render_directory())
+                if stats is not None:
+                    stats.bytes_written += saved
+        try:
+            with self._phase("move") as stats:
+                for src, dst, length, header in moves:
+                    if stats is not None:
+                        stats.bytes_read += length
+                        stats.bytes_written += len(header) + length
+                if journal is not None:
+                    saved = journal.redo(self.fp, moves)
+                    if stats is not None:
+                        stats.bytes_written += saved
+                else:
+                    for src, dst, length, header in moves:
+                        if header:
+                            self.fp.seek(dst - len(header))
+                            self.fp.write(header)
+                        if length:
+                            _move_within(self.fp, src, dst, length)
+            self._write_directory()
+            if journal is not None:
+                _fsync(self.fp)
+        except BaseException:
+            if journal is None:
+                raise
+            try:
+                self.fp.flush()
+            except OSError:
+                pass
+            journal.recover(self.filename)
+            # the archive's contents are as the commit left them
+            self.fp.close()
+            self.fp = io.open(self.filename, "r+b")
+            self._reset()
+            raise
+        if journal is not None:
+            journal.remove()
+
+    def _render_directory(self):
+        """Return the central directory, and end records, _write_directory()
+        would write at start_dir"""
+        fp = self.fp
+        self.fp = _OffsetBuffer(self.start_dir)
+        try:
+            self._write_end_record()
+            return self.fp.getvalue()
+        finally:
+            self.fp = fp
+
+    def _index_cache_key(self, endrec, encoding):
+        """Identify this version of the archive: its path, size and
+        modification time, its end of central directory record and how the
+        index was built"""
+        st = os.stat(self.filename)
+        key = [os.path.abspath(self.filename), st.st_size, st.st_mtime_ns,
+               endrec[zipfile._ECD_SIGNATURE], endrec[zipfile._ECD_ENTRIES_TOTAL],
+               endrec[zipfile._ECD_SIZE], endrec[zipfile._ECD_OFFSET],
+               endrec[zipfile._ECD_LOCATION], sys.byteorder, encoding]
+        return b'\0'.join(os.fsencode(str(k)) for k in key)
+
+    def _save_index_cache(self, cache_path, key):
+        try:
+            self._lazy.save(cache_path, key)
+        except OSError:
+            pass
+
+    def _refresh_index_cache(self):
+        """Update the index cache after the archive has been rewritten"""
+        cache_path = self._index_cache_path()
+        if not cache_path:
+            return
+        with self._lock:
+            self.fp.flush()
+            endrec = zipfile._EndRecData(self.fp)
+            self.fp.seek(self.start_dir)
+            data = self.fp.read(endrec[zipfile._ECD_SIZE])
+        encoding = getattr(self, 'metadata_encoding', None) or 'cp437'
+        key = self._index_cache_key(endrec, encoding)
+        try:
+            _LazyDirectory(data, _concat(endrec), encoding,
+                           self.start_dir).save(cache_path, key)
+        except OSError:
+            # the cache is only an optimisation
+            pass
+
+    def getinfo(self, name):
+        """Return the instance of ZipInfo given 'name'."""
+        if self._lazy is None:
+            return super().getinfo(name)
+        zinfo = self._lazy.getinfo(name)
+        if zinfo is None:
+            raise KeyError(
+                'There is no item named %r in the archive' % name)
+        return zinfo
+
+    def _has_member(self, name):
+        if self._lazy is not None:
+            return self._lazy.getinfo(name) is not None
+        return name in self.NameToInfo
 
     def _hidden_files(self):
         """Find any files that are hidden between memebers of this archive"""
-        # Establish the file boundaries, start - end, for each file
-        # initial file boundaries are the start and end of the zip up to the
-        # central directory
-        file_boundaries = [{"start": 0, "end": 0},
-                           {"start": self.start_dir, "end": self.start_dir}]
-        # Include removed files - we don't want to count them as hidden
-        for fileinfo in self.filelist + self.removed_filelist:
-
-            # establish the end_offset
-            end_offset = fileinfo.header_offset
-            end_offset += zipfile.sizeFileHeader
-            end_offset += len(fileinfo.orig_filename)
-            end_offset += len(fileinfo.extra)
-            end_offset += fileinfo.compress_size
-            is_encrypted = fileinfo.flag_bits & 0x1
-            if is_encrypted:
-                end_offset += 12
-
-            # add to the file boundaries
-            file_boundaries.append({"start": fileinfo.header_offset,
-                                    "end": end_offset})
-
-        # Look for data inbetween the file boundaries
-        file_boundaries.sort(key=operator.itemgetter("start"))
-        current = file_boundaries.pop(0)
-        hidden_files = []
-        for next in file_boundaries:
-            if current["end"] > next["start"]:
-                # next is contained within current |--c.s---n.s--n.e---c.e--|
-                continue
-            elif current["end"] != next["start"]:
-                # There is some data inbetween
-                file = zipfile._SharedFile(self.fp, current["end"], self._fpclose, self._lock)
-                file.length = next["start"] - current["end"]
-                hidden_files.append(file)
-            current = next
+        return [_RangeFile(self, start, end - start)
+                for start, end in self._get_layout().gaps(self.start_dir)]
+
+    def dead_space(self):
+        """Return the number of bytes of the archive's data that don't belong
+        to any member: space left by members removed (or renamed) with
+        COMMIT_APPEND, members pending removal and any other hidden files.
+        All of it is reclaimed by compacting the archive."""
+        with self._lock:
+            layout = self._get_layout()
+            gaps = layout.gaps(self.start_dir, ignore=self.removed_filelist)
+            return sum(end - start for start, end in gaps)
 
-        return hidden_files
+    def _get_layout(self):
+        """Return the layout index of this archive, indexing any members
+        added or removed since it was last used"""
+        with self._lock:
+            if self._layout is None:
+                self._layout = _Layout(self)
+            self._layout.update()
+            return self._layout
+
+    def _local_header(self, zinfo):
+        """Read the raw local file header, including the filename and extra
+        field, of the member zinfo"""
+        fheader = self._read_at(zinfo.header_offset, zipfile.sizeFileHeader)
+        if len(fheader) != zipfile.sizeFileHeader:
+            raise zipfile.BadZipFile("Truncated file header")
+        fheader_t = struct.unpack(zipfile.structFileHeader, fheader)
+        if fheader_t[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile("Bad magic number for file header")
+        length = (fheader_t[zipfile._FH_FILENAME_LENGTH] +
+                  fheader_t[zipfile._FH_EXTRA_FIELD_LENGTH])
+        return fheader + self._read_at(zinfo.header_offset +
+                                       zipfile.sizeFileHeader, length)
+
+    def _read_at(self, pos, n):
+        """Read n bytes from pos in the archive's file"""
+        if self._mmap is not None:
+            return self._mmap[pos:pos + n]
+        self.fp.seek(pos)
+        return self.fp.read(n)
+
+    def _member_extent(self, zinfo, header=None):
+        """Return the number of bytes occupied in the archive by the member
+        zinfo: local header, compressed data and any data descriptor"""
+        if header is None:
+            header = self._local_header(zinfo)
+        length = len(header) + zinfo.compress_size
+        if zinfo.flag_bits & 0x08:
+            zip64 = (zinfo.file_size > ZIP64_LIMIT or
+                     zinfo.compress_size > ZIP64_LIMIT)
+            length += 20 if zip64 else 12
+            # The data descriptor signature is optional
+            if self._read_at(zinfo.header_offset + length -
+                             (20 if zip64 else 12), 4) == stringDataDescriptor:
+                length += 4
+        return length
+
+    def open(self, name, mode="r", pwd=None, **kwargs):
+        """Return file-like object for 'name', see ZipFile.open().
+        With directory_only_renames the member may have been renamed in the
+        central directory only, and with shared_payloads its local header may
+        be another member's, so the name in its local header is accepted as
+        well."""
+        if mode == "r" and (self.directory_only_renames or
+                            self.shared_payloads):
+            if isinstance(name, zipfile.ZipInfo):
+                zinfo = name
+            else:
+                zinfo = self.getinfo(name)
+            if self.shared_payloads:
+                # the member itself isn't renamed
+                zinfo = copy.copy(zinfo)
+                if hasattr(zinfo, '_end_offset'):
+                    # Python 3.12+ rejects members sharing their data
+                    zinfo._end_offset = None
+                name = zinfo
+            with self._lock:
+                zinfo.orig_filename = self._local_filename(
+                    self._local_header(zinfo))
+        if mode == "r" and self._mmap is not None:
+            return self._open_mmap_member(name, pwd)
+        return super().open(name, mode, pwd, **kwargs)
+
+    def _open_mmap(self):
+        """Map the archive's file into memory if it is a real file"""
+        import mmap
+        try:
+            fd = self.fp.fileno()
+        except (AttributeError, OSError, ValueError):
+            # not a real file, keep reading through the file pointer
+            return
+        if os.fstat(fd).st_size == 0:
+            return
+        self._mmap = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        self._mmap_view = memoryview(self._mmap)
+
+    def _close_mmap(self):
+        if self._mmap is None:
+            return
+        self._mmap_view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # views handed out are still alive, the map is closed once
+            # they have all been released
+            pass
+        self._mmap = None
+        self._mmap_view = None
+
+    def _open_mmap_member(self, name, pwd=None):
+        """Open the member name for reading straight from the memory map"""
+        if isinstance(name, zipfile.ZipInfo):
+            zinfo = name
+        else:
+            zinfo = self.getinfo(name)
+        header = self._local_header(zinfo)
+        fname = self._local_filename(header)
+        if fname != zinfo.orig_filename and not self.directory_only_renames:
+            raise zipfile.BadZipFile(
+                'File name in directory %r and header %r differ.'
+                % (zinfo.orig_filename, fname))
+        return self._open_member_data(
+            zinfo, _RangeFile(self, zinfo.header_offset + len(header),
+                              zinfo.compress_size), pwd)
+
+    def _open_member_data(self, zinfo, data, pwd=None):
+        """Return a ZipExtFile decompressing the member zinfo from data, a
+        _RangeFile over its compressed bytes, making the checks
+        ZipFile.open() makes once past the local header"""
+        if zinfo.flag_bits & 0x20:
+            # Zip 2.7: compressed patched data
+            raise NotImplementedError("compressed patched data (flag bit 5)")
+        if zinfo.flag_bits & 0x40:
+            # strong encryption
+            raise NotImplementedError("strong encryption (flag bit 6)")
+        end_offset = getattr(zinfo, '_end_offset', None)
+        if (end_offset is not None and not self.shared_payloads and
+                data.start + zinfo.compress_size > end_offset):
+            raise zipfile.BadZipFile(
+                "Overlapped entries: %r (possible zip bomb)"
+                % zinfo.orig_filename)
+        pwd = pwd or self.pwd
+        if zinfo.flag_bits & 0x1:
+            if not pwd:
+                raise RuntimeError("File %r is encrypted, password "
+                                   "required for extraction" % zinfo.filename)
+        else:
+            pwd = None
+        return zipfile.ZipExtFile(data, "r", zinfo, pwd, True)
+
+    def compressed_view(self, name):
+        """Return a memoryview of the compressed bytes of the member name, a
+        slice of the memory map when use_mmap is set"""
+        if isinstance(name, zipfile.ZipInfo):
+            zinfo = name
+        else:
+            zinfo = self.getinfo(name)
+        if self._mmap is None:
+            return memoryview(self.open_compressed(zinfo).read())
+        start = zinfo.header_offset + self._header_length(zinfo)
+        return self._mmap_view[start:start + zinfo.compress_size]
+
+    def view(self, name):
+        """Return a memoryview of the contents of the member name. When
+        use_mmap is set unencrypted ZIP_STORED members are returned as a
+        slice of the memory map without copying or checking their CRC."""
+        if isinstance(name, zipfile.ZipInfo):
+            zinfo = name
+        else:
+            zinfo = self.getinfo(name)
+        if (self._mmap is not None and zinfo.compress_type == ZIP_STORED and
+                not zinfo.flag_bits & 0x1):
+            return self.compressed_view(zinfo)
+        return memoryview(self.read(zinfo))
+
+    def hidden_views(self):
+        """Return a memoryview of each hidden file, see _hidden_files()"""
+        if self._mmap is None:
+            return [memoryview(f.read()) for f in self._hidden_files()]
+        return [self._mmap_view[start:end]
+                for start, end in self._get_layout().gaps(self.start_dir)]
+
+    def _local_filename(self, header):
+        """Decode the filename held in the raw local file header"""
+        fheader = struct.unpack(zipfile.structFileHeader,
+                                header[:zipfile.sizeFileHeader])
+        fname = header[zipfile.sizeFileHeader:zipfile.sizeFileHeader +
+                       fheader[zipfile._FH_FILENAME_LENGTH]]
+        if fheader[zipfile._FH_GENERAL_PURPOSE_FLAG_BITS] & 0x800:
+            return fname.decode('utf-8')
+        return fname.decode(getattr(self, 'metadata_encoding', None) or 'cp437')
+
+    def extract_many(self, members=None, path=None, pwd=None, workers=None):
+        """
+        Extract members to path concurrently, each worker thread reading,
+        decompressing and writing out a member independently. Where the
+        archive is a real file members are read with os.pread() so workers
+        don't contend for the archive's file pointer.
+
+        Args:
+          members (list(str), list(ZipInfo), optional): the members to
+            extract, defaults to all of them.
+          path (str, optional): the directory to extract to, defaults to the
+            current working directory.
+          pwd (bytes, optional): the password for encrypted members.
+          workers (int, optional): the number of worker threads, defaults to
+            ThreadPoolExecutor's default.
+
+        Returns:
+          The list of paths extracted to, in the order of members.
+        """
+        if members is None:
+            members = self.filelist
+        if path is None:
+            path = os.getcwd()
+        else:
+            path = os.fspath(path)
+        infos = [m if isinstance(m, zipfile.ZipInfo) else self.getinfo(m)
+                 for m in members]
+        layout = self._get_layout()
+        try:
+            with self._lock:
+                self.fp.flush()
+                fd = self.fp.fileno()
+        except (AttributeError, OSError, ValueError):
+            fd = None
+
+        def extract(zinfo):
+            return self._extract_member_from(zinfo, path, pwd, layout, fd)
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            return list(executor.map(extract, infos))
+
+    def _extract_member_from(self, member, targetpath, pwd, layout, fd):
+        """Extract the member to targetpath, like ZipFile._extract_member(),
+        reading it directly rather than through open()."""
+        # build the destination pathname, replacing
+        # forward slashes to platform specific separators.
+        arcname = member.filename.replace('/', os.path.sep)
+
+        if os.path.altsep:
+            arcname = arcname.replace(os.path.altsep, os.path.sep)
+        # interpret absolute pathname as relative, remove drive letter or
+        # UNC path, redundant separators, "." and ".." components.
+        arcname = os.path.splitdrive(arcname)[1]
+        invalid_path_parts = ('', os.path.curdir, os.path.pardir)
+        arcname = os.path.sep.join(x for x in arcname.split(os.path.sep)
+                                   if x not in invalid_path_parts)
+        if os.path.sep == '\\':
+            # filter illegal characters on Windows
+            arcname = self._sanitize_windows_name(arcname, os.path.sep)
+
+        targetpath = os.path.join(targetpath, arcname)
+        targetpath = os.path.normpath(targetpath)
+
+        # Create all upper directories if necessary.
+        upperdirs = os.path.dirname(targetpath)
+        if upperdirs:
+            os.makedirs(upperdirs, exist_ok=True)
+
+        if member.is_dir():
+            os.makedirs(targetpath, exist_ok=True)
+            return targetpath
+
+        data = _RangeFile(self, member.header_offset +
+                          layout.header_length(member),
+                          member.compress_size, fd=fd)
+        with self._open_member_data(member, data, pwd) as source, \
+             open(targetpath, "wb") as target:
+            shutil.copyfileobj(source, target, COPY_BUFSIZE)
+
+        return targetpath
+
+    def _touched_members(self):
+        """Return the members that have been renamed or added since the
+        archive was read"""
+        return [zinfo for zinfo in self.filelist
+                if zinfo.filename != zinfo.orig_filename or
+                zinfo.header_offset >= self._loaded_end]
+
+    def verify(self, level=VERIFY_FULL, members=None, workers=None):
+        """
+        Check the integrity of the archive.
+
+        Args:
+          level (str): VERIFY_NONE, VERIFY_STRUCTURE (every local header is
+            present, agrees with the central directory and its data ends
+            before the central directory), VERIFY_TOUCHED (structure plus
+            the CRC of the given members) or VERIFY_FULL (structure plus the
+            CRC of every member, like testzip()).
+          members (list(str), optional): names of the members to CRC check
+            with VERIFY_TOUCHED.
+          workers (int, optional): the number of threads checking CRCs, see
+            verify_report().
+
+        Returns:
+          The name of the first bad member, or None if all are ok.
+        """
+        return self.verify_report(level, members, workers).first_bad
+
+    def verify_report(self, level=VERIFY_FULL, members=None, workers=None):
+        """
+        Check the integrity of the archive, as verify(), reporting the result
+        for every member checked rather than stopping at the first bad one.
+
+        The CRC of STORED members is computed straight from the archive's
+        memory map, or with os.pread(), in large blocks. Compressed (and
+        encrypted) members are decompressed in a pool of worker threads;
+        zlib, bz2 and lzma release the GIL so these run in parallel. Archives
+        that aren't real files, e.g. BytesIO, are checked one member at a
+        time. Members with a bad local header are not CRC checked.
+
+        Args:
+          level (str): as verify().
+          members (list(str), optional): as verify().
+          workers (int, optional): the number of threads checking CRCs,
+            defaults to ThreadPoolExecutor's default.
+
+        Returns:
+          A VerifyReport.
+        """
+        if level not in (VERIFY_NONE, VERIFY_STRUCTURE, VERIFY_TOUCHED,
+                         VERIFY_FULL):
+            raise ValueError("Unknown verify level: {}".format(level))
+        report = VerifyReport(level)
+        if level == VERIFY_NONE:
+            return report
+
+        with self._lock:
+            # where the data of each member with a good local header starts
+            starts = {}
+            for zinfo in self.filelist:
+                start, error = self._check_structure(zinfo)
+                report.checks.append(MemberCheck(zinfo.filename, error is None,
+                                                 "structure", error))
+                if error is None:
+                    starts[zinfo] = start
+            if level == VERIFY_STRUCTURE:
+                return report
+            if level == VERIFY_FULL:
+                members = self.namelist()
+            infos = []
+            for name in members or []:
+                if not self._has_member(name):
+                    report.checks.append(
+                        MemberCheck(name, False, "crc", "no such member"))
+                elif self.getinfo(name) in starts:
+                    infos.append(self.getinfo(name))
+            try:
+                self.fp.flush()
+                fd = self.fp.fileno()
+            except (AttributeError, OSError, ValueError):
+                fd = None
+
+        if self._stats is not None:
+            self._stats.bytes_read += sum(zinfo.compress_size for zinfo in infos)
+
+        def check(zinfo):
+            try:
+                error = self._check_crc(zinfo, starts[zinfo], fd)
+            except Exception as e:
+                # corrupt data can upset the decompressors in any number of ways
+                error = "{}: {}".format(type(e).__name__, e)
+            return MemberCheck(zinfo.filename, error is None, "crc", error)
+
+        # STORED members are cheap to check, leave the pool to the others
+        stored = []
+        compressed = []
+        for zinfo in infos:
+            if zinfo.compress_type == ZIP_STORED and not zinfo.flag_bits & 0x1:
+                stored.append(zinfo)
+            else:
+                compressed.append(zinfo)
+        if fd is None and self._mmap is None:
+            # workers would have to take the archive's lock to read, which
+            # the caller (e.g. a commit) may be holding, so check them here
+            checks = {zinfo.filename: check(zinfo) for zinfo in infos}
+        else:
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                results = executor.map(check, compressed)
+                checks = {zinfo.filename: check(zinfo) for zinfo in stored}
+                checks.update((result.name, result) for result in results)
+        report.checks.extend(checks[zinfo.filename] for zinfo in infos)
+        return report
+
+    def _check_crc(self, zinfo, start, fd):
+        """Return why the data of the member zinfo, starting at offset start,
+        is bad, or None if it matches its CRC"""
+        if zinfo.compress_type != ZIP_STORED or zinfo.flag_bits & 0x1:
+            data = _RangeFile(self, start, zinfo.compress_size, fd=fd)
+            with self._open_member_data(zinfo, data) as f:
+                # ZipExtFile checks the CRC when it reaches the end
+                length = 0
+                while True:
+                    n = len(f.read(COPY_BUFSIZE))
+                    if not n:
+                        break
+                    length += n
+        else:
+            if zinfo.compress_size != zinfo.file_size:
+                return "compressed size doesn't match file size"
+            crc = 0
+            length = 0
+            for block in self._stored_blocks(start, zinfo.compress_size, fd):
+                crc = _crc32(block, crc)
+                length += len(block)
+            if length != zinfo.file_size:
+                return "truncated data"
+            if crc != zinfo.CRC:
+                return "bad CRC-32"
+        if length != zinfo.file_size:
+            return "file size doesn't match data"
+        return None
+
+    def _stored_blocks(self, start, length, fd):
+        """Yield the length bytes at offset start of the archive's file in
+        large blocks, without copying them where they can be mapped"""
+        if self._mmap is not None:
+            yield self._mmap_view[start:start + length]
+            return
+        end = start + length
+        while start < end:
+            if fd is not None:
+                block = os.pread(fd, min(COPY_BUFSIZE, end - start), start)
+            else:
+                block = self._read_at(start, min(COPY_BUFSIZE, end - start))
+            if not block:
+                return
+            yield block
+            start += len(block)
+
+    def _check_structure(self, zinfo):
+        """Check the local header of the member zinfo against the central
+        directory.
+
+        Returns:
+          (start, error): the offset of the member's data and why the header
+          doesn't match, or None if it does.
+        """
+        try:
+            header = self._local_header(zinfo)
+            end = zinfo.header_offset + self._member_extent(zinfo, header)
+            fname = self._local_filename(header)
+        except (zipfile.BadZipFile, struct.error, UnicodeDecodeError) as e:
+            return None, "bad local header: {}".format(e)
+        start = zinfo.header_offset + len(header)
+        fheader = struct.unpack(zipfile.structFileHeader,
+                                header[:zipfile.sizeFileHeader])
+        if (fname != zinfo.orig_filename and not self.directory_only_renames
+                and not self.shared_payloads):
+            return start, "local header name {!r} doesn't match".format(fname)
+        if fheader[zipfile._FH_COMPRESSION_METHOD] != zinfo.compress_type:
+            return start, "local header compression method doesn't match"
+        if end > self.start_dir:
+            return start, "data overlaps the central directory"
+        return start, None
 
     def _renamecheck(self, filename):
         """Check for errors before writing a file to the archive."""
-        if filename in self.NameToInfo:
+        if self._has_member(filename):
             import warnings
-            warnings.warn('Duplicate name: %r' % zinfo.filename, stacklevel=3)
+            warnings.warn('Duplicate name: %r' % filename, stacklevel=3)
         if self.mode not in ('w', 'x', 'a'):
             raise RuntimeError("rename() requires mode 'w', 'x', or 'a'")
         if not self.fp:
@@ -122,12 +963,32 @@ class ZipFileExtended(ZipFile):
         else:
             zinfo = self.getinfo(zinfo_or_arcname)
 
-        self.filelist.remove(zinfo)
+        if self._lazy is not None:
+            self._lazy.remove(zinfo)
+        else:
+            self.filelist.remove(zinfo)
+            del self.NameToInfo[zinfo.filename]
         self.removed_filelist.append(zinfo)
-        del self.NameToInfo[zinfo.filename]
         self._didModify = True
         self.requires_commit = True
 
+    def batch(self, commit_mode=None, verify=VERIFY_STRUCTURE):
+        """
+        Return a ZipBatch to gather many removes, renames and writes which
+        are applied together, followed by a single commit, when its context
+        exits without an exception.
+
+            with zip.batch() as batch:
+                batch.remove("old")
+                batch.rename("a", "b")
+                batch.writestr("new", data)
+
+        Args:
+          commit_mode (str, optional): passed on to commit().
+          verify (str, optional): passed on to commit().
+        """
+        return ZipBatch(self, commit_mode=commit_mode, verify=verify)
+
     def rename(self, zinfo_or_arcname, filename):
         """
         Rename a member in the archive.
@@ -147,16 +1008,7 @@ class ZipFileExtended(ZipFile):
 
         self._renamecheck(filename)
 
-        # Terminate the file name at the first null byte.  Null bytes in file
-        # names are used as tricks by viruses in archives.
-        null_byte = filename.find(chr(0))
-        if null_byte >= 0:
-            filename = filename[0:null_byte]
-        # This is used to ensure paths in generated ZIP files always use
-        # forward slashes as the directory separator, as required by the
-        # ZIP format specification.
-        if os.sep != "/" and os.sep in filename:
-            filename = filename.replace(os.sep, "/")
+        filename = _clean_filename(filename)
 
         if isinstance(zinfo_or_arcname, zipfile.ZipInfo):
             zinfo = zinfo_or_arcname
@@ -165,8 +1017,12 @@ class ZipFileExtended(ZipFile):
         else:
             zinfo = self.getinfo(zinfo_or_arcname)
 
-        zinfo.filename = filename
-        self.NameToInfo[zinfo.filename] = zinfo
+        if self._lazy is not None:
+            self._lazy.rename(zinfo, filename)
+        else:
+            del self.NameToInfo[zinfo.filename]
+            zinfo.filename = filename
+            self.NameToInfo[zinfo.filename] = zinfo
 
         self._didModify = True
         self.requires_commit = True
@@ -195,12 +1051,15 @@ class ZipFileExtended(ZipFile):
                             pass
                         self._write_end_record()
         finally:
+            self._close_mmap()
             fp = self.fp
             self.fp = None
             self._fpclose(fp)
 
 
-    def clone(self, file, filenames_or_infolist=None, ignore_hidden_files=False):
+    def clone(self, file, filenames_or_infolist=None, ignore_hidden_files=False,
+              bufsize=COPY_BUFSIZE, verify=None, compress_type=None,
+              compresslevel=None, workers=None, dedup=None):
         """ Clone the a zip file using the given file (filename or filepointer).
 
         Args:
@@ -210,6 +1069,27 @@ class ZipFileExtended(ZipFile):
             members from this zip file to include in the new zip file.
           ignore_hidden_files (boolean): flag to indicate wether hidden files
             (data inbetween managed memebers of the archive) should be included.
+          bufsize (int, optional): the maximum number of bytes held in memory
+            at once while copying members and hidden files.
+          verify (str, optional): the integrity check made on the clone, one
+            of VERIFY_NONE, VERIFY_STRUCTURE, VERIFY_TOUCHED or VERIFY_FULL.
+            Defaults to VERIFY_STRUCTURE, which is enough to catch a bad copy
+            when members are copied verbatim, or VERIFY_TOUCHED when members
+            are recompressed.
+          compress_type (int, optional): recompress members stored with a
+            different compression method using this one, e.g. ZIP_DEFLATED.
+          compresslevel (int, optional): the level to recompress at, given
+            a compress_type every member is recompressed at this level.
+          workers (int, optional): the number of processes to recompress
+            members in, by default they are recompressed in this process.
+            Recompressed members are held in memory whole.
+          dedup (str, optional): DEDUP_REPORT to find the members with
+            identical contents, see duplicates(), recording them in the
+            CommitStats of the commit in progress, or DEDUP_SHARE to also
+            write each set's contents once, the rest of the set pointing at
+            the first one's local header from the central directory. Other
+            zip readers reject these members, so the clone is opened with
+            shared_payloads set.
 
         Returns:
             A new ZipFile object of the cloned zipfile open in append mode.
@@ -220,49 +1100,236 @@ class ZipFileExtended(ZipFile):
         Raises:
             BadZipFile exception.
         """
-        # if we are filtering or need to commit changes then create via ZipFile
+        if dedup not in (None, DEDUP_REPORT, DEDUP_SHARE):
+            raise ValueError("Unknown dedup mode: {}".format(dedup))
+        touched = [zinfo.filename for zinfo in self._touched_members()]
+        sets = []
+        # if we are filtering, recompressing, sharing payloads or need to
+        # commit changes then create via ZipFile
         if(filenames_or_infolist or self.requires_commit or
-           ignore_hidden_files):
-
-            files = self._gather_and_filter_files(
-                filenames_or_infolist=filenames_or_infolist,
-                ignore_hidden_files=ignore_hidden_files,
-                sort=True)
-
-            with ZipFileExtended(file, mode="w") as clone:
-
-                for f in files:
-                    if isinstance(f, zipfile.ZipInfo):
-                        bytes = self.read_compressed(f.filename)
-                        clone.write_compressed(f, bytes)
+           ignore_hidden_files or compress_type is not None or
+           dedup == DEDUP_SHARE):
+
+            with self._phase("gather"):
+                files = self._gather_and_filter_files(
+                    filenames_or_infolist=filenames_or_infolist,
+                    ignore_hidden_files=ignore_hidden_files,
+                    sort=True)
+            # pending changes to members left out of the clone aren't checked
+            written = {f.filename for f in files
+                       if isinstance(f, zipfile.ZipInfo)}
+            touched = [name for name in touched if name in written]
+
+            recompress = [f for f in files if isinstance(f, zipfile.ZipInfo) and
+                          _needs_recompress(f, compress_type, compresslevel)]
+            touched.extend(zinfo.filename for zinfo in recompress)
+            if recompress and dedup == DEDUP_SHARE:
+                raise ValueError("Can't share payloads of recompressed members")
+
+            if dedup is not None:
+                with self._phase("dedup"):
+                    sets = self.duplicates(
+                        [f for f in files if isinstance(f, zipfile.ZipInfo)],
+                        bufsize)
+
+            with self._phase("copy") as stats:
+                with ZipFileExtended(file, mode="w") as clone:
+                    if recompress:
+                        self._recompress_into(clone, files, set(recompress),
+                                              compress_type, compresslevel,
+                                              workers, bufsize)
+                    elif dedup == DEDUP_SHARE and sets:
+                        self._dedup_into(clone, files, sets, bufsize)
                     else:
-                        bytes = f.read(f.length)
-                        clone._write_hidden(bytes)
+                        for f in files:
+                            self._copy_into(clone, f, bufsize)
+                    if stats is not None:
+                        stats.bytes_read += sum(
+                            f.compress_size if isinstance(f, zipfile.ZipInfo)
+                            else f.length for f in files)
+                        stats.bytes_written += clone.start_dir
+
+            if verify is None and recompress:
+                verify = VERIFY_TOUCHED
 
         else:
+            if dedup is not None:
+                with self._phase("dedup"):
+                    sets = self.duplicates(bufsize=bufsize)
             # We are copying with no modifications - just copy bytes
-            self._quick_clone(file)
+            with self._phase("copy"):
+                self._quick_clone(file, bufsize=bufsize)
 
+        if self._stats is not None and dedup is not None:
+            self._stats.duplicates = [[zinfo.filename for zinfo in members]
+                                      for members in sets]
+        shared = dedup == DEDUP_SHARE and bool(sets)
         clone = ZipFileExtended(file, mode="a", compression=self.compression,
-                                allowZip64=self._allowZip64)
-        badfile = clone.testzip()
+                                allowZip64=self._allowZip64,
+                                directory_only_renames=self.directory_only_renames,
+                                shared_payloads=self.shared_payloads or shared)
+        with self._phase("verify"):
+            # count the bytes verification reads as part of this commit
+            clone._stats = self._stats
+            try:
+                badfile = clone.verify(verify or VERIFY_STRUCTURE, touched)
+            finally:
+                clone._stats = None
         if(badfile):
             raise zipfile.BadZipFile("Error when cloning zipfile, failed zipfile check: {} file is corrupt".format(badfile))
         return clone
 
-    def _quick_clone(self, file):
+    def _copy_into(self, clone, f, bufsize=COPY_BUFSIZE):
+        """Copy the member or hidden file f verbatim into clone"""
+        if isinstance(f, zipfile.ZipInfo):
+            # copy the compressed bytes straight across, the
+            # ZipInfo is copied as writing it updates its offset
+            clone.write_compressed(copy.copy(f), self.open_compressed(f),
+                                   bufsize=bufsize)
+        else:
+            clone._write_hidden(f, bufsize=bufsize)
+
+    def _dedup_into(self, clone, files, sets, bufsize=COPY_BUFSIZE):
+        """Write files into clone in order, copying the contents of each
+        duplicate set in sets once"""
+        # each duplicate -> the first member of its set, and what that was
+        # written as
+        firsts = {zinfo: members[0] for members in sets for zinfo in members[1:]}
+        written = {}
+        for f in files:
+            first = firsts.get(f)
+            if first is not None and first in written:
+                clone._write_shared(copy.copy(f), written[first])
+                continue
+            self._copy_into(clone, f, bufsize)
+            if isinstance(f, zipfile.ZipInfo):
+                written[f] = clone.filelist[-1]
+
+    def _write_shared(self, zinfo, first):
+        """Add zinfo to the central directory, sharing the local header and
+        contents of first, a member already written to this archive"""
+        with self._lock:
+            zinfo.header_offset = first.header_offset
+            zinfo.flag_bits = first.flag_bits
+            # its own name is written to the central directory
+            zinfo.orig_filename = zinfo.filename
+            if hasattr(zinfo, '_end_offset'):
+                zinfo._end_offset = None
+            self._didModify = True
+            self.filelist.append(zinfo)
+            self.NameToInfo[zinfo.filename] = zinfo
+
+    def duplicates(self, members=None, bufsize=COPY_BUFSIZE):
+        """
+        Find the members with identical contents. Members are grouped by
+        CRC, sizes and compression, then those that could be duplicates are
+        told apart by a SHA-256 hash of their compressed bytes.
+
+        Args:
+          members (list(str), list(ZipInfo), optional): the members to look
+            at, defaults to all of them.
+          bufsize (int, optional): the maximum number of bytes held in memory
+            at once while hashing a member.
+
+        Returns:
+          A list of duplicate sets, each a list of two or more ZipInfo
+          objects in offset order, ordered by their first member.
+        """
+        if members is None:
+            infos = self.filelist
+        else:
+            infos = [m if isinstance(m, zipfile.ZipInfo) else self.getinfo(m)
+                     for m in members]
+        candidates = collections.defaultdict(list)
+        for zinfo in infos:
+            if zinfo.is_dir():
+                continue
+            candidates[(zinfo.CRC, zinfo.file_size, zinfo.compress_size,
+                        zinfo.compress_type, zinfo.flag_bits & 0x1)].append(zinfo)
+        groups = collections.defaultdict(list)
+        # members already sharing a payload needn't be hashed twice
+        digests = {}
+        for key, group in candidates.items():
+            if len(group) < 2:
+                continue
+            for zinfo in group:
+                digest = digests.get(zinfo.header_offset)
+                if digest is None:
+                    digest = hashlib.sha256()
+                    with self.open_compressed(zinfo) as data:
+                        for chunk in iter(lambda: data.read(bufsize), b""):
+                            digest.update(chunk)
+                    digest = digests[zinfo.header_offset] = digest.digest()
+                groups[key + (digest,)].append(zinfo)
+        sets = [sorted(group, key=operator.attrgetter('header_offset'))
+                for group in groups.values() if len(group) > 1]
+        sets.sort(key=lambda members: members[0].header_offset)
+        return sets
+
+    def _recompress_into(self, clone, files, recompress, compress_type,
+                         compresslevel, workers, bufsize=COPY_BUFSIZE):
+        """Write files into clone in order, recompressing the members in
+        recompress with compress_type, optionally across a pool of worker
+        processes"""
+        if workers and workers > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(workers)
+        else:
+            executor = None
+        # members waiting to be written, in order, with their pending result
+        pending = collections.deque()
+        window = 2 * workers if executor else 1
+        try:
+            for f in files:
+                if f in recompress:
+                    args = (self.read_compressed(f), f.compress_type,
+                            compress_type, compresslevel)
+                    if executor:
+                        result = executor.submit(_recompress, *args)
+                    else:
+                        result = _recompress(*args)
+                else:
+                    result = None
+                pending.append((f, result))
+                while len(pending) > window:
+                    self._write_recompressed(clone, *pending.popleft(),
+                                             compress_type=compress_type,
+                                             bufsize=bufsize)
+            while pending:
+                self._write_recompressed(clone, *pending.popleft(),
+                                         compress_type=compress_type,
+                                         bufsize=bufsize)
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
+
+    def _write_recompressed(self, clone, f, result, compress_type,
+                            bufsize=COPY_BUFSIZE):
+        if result is None:
+            self._copy_into(clone, f, bufsize)
+            return
+        if isinstance(result, concurrent.futures.Future):
+            result = result.result()
+        zinfo = copy.copy(f)
+        # bit 1 and 2 are specific to the compression method
+        zinfo.flag_bits &= ~0x06
+        clone.write_compressed(zinfo, result, compress_type=compress_type)
+
+    def _quick_clone(self, file, bufsize=COPY_BUFSIZE):
         """
         Perform a quicker file copy based clone of this zipfile into the
         given file
         """
         with self._lock:
-            self.fp.seek(0)
+            size = self.fp.seek(0, os.SEEK_END)
+            if self._stats is not None:
+                self._stats.bytes_read += size
+                self._stats.bytes_written += size
             if isinstance(file, str):
                 with open(file, 'wb+') as fp:
-                    shutil.copyfileobj(self.fp, fp)
+                    _copy_range(self.fp, 0, fp, size, bufsize)
             else:
                 fp = file
-                shutil.copyfileobj(self.fp, fp)
+                _copy_range(self.fp, 0, fp, size, bufsize)
                 fp.seek(0)
 
     def _gather_and_filter_files(self, filenames_or_infolist=None,
@@ -273,7 +1340,7 @@ class ZipFileExtended(ZipFile):
         filenames_or_infolist and ignore_hidden_files flag.
         Returns:
           A list containing fileinfo instances for managed files and
-          _SharedFile instances for hidden files.
+          _RangeFile instances for hidden files.
 
           If sort=True the list is ordered by each file's offset in the
           archive.
@@ -289,34 +1356,80 @@ class ZipFileExtended(ZipFile):
            isinstance(filenames_or_infolist[0], zipfile.ZipInfo)):
             infolist = filenames_or_infolist
         else:
+            filenames = set(filenames_or_infolist)
             infolist = [zipinfo for zipinfo in self.infolist()
-                        if zipinfo.filename in filenames_or_infolist]
+                        if zipinfo.filename in filenames]
         # if there are hidden files then include these in the file list and
         # maintain the relative order w.r.t. the managed files by sorting by
         # their start position in the file
         if hidden_files:
             files = infolist + hidden_files
         else:
-            files = infolist
+            files = list(infolist)
 
         if sort:
-            files.sort(key=lambda f: f._pos if hasattr(f, '_pos') else f.header_offset)
+            files.sort(key=lambda f: f.start if isinstance(f, _RangeFile) else f.header_offset)
 
         return files
 
     def read_compressed(self, name, pwd=None):
-        """Return file bytes uncompressed for name."""
-        with self.open(name, "r", pwd) as fp:
-            # Replace the read, _read1 methods for the ZipExtFile file pointer fp
-            # with those defined in this module to support reading the compressed
-            # version of the file
-            fp.read = types.MethodType(read, fp)
-            fp._read1 = types.MethodType(_read1, fp)
-            return fp.read(decompress=False)
-
-    def write_compressed(self, zinfo, data, compress_type=None):
+        """Return the compressed bytes of the member name. Encrypted members
+        are decrypted using pwd, or the archive's default password."""
+        if isinstance(name, zipfile.ZipInfo):
+            zinfo = name
+        else:
+            zinfo = self.getinfo(name)
+        with self.open_compressed(zinfo) as fp:
+            data = fp.read()
+        if zinfo.flag_bits & 0x1:
+            data = self._decrypt(zinfo, data, pwd or self.pwd)
+        return data
+
+    def open_compressed(self, name):
+        """Return a readable file-like object over the compressed bytes of
+        the member name exactly as they are stored in the archive, without
+        decompressing or decrypting them. Its length attribute gives the
+        number of compressed bytes."""
+        if isinstance(name, zipfile.ZipInfo):
+            zinfo = name
+        else:
+            zinfo = self.getinfo(name)
+        return _RangeFile(self, zinfo.header_offset + self._header_length(zinfo),
+                          zinfo.compress_size)
+
+    def _header_length(self, zinfo):
+        """Return the length of the local header of the member zinfo, from
+        the layout index if it has been built"""
+        with self._lock:
+            layout = self._layout
+            if layout is not None and zinfo in layout.positions:
+                return layout.header_length(zinfo)
+            return len(self._local_header(zinfo))
+
+    def _decrypt(self, zinfo, data, pwd):
+        """Decrypt the raw bytes of the encrypted member zinfo"""
+        if not pwd:
+            raise RuntimeError("File %r is encrypted, password "
+                               "required for extraction" % zinfo.filename)
+        decrypter = zipfile._ZipDecrypter(pwd)
+        header = decrypter(data[:12])
+        if zinfo.flag_bits & 0x8:
+            # compare against the file type from extended local headers
+            check_byte = (zinfo._raw_time >> 8) & 0xff
+        else:
+            # compare against the CRC otherwise
+            check_byte = (zinfo.CRC >> 24) & 0xff
+        if header[11] != check_byte:
+            raise RuntimeError("Bad password for file %r" % zinfo.filename)
+        return decrypter(data[12:])
+
+    def write_compressed(self, zinfo, data, compress_type=None,
+                         bufsize=COPY_BUFSIZE):
         """Write a file into the archive using the already compressed bytes.
-        The contents is 'data', which is the already compressed bytes.
+        The contents is 'data', which is the already compressed bytes or a
+        file-like object positioned at the start of them, in which case
+        zinfo.compress_size bytes are copied across in chunks of at most
+        bufsize bytes.
         'zinfo' is a ZipInfo instance proving the required metadata to
         sucessfully write this file.
         """
@@ -333,6 +1446,9 @@ class ZipFileExtended(ZipFile):
             zinfo.orig_filename = zinfo.filename
 
             zinfo.header_offset = self.fp.tell()    # update start of header
+            if hasattr(zinfo, '_end_offset'):
+                # where the member ended in the archive it was read from
+                zinfo._end_offset = None
             if compress_type is not None:
                 zinfo.compress_type = compress_type
             if zinfo.compress_type == ZIP_LZMA:
@@ -344,14 +1460,18 @@ class ZipFileExtended(ZipFile):
             self._writecheck(zinfo)
             self._didModify = True
 
-            zinfo.compress_size = len(data)    # Compressed size
+            if not hasattr(data, 'read'):
+                zinfo.compress_size = len(data)    # Compressed size
 
             zip64 = zinfo.file_size > ZIP64_LIMIT or \
                 zinfo.compress_size > ZIP64_LIMIT
             if zip64 and not self._allowZip64:
-                raise LargeZipFile("Filesize would require ZIP64 extensions")
+                raise zipfile.LargeZipFile("Filesize would require ZIP64 extensions")
             self.fp.write(zinfo.FileHeader(zip64))
-            self.fp.write(data)
+            if hasattr(data, 'read'):
+                _copy_stream(data, self.fp, zinfo.compress_size, bufsize)
+            else:
+                self.fp.write(data)
             if zinfo.flag_bits & 0x08:
                 # Write CRC and file sizes after the file data
                 fmt = '<LQQ' if zip64 else '<LLL'
@@ -362,13 +1482,305 @@ class ZipFileExtended(ZipFile):
             self.filelist.append(zinfo)
             self.NameToInfo[zinfo.filename] = zinfo
 
-    def _write_hidden(self, data):
+    def replace(self, zinfo_or_arcname, data, compress_type=None,
+                compresslevel=None, bufsize=COPY_BUFSIZE):
+        """
+        Replace the contents of a member, without a commit.
+
+        The new contents are compressed first. If they fit in the space the
+        member occupies they are written over it, with its local header
+        rewritten for the new CRC and sizes, otherwise the member is written
+        again after the last member and its old space becomes dead space
+        (see dead_space()). The member's central directory record, with the
+        new CRC and sizes, isn't patched: the central directory is rewritten
+        when the archive is closed (or committed), as after write(), so the
+        cost is proportional to the size of the member rather than the
+        archive.
+
+        Args:
+          zinfo_or_arcname (ZipInfo, str): ZipInfo object or filename of the
+            member.
+          data (bytes, str, file): the new contents, or a file-like object
+            to read them from.
+          compress_type (int, optional): the compression to use, defaults to
+            the member's current compression.
+          compresslevel (int, optional): the level to compress at.
+          bufsize (int, optional): the maximum number of bytes read from data
+            at once, larger compressed contents are buffered on disk.
+
+        Raises:
+          RuntimeError: If attempting to modify an Zip archive that is closed.
+        """
+        if not self.fp:
+            raise RuntimeError(
+                "Attempt to write to ZIP archive that was already closed")
+
+        self._removecheck()
+
+        if isinstance(zinfo_or_arcname, zipfile.ZipInfo):
+            zinfo = zinfo_or_arcname
+            # perform an existence check
+            self.getinfo(zinfo.filename)
+        else:
+            zinfo = self.getinfo(zinfo_or_arcname)
+        if compress_type is None:
+            compress_type = zinfo.compress_type
+        if compresslevel is None:
+            compresslevel = self.compresslevel
+        zipfile._check_compression(compress_type)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        with tempfile.SpooledTemporaryFile(max_size=bufsize) as buffer:
+            crc, file_size = _compress_stream(data, buffer, compress_type,
+                                              compresslevel, bufsize)
+            compress_size = buffer.tell()
+            buffer.seek(0)
+            zip64 = file_size > ZIP64_LIMIT or compress_size > ZIP64_LIMIT
+            if zip64 and not self._allowZip64:
+                raise zipfile.LargeZipFile("Filesize would require ZIP64 extensions")
+
+            with self._lock:
+                slot = self._member_extent(zinfo)
+                at_end = zinfo.header_offset + slot == self.start_dir
+                # the contents may be shared with duplicates, see clone()
+                shared = self.shared_payloads and any(
+                    other.header_offset == zinfo.header_offset and
+                    other is not zinfo for other in self.filelist)
+                if self._layout is not None:
+                    # reindexed at its new extent when next used
+                    self._layout.discard([zinfo])
+
+                zinfo.date_time = time.localtime(time.time())[:6]
+                zinfo.compress_type = compress_type
+                zinfo.CRC = crc
+                zinfo.file_size = file_size
+                zinfo.compress_size = compress_size
+                # the sizes are known up front so there's no data descriptor,
+                # and the new contents aren't encrypted
+                zinfo.flag_bits &= ~(0x01 | 0x02 | 0x04 | 0x08)
+                if compress_type == ZIP_LZMA:
+                    # Compressed data includes an end-of-stream (EOS) marker
+                    zinfo.flag_bits |= 0x02
+                zinfo.extra = _strip_extra(zinfo.extra, (1,))
+                zinfo.orig_filename = zinfo.filename
+                if hasattr(zinfo, '_end_offset'):
+                    zinfo._end_offset = None
+                header = zinfo.FileHeader(zip64)
+
+                if shared or (len(header) + compress_size > slot and
+                              not at_end):
+                    # written after the last member, the old copy becomes
+                    # dead space unless it's shared
+                    zinfo.header_offset = self.start_dir
+                    at_end = True
+                self.fp.seek(zinfo.header_offset)
+                self.fp.write(header)
+                _copy_stream(buffer, self.fp, compress_size, bufsize)
+                self.fp.flush()
+                if at_end:
+                    self.start_dir = self.fp.tell()
+                    # drop the rest of a last member that shrank, the
+                    # central directory won't cover it in mode 'w'
+                    self.fp.truncate()
+                self._didModify = True
+
+    def copy_from(self, other, members=None, conflict_policy=CONFLICT_ERROR,
+                  bufsize=COPY_BUFSIZE):
+        """
+        Copy members of another archive into this one without decompressing
+        them, their compressed bytes (and any encryption) copied verbatim via
+        write_compressed().
+
+        Args:
+          other (ZipFileExtended, str, file): the archive to copy from, or
+            its filename or a file-like object to open it from.
+          members (list(str), list(ZipInfo), optional): the members to copy,
+            defaults to all of them.
+          conflict_policy (str, callable): what to do when a member's name
+            is already taken: CONFLICT_ERROR, CONFLICT_SKIP, CONFLICT_REPLACE
+            or CONFLICT_RENAME. Or a callable, called as
+            conflict_policy(zinfo, other), returning the name to copy the
+            member to (which replaces any member of that name) or None to
+            skip it.
+          bufsize (int, optional): the maximum number of bytes held in memory
+            at once while copying a member.
+
+        Returns:
+          The names the members were copied to, skipped members omitted.
+
+        Raises:
+          ValueError: on a name conflict with CONFLICT_ERROR.
+        """
+        if not isinstance(other, ZipFileExtended):
+            with ZipFileExtended(other) as other:
+                return self.copy_from(other, members, conflict_policy, bufsize)
+        if other is self:
+            raise ValueError("Can't copy members of an archive into itself")
+        if not self.fp:
+            raise RuntimeError(
+                "Attempt to write to ZIP archive that was already closed")
+        if members is None:
+            infos = other.infolist()
+        else:
+            infos = [m if isinstance(m, zipfile.ZipInfo) else other.getinfo(m)
+                     for m in members]
+
+        copied = []
+        for zinfo in infos:
+            name = zinfo.filename
+            if self._has_member(name):
+                name = self._resolve_conflict(zinfo, other, conflict_policy)
+                if name is None:
+                    continue
+                if self._has_member(name):
+                    self.remove(name)
+            new = copy.copy(zinfo)
+            new.filename = name
+            self.write_compressed(new, other.open_compressed(zinfo),
+                                  bufsize=bufsize)
+            copied.append(name)
+        return copied
+
+    def merge(self, sources, conflict_policy=CONFLICT_ERROR,
+              bufsize=COPY_BUFSIZE):
+        """
+        Copy every member of each of sources, in turn, into this archive
+        without decompressing them, see copy_from().
+
+        Args:
+          sources (list): ZipFileExtended objects, filenames or file-like
+            objects of the archives to merge in.
+          conflict_policy (str, callable): as copy_from(), applied to
+            conflicts with this archive and between the sources.
+          bufsize (int, optional): as copy_from().
+
+        Returns:
+          The names of the members copied, in order.
+        """
+        copied = []
+        for source in sources:
+            copied.extend(self.copy_from(source, None, conflict_policy,
+                                         bufsize))
+        return copied
+
+    def split(self, max_bytes=None, max_entries=None, naming=None,
+              group_by_directory=False, workers=None, verify=VERIFY_STRUCTURE,
+              bufsize=COPY_BUFSIZE):
+        """
+        Split the archive into shards holding at most max_bytes bytes and/or
+        max_entries members each. Members are copied without recompression,
+        in offset order, and hidden files are left out. A member bigger than
+        max_bytes gets a shard of its own.
+
+        Args:
+          max_bytes (int, optional): the largest a shard may be, including
+            its central directory.
+          max_entries (int, optional): the most members a shard may hold.
+          naming (str, callable, optional): a format string given the shard
+            number as {index} (counting from 1), or a callable called with
+            the shard number, producing the filename or file-like object of
+            each shard. Defaults to "<archive name>.{index:03d}.zip" for
+            archives opened by filename.
+          group_by_directory (boolean): keep members of the same directory
+            together in a shard, wherever they are in the archive, unless the
+            directory alone exceeds a limit. Directories are taken in the
+            order their first member appears.
+          workers (int, optional): write up to this many shards at once in
+            worker threads, by default they are written one after another.
+          verify (str, optional): the integrity check made on each shard.
+          bufsize (int, optional): the maximum number of bytes held in memory
+            at once while copying a member.
+
+        Returns:
+          The filenames (or file-like objects) of the shards, in order.
+        """
+        if max_bytes is None and max_entries is None:
+            raise ValueError("split() requires max_bytes or max_entries")
+        if naming is None:
+            if self._filePassed:
+                raise ValueError("split() requires naming for archives not "
+                                 "opened by filename")
+            root, ext = os.path.splitext(self.filename)
+            naming = root + ".{index:03d}" + (ext or ".zip")
+        if not callable(naming):
+            naming = naming.format
+            make_name = lambda index: naming(index=index)
+        else:
+            make_name = naming
+
+        with self._lock:
+            layout = self._get_layout()
+            infos = sorted(self.filelist, key=operator.attrgetter('header_offset'))
+            try:
+                self.fp.flush()
+                fd = self.fp.fileno()
+            except (AttributeError, OSError, ValueError):
+                fd = None
+        sizes = {}
+        for zinfo in infos:
+            sizes[zinfo] = _shard_entry_size(zinfo)
+        key = None
+        if group_by_directory:
+            key = lambda zinfo: posixpath.dirname(zinfo.filename.rstrip('/'))
+        parts = _partition(infos, sizes, max_bytes, max_entries, key)
+
+        def write_shard(index, part):
+            name = make_name(index)
+            with ZipFileExtended(name, "w", allowZip64=self._allowZip64) as shard:
+                for zinfo in part:
+                    data = _RangeFile(self, zinfo.header_offset +
+                                      layout.header_length(zinfo),
+                                      zinfo.compress_size, fd=fd)
+                    shard.write_compressed(copy.copy(zinfo), data,
+                                           bufsize=bufsize)
+            if not isinstance(name, str):
+                name.seek(0)
+            with ZipFileExtended(name) as shard:
+                badfile = shard.verify(verify)
+            if badfile:
+                raise zipfile.BadZipFile("Error when splitting zipfile, failed zipfile check: {} file is corrupt".format(badfile))
+            return name
+
+        indexes = range(1, len(parts) + 1)
+        if workers and workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                return list(executor.map(write_shard, indexes, parts))
+        return [write_shard(index, part) for index, part in zip(indexes, parts)]
+
+    def _resolve_conflict(self, zinfo, other, conflict_policy):
+        """Return the name to copy the member zinfo of other to when its own
+        name is taken, or None to skip it"""
+        if callable(conflict_policy):
+            return conflict_policy(zinfo, other)
+        if conflict_policy == CONFLICT_ERROR:
+            raise ValueError("Duplicate name: %r" % zinfo.filename)
+        if conflict_policy == CONFLICT_SKIP:
+            return None
+        if conflict_policy == CONFLICT_REPLACE:
+            return zinfo.filename
+        if conflict_policy == CONFLICT_RENAME:
+            if zinfo.filename.endswith('/'):
+                root, ext = zinfo.filename[:-1], '/'
+            else:
+                root, ext = posixpath.splitext(zinfo.filename)
+            for n in itertools.count(1):
+                name = "{}~{}{}".format(root, n, ext)
+                if not self._has_member(name):
+                    return name
+        raise ValueError("Unknown conflict policy: {}".format(conflict_policy))
+
+    def _write_hidden(self, data, bufsize=COPY_BUFSIZE):
         """Write data to the file that contains the zipfile without adding it as
-        a managed entry of the zip"""
+        a managed entry of the zip. data is either bytes or a file-like object
+        with a length attribute, which is copied in chunks of at most bufsize"""
         with self._lock:
             if self._seekable:
                 self.fp.seek(self.start_dir)
-            self.fp.write(data)
+            if hasattr(data, 'read'):
+                _copy_stream(data, self.fp, data.length, bufsize)
+            else:
+                self.fp.write(data)
             self.fp.flush()
             self.start_dir = self.fp.tell()
 
@@ -378,153 +1790,1983 @@ class ZipFileExtended(ZipFile):
         self.requires_commit = False
         self.removed_filelist = []
         # Reread contents
+        self._lazy = None
+        self.filelist = []
+        self.NameToInfo = {}
+        self._layout = None
         self._RealGetContents()
+        self._loaded_end = self.start_dir
         # seek to start of directory ready for subsequent writes
         self.fp.seek(self.start_dir)
 
 
-    def commit(self):
+    def commit(self, commit_mode=None, verify=VERIFY_STRUCTURE, dedup=None,
+               compact=False):
+        """Write all outstanding changes (removals, renames) to the archive.
+
+        Args:
+          commit_mode (str, optional): COMMIT_CLONE, COMMIT_INPLACE or
+            COMMIT_APPEND, defaults to the commit_mode the archive was opened
+            with.
+          verify (str, optional): the integrity check made on the updated
+            archive, see verify().
+          dedup (str, optional): DEDUP_REPORT records the sets of members
+            with identical contents in the CommitStats, see duplicates().
+            DEDUP_SHARE also rewrites the archive (as COMMIT_CLONE) with
+            each set's contents stored once, see clone(); it requires the
+            archive to be opened with shared_payloads.
+          compact (bool, optional): if True, the archive is also compacted,
+            dropping any dead space left by earlier COMMIT_APPEND commits
+            along with any other hidden files, whatever the commit_mode.
+
+        Raises:
+          RuntimeError: If the changes could not be committed.
+          BadZipFile: If the updated archive fails verification.
+        """
+        if commit_mode is None:
+            commit_mode = self.commit_mode
+        if commit_mode not in (COMMIT_CLONE, COMMIT_INPLACE, COMMIT_APPEND):
+            raise ValueError("Unknown commit mode: {}".format(commit_mode))
+        if dedup not in (None, DEDUP_REPORT, DEDUP_SHARE):
+            raise ValueError("Unknown dedup mode: {}".format(dedup))
+        if dedup == DEDUP_SHARE and not self.shared_payloads:
+            raise ValueError("DEDUP_SHARE requires shared_payloads")
+        stats = CommitStats(commit_mode)
+        stats.removed = len(self.removed_filelist)
+        for zinfo in self._touched_members():
+            if zinfo.header_offset >= self._loaded_end:
+                stats.added += 1
+            else:
+                stats.renamed += 1
+        self._stats = stats
+        start = time.perf_counter()
+        try:
+            if dedup == DEDUP_REPORT:
+                with self._phase("dedup"):
+                    stats.duplicates = [
+                        [zinfo.filename for zinfo in members]
+                        for members in self.duplicates()]
+            self._commit(commit_mode, verify, dedup, compact)
+        finally:
+            self._stats = None
+            stats.seconds = time.perf_counter() - start
+            stats.members = len(self.filelist)
+            self.last_commit_stats = stats
+        if self.commit_hook is not None:
+            self.commit_hook("commit", stats.seconds, stats)
+
+    def compact(self, verify=VERIFY_STRUCTURE):
+        """Commit any outstanding changes and reclaim the archive's dead
+        space, see dead_space(), by moving the remaining members down over
+        it. Any other hidden files are dropped too.
+
+        Args:
+          verify (str, optional): the integrity check made on the compacted
+            archive, see verify().
+
+        Raises:
+          RuntimeError: If the archive could not be compacted.
+          BadZipFile: If the compacted archive fails verification.
+        """
+        self.commit(verify=verify, compact=True)
+
+    def _commit(self, commit_mode, verify, dedup=None, compact=False):
+        in_memory = isinstance(self.fp, io.BytesIO)
+        if dedup == DEDUP_SHARE:
+            # only a clone can share payloads
+            if in_memory:
+                self._commit_memory(verify, dedup=dedup)
+            else:
+                self._commit_clone(verify, dedup=dedup)
+            return
+        if compact:
+            self._compact(verify)
+            return
+        if commit_mode == COMMIT_APPEND and self._commit_append(verify):
+            self._auto_compact(verify)
+            return
+        if self._commit_renames(verify):
+            return
+        if ((commit_mode == COMMIT_INPLACE or in_memory) and
+                self._commit_inplace(verify)):
+            return
+        if in_memory:
+            self._commit_memory(verify)
+        else:
+            self._commit_clone(verify)
+
+    def _commit_memory(self, verify=VERIFY_STRUCTURE,
+                       ignore_hidden_files=False, dedup=None):
+        """
+        Commit outstanding changes to an archive held in a BytesIO, when it
+        can't be compacted in place, by cloning it into another BytesIO and
+        copying the clone's buffer back over the archive's. No temporary
+        files are involved.
+        """
+        self._commit_path("memory")
+        with io.BytesIO() as clonefp:
+            # will verify and raise BadZipFile error if it fails
+            clone = self.clone(clonefp, ignore_hidden_files=ignore_hidden_files,
+                               verify=verify, dedup=dedup)
+            clone.close()
+            with self._lock:
+                with self._phase("stream_copy") as stats:
+                    size = clonefp.seek(0, os.SEEK_END)
+                    self.fp.seek(0)
+                    _copy_range(clonefp, 0, self.fp, size,
+                                progress=self._progress("stream_copy"))
+                    self.fp.truncate()
+                    if stats is not None:
+                        stats.bytes_read += size
+                        stats.bytes_written += size
+                with self._phase("reset"):
+                    self._reset()
+
+    @contextlib.contextmanager
+    def _phase(self, name):
+        """Time a phase of the commit in progress, if any, yielding its
+        CommitStats (or None) so bytes read and written can be counted"""
+        stats = self._stats
+        if stats is None:
+            yield None
+            return
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            seconds = time.perf_counter() - start
+            stats.phases[name] = stats.phases.get(name, 0.0) + seconds
+            if self.commit_hook is not None:
+                self.commit_hook(name, seconds, stats)
+
+    def _commit_path(self, path):
+        """Record the way the commit in progress is being made, the first
+        (e.g. an append commit that goes on to compact) taking precedence"""
+        if self._stats is not None and self._stats.path is None:
+            self._stats.path = path
+
+    def _progress(self, phase):
+        """Return a progress callback for copies made in phase, or None"""
+        if self.commit_progress is None:
+            return None
+        return functools.partial(self.commit_progress, phase)
+
+    def _write_directory(self):
+        """Write the central directory at start_dir and truncate the file
+        after it"""
+        with self._phase("directory") as stats:
+            self.fp.seek(self.start_dir)
+            self._write_end_record()
+            if stats is not None:
+                stats.bytes_written += self.fp.tell() - self.start_dir
+            self.fp.truncate()
+            self.fp.flush()
+            if self.fsync:
+                _fsync(self.fp)
+
+    def _commit_append(self, verify=VERIFY_STRUCTURE):
+        """
+        Commit outstanding changes without moving any member data. Removed
+        members are simply left out of a new central directory, written
+        after the last member, and become dead space. A renamed member's
+        local header is patched in place when the new name is the same
+        length (or directory_only_renames is set), otherwise the member is
+        copied with its new header to the end of the archive and the old
+        copy becomes dead space.
+
+        Returns:
+          False if the archive can't be updated in place, True otherwise.
+        """
+        if (not self._seekable or not hasattr(self.fp, 'truncate') or
+                not hasattr(self.fp, 'write')):
+            return False
+
+        with self._lock:
+            self._commit_path("append")
+            layout = self._get_layout()
+            touched = [zinfo.filename for zinfo in self._touched_members()]
+            renamed = [zinfo for zinfo in self.filelist
+                       if zinfo.filename != zinfo.orig_filename]
+            # moved members are written over the central directory, and only
+            # renamed members' headers are patched
+            regions = [(zinfo.header_offset,
+                        zinfo.header_offset + layout.header_length(zinfo))
+                       for zinfo in renamed]
+            regions.append((self.start_dir, None))
+            with self._journaled(regions):
+                moved = []
+                cursor = self.start_dir
+                with self._phase("renames") as stats:
+                    for zinfo in renamed:
+                        header = self._local_header(zinfo)
+                        new_header = _rename_local_header(header, zinfo)
+                        if len(new_header) == len(header):
+                            self.fp.seek(zinfo.header_offset)
+                            self.fp.write(new_header)
+                        elif self.directory_only_renames:
+                            continue
+                        else:
+                            start, end = layout.extent(zinfo)
+                            length = end - start - len(header)
+                            self.fp.seek(cursor)
+                            self.fp.write(new_header)
+                            # the copy lands after all the data so never overlaps it
+                            _move_within(self.fp, start + len(header),
+                                         cursor + len(new_header), length)
+                            zinfo.header_offset = cursor
+                            if hasattr(zinfo, '_end_offset'):
+                                # Python 3.12+ bounds reads by the next
+                                # member's offset, now out of date
+                                zinfo._end_offset = None
+                            cursor += len(new_header) + length
+                            moved.append(zinfo)
+                            if stats is not None:
+                                stats.bytes_read += length
+                                stats.bytes_written += length
+                        if stats is not None:
+                            stats.bytes_written += len(new_header)
+                        zinfo.orig_filename = zinfo.filename
+
+                self.start_dir = cursor
+                self._write_directory()
+                # removed members' data, and the old copies of moved ones, are
+                # now dead space; the moved members are reindexed at their new
+                # offsets
+                layout.discard(self.removed_filelist + moved)
+
+                self._didModify = False
+                self.requires_commit = False
+                self.removed_filelist = []
+                self._loaded_end = self.start_dir
+                self._refresh_index_cache()
+
+                with self._phase("verify"):
+                    badfile = self.verify(verify, touched)
+                if badfile:
+                    raise zipfile.BadZipFile("Error when updating zipfile, failed zipfile check: {} file is corrupt".format(badfile))
+        return True
+
+    def _auto_compact(self, verify=VERIFY_STRUCTURE):
+        """Compact the archive if its dead space exceeds compact_threshold"""
+        if self.compact_threshold is None or not self.start_dir:
+            return
+        if self.dead_space() <= self.compact_threshold * self.start_dir:
+            return
+        self._compact(verify)
+
+    def _compact(self, verify=VERIFY_STRUCTURE):
+        """Commit outstanding changes dropping hidden files, dead space
+        included"""
+        if self._stats is not None:
+            self._stats.compacted = True
+        if self._commit_inplace(verify, ignore_hidden_files=True):
+            return
+        if isinstance(self.fp, io.BytesIO):
+            self._commit_memory(verify, ignore_hidden_files=True)
+        else:
+            self._commit_clone(verify, ignore_hidden_files=True)
+
+    def _commit_renames(self, verify=VERIFY_STRUCTURE):
+        """
+        Commit outstanding changes by rewriting only the central directory.
+        Only possible when the changes are all renames and each new name can
+        be patched into its local header in place, being the same length as
+        the old one, or directory_only_renames is set.
+
+        Returns:
+          False if the changes can not be committed this way, True otherwise.
+        """
+        if (self.removed_filelist or not self._seekable or
+                not hasattr(self.fp, 'truncate') or
+                not hasattr(self.fp, 'write')):
+            return False
+
+        with self._lock:
+            renamed = [zinfo for zinfo in self.filelist
+                       if zinfo.filename != zinfo.orig_filename]
+            patches = []
+            for zinfo in renamed:
+                header = self._local_header(zinfo)
+                new_header = _rename_local_header(header, zinfo)
+                if len(new_header) == len(header):
+                    patches.append((zinfo, new_header))
+                elif not self.directory_only_renames:
+                    return False
+
+            # the central directory and patched headers can be put back
+            regions = [(zinfo.header_offset, zinfo.header_offset + len(header))
+                       for zinfo, header in patches]
+            regions.append((self.start_dir, None))
+            with self._journaled(regions):
+                self._commit_path("renames")
+                with self._phase("renames") as stats:
+                    for zinfo, header in patches:
+                        self.fp.seek(zinfo.header_offset)
+                        self.fp.write(header)
+                        zinfo.orig_filename = zinfo.filename
+                        if stats is not None:
+                            stats.bytes_written += len(header)
+                self._write_directory()
+
+                self._didModify = False
+                self.requires_commit = False
+                self._loaded_end = self.start_dir
+                self._refresh_index_cache()
+
+                with self._phase("verify"):
+                    badfile = self.verify(verify, [zinfo.filename for zinfo in renamed])
+                if badfile:
+                    raise zipfile.BadZipFile("Error when renaming in zipfile, failed zipfile check: {} file is corrupt".format(badfile))
+        return True
+
+    def _compaction_plan(self, ignore_hidden_files=False):
+        """
+        Plan an in-place compaction of this archive.
+
+        Returns:
+          A list of (zinfo, src, dst, length, header) tuples, in offset order,
+          describing where each region of data that needs to move lives now
+          and where it should be written to. zinfo is None for hidden files,
+          header is the replacement local header for renamed members. Members
+          nested inside another region are relocated along with it and get an
+          (zinfo, src, dst, 0, None) entry.
+
+          Returns None if the archive can not be compacted in place, e.g. a
+          rename has made a local header grow beyond the space available.
+        """
+        layout = self._get_layout()
+        files = self._gather_and_filter_files(
+            ignore_hidden_files=ignore_hidden_files, sort=True)
+        plan = []
+        cursor = 0
+        # the extent of the last region kept: (src, dst, end)
+        span = (0, 0, 0)
+        for f in files:
+            if isinstance(f, zipfile.ZipInfo):
+                src, end = layout.extent(f)
+                if src < span[2]:
+                    if end > span[2]:
+                        # Partially overlapping members can't be untangled
+                        return None
+                    # contained within the previous region so moves with it
+                    plan.append((f, src, span[1] + src - span[0], 0, None))
+                    continue
+                new_header = None
+                if f.filename != f.orig_filename:
+                    header = self._local_header(f)
+                    new_header = _rename_local_header(header, f)
+                    # the data must never be written ahead of where it's read
+                    if cursor + len(new_header) > src + len(header):
+                        return None
+            else:
+                src = max(f.start, span[2])
+                end = f.start + f.length
+                if src >= end:
+                    continue
+                new_header = None
+            plan.append((f if isinstance(f, zipfile.ZipInfo) else None,
+                         src, cursor, end - src, new_header))
+            span = (src, cursor, end)
+            cursor += end - src
+            if new_header is not None:
+                cursor += len(new_header) - len(header)
+        return plan
+
+    def _commit_inplace(self, verify=VERIFY_STRUCTURE,
+                        ignore_hidden_files=False):
+        """
+        Commit outstanding changes by compacting the archive in place.
+        Regions before the first removed or renamed member are left untouched,
+        everything after it is slid down over the freed space before the
+        central directory is rewritten and the file truncated.
+
+        Hidden files are kept unless ignore_hidden_files is set, when their
+        space is reclaimed too.
+
+        Returns:
+          False if the archive can not be compacted in place, True otherwise.
+        """
+        if (not self._seekable or not hasattr(self.fp, 'truncate') or
+                not hasattr(self.fp, 'write')):
+            return False
+
+        with self._lock:
+            with self._phase("plan"):
+                layout = self._get_layout()
+                plan = self._compaction_plan(ignore_hidden_files)
+            if plan is None:
+                return False
+            self._commit_path("inplace")
+            touched = [zinfo.filename for zinfo in self._touched_members()]
+
+            # the plan as moves of data, each after writing the local header,
+            # if any, that goes just before it: (src, dst, length, header)
+            moves = []
+            end = 0
+            for zinfo, src, dst, length, header in plan:
+                if zinfo is not None and length == 0:
+                    # nested member, data is moved by its containing region
+                    continue
+                if header is not None:
+                    old_length = layout.header_length(zinfo)
+                    src += old_length
+                    dst += len(header)
+                    length -= old_length
+                    # the data may already be where it belongs
+                    moves.append((src, dst, length if src != dst else 0,
+                                  header))
+                elif src != dst:
+                    moves.append((src, dst, length, b""))
+                end = dst + length
+            for zinfo, src, dst, length, header in plan:
+                if zinfo is not None:
+                    zinfo.header_offset = dst
+                    if header is not None:
+                        zinfo.orig_filename = zinfo.filename
+            self.start_dir = end
+
+            self._move_data(moves)
+            # members have moved
+            self._layout = None
+
+            self._didModify = False
+            self.requires_commit = False
+            self.removed_filelist = []
+            self._loaded_end = self.start_dir
+            self._refresh_index_cache()
+
+            with self._phase("verify"):
+                badfile = self.verify(verify, touched)
+            if badfile:
+                raise zipfile.BadZipFile("Error when compacting zipfile, failed zipfile check: {} file is corrupt".format(badfile))
+        return True
+
+    def _commit_clone(self, verify=VERIFY_STRUCTURE, ignore_hidden_files=False,
+                      dedup=None):
         # zip will be validated by clone
         # Try to create tempfiles in same directory first
         if not self._filePassed:
             dir = os.path.dirname(self.filename)
         else:
             dir = None
+        with self._phase("tempfiles"):
+            try:
+                clonefp = tempfile.NamedTemporaryFile(dir=dir, delete=False)
+            except:
+                clonefp = tempfile.NamedTemporaryFile(delete=False)
+
+        # Is this a real file, and does the clone live on the same mount
+        # point, so it can be renamed over the archive?
+        rename = (not self._filePassed and os.path.exists(self.filename) and
+                  (find_mount_point(self.filename) ==
+                   find_mount_point(clonefp.name)))
+        journal = None
+        if rename and self._journal_path() is not None:
+            journal = _Journal(self._journal_path())
+            with self._phase("journal"):
+                self.fp.flush()
+                journal.begin_clone(self.filename, clonefp.name)
+
         try:
-            clonefp = tempfile.NamedTemporaryFile(dir=dir, delete=False)
-            backupfp = tempfile.NamedTemporaryFile(dir=dir, delete=False)
+            # clone the zip to create the up-to-date version -
+            # will verify and raise BadZipFile error if it fails
+            clone = self.clone(clonefp, ignore_hidden_files=ignore_hidden_files,
+                               verify=verify, dedup=dedup)
+            clone.close()
+            if self.fsync or journal is not None:
+                _fsync(clonefp)
+            clonefp.close()
         except:
-            clonefp = tempfile.NamedTemporaryFile(delete=False)
-            backupfp = tempfile.NamedTemporaryFile(delete=False)
-
-        # clone the zip to create the up-to-date version -
-        # will verify and raise BadZipFile error if it fails
-        clone = self.clone(clonefp)
-
-        # Now we need to move files around
-        # Is this a real file, and does it live on the same mount point?
-        if(not self._filePassed and os.path.exists(self.filename) and
-           (find_mount_point(self.filename) == find_mount_point(clone.filename))):
-            # if things are filebased then we can used the OS to move files
-            # around. mv self.filename to backupfp, new to self.filename,
-            # and then remove backupfp
-            backupfp.close()
+            clonefp.close()
+            os.unlink(clonefp.name)
+            if journal is not None:
+                journal.remove()
+            raise
+
+        if rename:
+            # if things are filebased then we can use the OS to atomically
+            # replace the archive with the clone
+            self._commit_path("clone-rename")
             try:
-                os.rename(self.filename, backupfp.name)
+                if journal is not None:
+                    with self._phase("journal"):
+                        # from here on a crash rolls forward to the clone
+                        journal.clone_ready()
+                with self._phase("swap"):
+                    os.replace(clone.filename, self.filename)
+                    if self.fsync or journal is not None:
+                        _fsync_dir(os.path.dirname(os.path.abspath(self.filename)))
+                    if journal is not None:
+                        journal.remove()
             except:
+                if os.path.exists(clone.filename):
+                    os.unlink(clone.filename)
+                if journal is not None:
+                    journal.remove()
                 raise RuntimeError("Failed to commit updates to zipfile")
-            try:
-                os.rename(clone.filename, self.filename)
+            # swap our file pointer over to the new file
+            with self._lock, self._phase("reset"):
+                self.fp.close()
+                self.fp = io.open(self.filename, "r+b")
                 self._reset()
-            except:
-                os.rename(backupfp.name, self.filename)
-                raise RuntimeError("Failed to commit updates to zipfile")
+            return
         # Is it a file-like stream?
-        elif hasattr(self.fp, 'write'):
+        if hasattr(self.fp, 'write'):
             # self.fp is a stream or lives on another mount point
+            self._commit_path("clone-stream")
+            try:
+                backupfp = tempfile.NamedTemporaryFile(dir=dir, delete=False)
+            except:
+                backupfp = tempfile.NamedTemporaryFile(delete=False)
             with self._lock:
                 try:
-                    self.fp.seek(0)
-                    for b in self.fp:
-                        backupfp.write(b)
+                    with self._phase("backup") as stats:
+                        backup_size = self.fp.seek(0, os.SEEK_END)
+                        _copy_range(self.fp, 0, backupfp, backup_size,
+                                    progress=self._progress("backup"))
+                        if stats is not None:
+                            stats.bytes_read += backup_size
+                            stats.bytes_written += backup_size
                 except:
                     raise RuntimeError("Failed to commit updates to zipfile")
                 try:
-                    # Set up to write new bytes
-                    self.fp.seek(0)
-                    self.fp.truncate()  # might be shorter so truncate
-                    with open(clone.filename, 'rb') as fp:
-                        for b in fp:
-                            self.fp.write(b)
-                    self._reset()
+                    with self._phase("stream_copy") as stats:
+                        # Set up to write new bytes
+                        self.fp.seek(0)
+                        self.fp.truncate()  # might be shorter so truncate
+                        with open(clone.filename, 'rb') as fp:
+                            size = fp.seek(0, os.SEEK_END)
+                            _copy_range(fp, 0, self.fp, size,
+                                        progress=self._progress("stream_copy"))
+                        self.fp.flush()
+                        if self.fsync:
+                            _fsync(self.fp)
+                        if stats is not None:
+                            stats.bytes_read += size
+                            stats.bytes_written += size
+                    with self._phase("reset"):
+                        self._reset()
                 except:
-                    backupfp.seek(0)
                     self.fp.seek(0)
-                    for b in backup.fp:
-                        self.fp.write(b)
+                    _copy_range(backupfp, 0, self.fp, backup_size)
+                    self.fp.truncate()
                     backupfp.close()
                     raise RuntimeError("Failed to commit updates to zipfile")
             backupfp.close()
         else:
             # failed to commit
+            os.unlink(clonefp.name)
             raise RuntimeError("Failed to commit updates to zipfile")
         # cleanup
-        if os.path.exists(backupfp.name):
-            os.unlink(backupfp.name)
+        with self._phase("cleanup"):
+            for name in (backupfp.name, clonefp.name):
+                if os.path.exists(name) and name != self.filename:
+                    os.unlink(name)
+
+
+class _LazyDirectory:
+    """
+    The central directory of an archive held as the raw bytes read from the
+    file. The offset of each record is kept in an array, and the CRC32 of
+    each (UTF-8 encoded) name in a sorted array alongside the record number,
+    so a member can be found by name with a binary search. A ZipInfo is only
+    created when a member is asked for. Where a member's data must end, the
+    next local header or the central directory, is worked out for every
+    member the first time one is created (or the index is saved), for
+    zipfile's check for overlapping members (Python 3.12+, and 3.11.8+).
+
+    The index can be saved to, and loaded from, a cache file. Loading maps
+    the file into memory so takes the same time whatever the archive's size.
+    """
+
+    def __init__(self, data, concat, encoding, start_dir):
+        self.data = data
+        self.concat = concat
+        self.encoding = encoding
+        self.start_dir = start_dir
+        self.ends = None
+        self.offsets = array.array('Q')
+        hashes = array.array('I')
+        total = 0
+        while total < len(data):
+            centdir = data[total:total + zipfile.sizeCentralDir]
+            if len(centdir) != zipfile.sizeCentralDir:
+                raise zipfile.BadZipFile("Truncated central directory")
+            centdir = struct.unpack(zipfile.structCentralDir, centdir)
+            if centdir[zipfile._CD_SIGNATURE] != zipfile.stringCentralDir:
+                raise zipfile.BadZipFile("Bad magic number for central directory")
+            self.offsets.append(total)
+            hashes.append(_name_hash(self._name(total, centdir)))
+            total = (total + zipfile.sizeCentralDir +
+                     centdir[zipfile._CD_FILENAME_LENGTH] +
+                     centdir[zipfile._CD_EXTRA_FIELD_LENGTH] +
+                     centdir[zipfile._CD_COMMENT_LENGTH])
+        self.order = array.array(
+            'I', sorted(range(len(hashes)), key=hashes.__getitem__))
+        self.hashes = array.array('I', (hashes[i] for i in self.order))
+        self._reset()
+
+    def _reset(self):
+        # ZipInfo created so far, by record number, and back again
+        self.infos = {}
+        self.records = {}
+        # record numbers removed, and renamed (new name -> record number)
+        self.removed = set()
+        self.renamed = {}
+
+    @classmethod
+    def load(cls, path, key, start_dir):
+        """Load the index saved to path by save(), returning None if there is
+        no such file or it was saved with a different key"""
+        import mmap
+        try:
+            with open(path, 'rb') as fp:
+                map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        view = memoryview(map)
+        try:
+            (magic, key_length, count, data_length,
+             concat) = struct.unpack_from(structIndexHeader, view)
+            offset = sizeIndexHeader + _pad8(key_length)
+            if (magic != stringIndexHeader or
+                    view[sizeIndexHeader:sizeIndexHeader + key_length] != key or
+                    len(view) != offset + 24 * count + data_length):
+                view.release()
+                map.close()
+                return None
+        except struct.error:
+            view.release()
+            map.close()
+            return None
+        lazy = cls.__new__(cls)
+        lazy.concat = concat
+        lazy.start_dir = start_dir
+        lazy.encoding = key.split(b'\0')[-1].decode('ascii')
+        lazy.offsets = view[offset:offset + 8 * count].cast('Q')
+        offset += 8 * count
+        lazy.hashes = view[offset:offset + 4 * count].cast('I')
+        offset += 4 * count
+        lazy.order = view[offset:offset + 4 * count].cast('I')
+        offset += 4 * count
+        lazy.ends = view[offset:offset + 8 * count].cast('Q')
+        offset += 8 * count
+        lazy.data = view[offset:offset + data_length]
+        lazy._reset()
+        return lazy
+
+    def save(self, path, key):
+        """Save the index to path, replacing it atomically"""
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, 'wb') as fp:
+            fp.write(struct.pack(structIndexHeader, stringIndexHeader,
+                                 len(key), len(self.offsets), len(self.data),
+                                 self.concat))
+            fp.write(key.ljust(_pad8(len(key)), b'\0'))
+            fp.write(self.offsets)
+            fp.write(self.hashes)
+            fp.write(self.order)
+            if self.ends is None:
+                self.ends = self._end_offsets()
+            fp.write(self.ends)
+            fp.write(self.data)
+        os.replace(tmp, path)
+
+    def _name(self, offset, centdir):
+        filename = bytes(self.data[offset + zipfile.sizeCentralDir:
+                                   offset + zipfile.sizeCentralDir +
+                                   centdir[zipfile._CD_FILENAME_LENGTH]])
+        if centdir[zipfile._CD_FLAG_BITS] & 0x800:
+            # UTF-8 file names extension
+            filename = filename.decode('utf-8')
+        else:
+            # Historical ZIP filename encoding
+            filename = filename.decode(self.encoding)
+        # as sanitised by ZipInfo
+        return _clean_filename(filename)
+
+    def info(self, record):
+        """Return the ZipInfo for the record number, creating it if need be"""
+        if record in self.infos:
+            return self.infos[record]
+        offset = self.offsets[record]
+        centdir = struct.unpack(
+            zipfile.structCentralDir,
+            self.data[offset:offset + zipfile.sizeCentralDir])
+        offset += zipfile.sizeCentralDir
+        filename = bytes(self.data[offset:offset + centdir[zipfile._CD_FILENAME_LENGTH]])
+        offset += centdir[zipfile._CD_FILENAME_LENGTH]
+        filename_crc = binascii.crc32(filename)
+        if centdir[zipfile._CD_FLAG_BITS] & 0x800:
+            filename = filename.decode('utf-8')
+        else:
+            filename = filename.decode(self.encoding)
+        # Create ZipInfo instance to store file information
+        x = zipfile.ZipInfo(filename)
+        x.extra = bytes(self.data[offset:offset + centdir[zipfile._CD_EXTRA_FIELD_LENGTH]])
+        offset += centdir[zipfile._CD_EXTRA_FIELD_LENGTH]
+        x.comment = bytes(self.data[offset:offset + centdir[zipfile._CD_COMMENT_LENGTH]])
+        x.header_offset = centdir[zipfile._CD_LOCAL_HEADER_OFFSET]
+        (x.create_version, x.create_system, x.extract_version, x.reserved,
+         x.flag_bits, x.compress_type, t, d,
+         x.CRC, x.compress_size, x.file_size) = centdir[1:12]
+        if x.extract_version > zipfile.MAX_EXTRACT_VERSION:
+            raise NotImplementedError("zip file version %.1f" %
+                                      (x.extract_version / 10))
+        x.volume, x.internal_attr, x.external_attr = centdir[15:18]
+        # Convert date/time code to (year, month, day, hour, min, sec)
+        x._raw_time = t
+        x.date_time = ( (d>>9)+1980, (d>>5)&0xF, d&0x1F,
+                        t>>11, (t>>5)&0x3F, (t&0x1F) * 2 )
+        _decode_extra(x, filename_crc)
+        x.header_offset = x.header_offset + self.concat
+        if hasattr(x, '_end_offset'):
+            x._end_offset = self.end_offset(record)
+        self.infos[record] = x
+        self.records[x] = record
+        return x
+
+    def end_offset(self, record):
+        """Return where the data of the record number must end"""
+        if self.ends is None:
+            self.ends = self._end_offsets()
+        return self.ends[record]
+
+    def _end_offsets(self):
+        """Return the offset of the next local header, or the central
+        directory, after each record's local header, the way ZipFile sets
+        ZipInfo._end_offset"""
+        starts = array.array('Q')
+        for offset in self.offsets:
+            centdir = struct.unpack(
+                zipfile.structCentralDir,
+                self.data[offset:offset + zipfile.sizeCentralDir])
+            starts.append(self._header_offset(offset, centdir))
+        ends = array.array('Q', [0]) * len(starts)
+        end = self.start_dir
+        # members sharing a local header end where it starts, but the first
+        for record in sorted(range(len(starts)), key=starts.__getitem__,
+                             reverse=True):
+            ends[record] = end
+            end = starts[record]
+        return ends
+
+    def _header_offset(self, offset, centdir):
+        """Return the offset of the record's local header, which may be in
+        its zip64 extra field"""
+        header_offset = centdir[zipfile._CD_LOCAL_HEADER_OFFSET]
+        if header_offset == 0xFFFFFFFF:
+            extra = offset + zipfile.sizeCentralDir + \
+                centdir[zipfile._CD_FILENAME_LENGTH]
+            end = extra + centdir[zipfile._CD_EXTRA_FIELD_LENGTH]
+            while extra + 4 <= end:
+                xid, xlen = struct.unpack('<HH', self.data[extra:extra + 4])
+                if xid == 1:
+                    # only the fields too big for the record are present
+                    skip = 8 * ((centdir[zipfile._CD_UNCOMPRESSED_SIZE] ==
+                                 0xFFFFFFFF) +
+                                (centdir[zipfile._CD_COMPRESSED_SIZE] ==
+                                 0xFFFFFFFF))
+                    if skip + 8 <= xlen:
+                        header_offset, = struct.unpack(
+                            '<Q', self.data[extra + 4 + skip:
+                                            extra + 12 + skip])
+                    break
+                extra += 4 + xlen
+        return header_offset + self.concat
+
+    def find(self, name):
+        """Return the record number of the member name, or None"""
+        if name in self.renamed:
+            return self.renamed[name]
+        found = None
+        i = bisect.bisect_left(self.hashes, _name_hash(name))
+        while i < len(self.hashes) and self.hashes[i] == _name_hash(name):
+            record = self.order[i]
+            i += 1
+            if record in self.removed:
+                continue
+            if record in self.infos:
+                # may have been renamed
+                matches = self.infos[record].filename == name
+            else:
+                offset = self.offsets[record]
+                centdir = struct.unpack(
+                    zipfile.structCentralDir,
+                    self.data[offset:offset + zipfile.sizeCentralDir])
+                matches = self._name(offset, centdir) == name
+            # like NameToInfo the last of any duplicates wins
+            if matches and (found is None or record > found):
+                found = record
+        return found
+
+    def getinfo(self, name):
+        record = self.find(name)
+        if record is None:
+            return None
+        return self.info(record)
+
+    def remove(self, zinfo):
+        record = self.records[zinfo]
+        self.removed.add(record)
+        if self.renamed.get(zinfo.filename) == record:
+            del self.renamed[zinfo.filename]
+
+    def rename(self, zinfo, filename):
+        record = self.records[zinfo]
+        if self.renamed.get(zinfo.filename) == record:
+            del self.renamed[zinfo.filename]
+        zinfo.filename = filename
+        self.renamed[filename] = record
+
+    def infolist(self):
+        """Return the ZipInfo of every member not removed, in order"""
+        return [self.info(record) for record in range(len(self.offsets))
+                if record not in self.removed]
 
 
-def read(self, n=-1, decompress=True):
-    """Read and return up to n bytes.
-    If the argument is omitted, None, or negative, data is read and returned
-    until EOF is reached..
+class _Journal:
+    """
+    Intent log making a commit crash safe. Before headers or the central
+    directory are patched in place the regions about to be overwritten are
+    saved to the journal (an undo log), before member data is slid down in
+    place the moves are planned in it along with the new central directory
+    (a redo log, with a checkpoint of the progress made), and before a clone
+    is swapped in for the archive the clone's path is recorded. Nothing in
+    the journal is acted on until its state has been set, which is only done
+    once what it records has been flushed to disk, and the journal is
+    removed once the commit is durable.
+
+    After a crash recover() puts the saved regions back, or finishes the
+    moves, or swaps in a clone that was complete, or removes a clone that
+    wasn't, reading no member data beyond what the unfinished moves copy.
     """
-    if n is None or n < 0:
-        buf = self._readbuffer[self._offset:]
-        self._readbuffer = b''
+
+    def __init__(self, path):
+        self.path = path
+
+    def _write(self, state, size, mtime_ns, write_body):
+        """Write the journal, setting its state once its body is on disk"""
+        with open(self.path, "wb") as journal:
+            journal.write(struct.pack(structJournalHeader, stringJournalHeader,
+                                      _JOURNAL_INCOMPLETE, size, mtime_ns))
+            result = write_body(journal)
+            _fsync(journal)
+            self._set_state(journal, state)
+        _fsync_dir(os.path.dirname(os.path.abspath(self.path)))
+        return result
+
+    def _set_state(self, journal, state):
+        journal.seek(len(stringJournalHeader))
+        journal.write(bytes([state]))
+        _fsync(journal)
+
+    def save(self, fp, regions):
+        """Save the regions, (start, end) offsets with end None for the end
+        of the file, of the archive fp. Returns the number of bytes saved."""
+        size = fp.seek(0, os.SEEK_END)
+
+        def write_regions(journal):
+            saved = 0
+            for start, end in regions:
+                end = size if end is None else min(end, size)
+                if start >= end:
+                    continue
+                journal.write(struct.pack(structJournalRegion, start,
+                                          end - start))
+                _copy_range(fp, start, journal, end - start)
+                saved += end - start
+            return saved
+        return self._write(_JOURNAL_UNDO, size, 0, write_regions)
+
+    def save_moves(self, fp, moves, end, directory):
+        """Plan the moves (src, dst, length, header) within the archive fp,
+        followed by the central directory written at end. Returns the size
+        of the journal."""
+        size = fp.seek(0, os.SEEK_END)
+
+        def write_moves(journal):
+            journal.write(struct.pack(structJournalCheckpoint, 0, 0, 0))
+            journal.write(struct.pack(structJournalMoves, len(moves), end,
+                                      len(directory)))
+            for src, dst, length, header in moves:
+                journal.write(struct.pack(structJournalMove, src, dst, length,
+                                          len(header)))
+                journal.write(header)
+            journal.write(directory)
+            return journal.tell()
+        self.scratch = self._write(_JOURNAL_REDO, size, 0, write_moves)
+        return self.scratch
+
+    def redo(self, fp, moves, move=0, done=0, saved=0):
+        """
+        Make the moves within the archive fp, starting from done bytes into
+        the move numbered move, checkpointing the progress as each chunk is
+        moved. saved is the length of a chunk of that move saved to the
+        journal, to be written first.
+
+        A chunk that would overwrite its own source, because the move is by
+        less than _REDO_MIN_CHUNK, is saved to the journal before it's
+        written. Returns the number of bytes saved.
+        """
+        total = 0
+        with open(self.path, "r+b") as journal:
+            for i in range(move, len(moves)):
+                src, dst, length, header = moves[i]
+                if i != move:
+                    done = saved = 0
+                if header:
+                    fp.seek(dst - len(header))
+                    fp.write(header)
+                if saved:
+                    journal.seek(self.scratch)
+                    chunk = journal.read(saved)
+                    fp.seek(dst + done)
+                    fp.write(chunk)
+                    done += saved
+                gap = src - dst
+                bufsize = COPY_BUFSIZE
+                if gap >= _REDO_MIN_CHUNK:
+                    bufsize = min(bufsize, gap)
+                while done < length:
+                    fp.seek(src + done)
+                    chunk = fp.read(min(bufsize, length - done))
+                    if not chunk:
+                        raise zipfile.BadZipFile("Unexpected end of archive")
+                    if len(chunk) > gap:
+                        self._checkpoint(journal, fp, i, done, chunk)
+                        total += len(chunk)
+                    else:
+                        self._checkpoint(journal, fp, i, done)
+                    fp.seek(dst + done)
+                    fp.write(chunk)
+                    done += len(chunk)
+                if length:
+                    # the next move's header may overwrite this one's source
+                    self._checkpoint(journal, fp, i + 1, 0)
+        return total
+
+    def _checkpoint(self, journal, fp, move, done, chunk=None):
+        """Record, once everything written to fp so far is on disk, that
+        done bytes of the move numbered move have been made, saving the next
+        chunk of it if given"""
+        _fsync(fp)
+        if chunk is not None:
+            journal.seek(self.scratch)
+            journal.write(chunk)
+        journal.seek(sizeJournalHeader)
+        journal.write(struct.pack(structJournalCheckpoint, move, done,
+                                  len(chunk) if chunk is not None else 0))
+        _fsync(journal)
+
+    def begin_clone(self, filename, clone_path):
+        """Record that clone_path is being written to replace the archive
+        filename, as it is now"""
+        st = os.stat(filename)
+        self._write(_JOURNAL_CLONE, st.st_size, st.st_mtime_ns,
+                    lambda journal: journal.write(os.fsencode(clone_path)))
+
+    def clone_ready(self):
+        """Record that the clone is complete and flushed to disk"""
+        with open(self.path, "r+b") as journal:
+            self._set_state(journal, _JOURNAL_CLONE_READY)
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            return
+        _fsync_dir(os.path.dirname(os.path.abspath(self.path)))
+
+    def recover(self, filename):
+        """
+        Roll back, or forward, a commit to the archive filename interrupted
+        part way through, and remove the journal.
+
+        Returns:
+          "rollback" or "rollforward", or None if there was nothing to do.
+        """
+        try:
+            journal = open(self.path, "rb")
+        except FileNotFoundError:
+            return None
+        result = None
+        with journal:
+            header = journal.read(sizeJournalHeader)
+            state = _JOURNAL_INCOMPLETE
+            if len(header) == sizeJournalHeader:
+                magic, state, size, mtime_ns = struct.unpack(
+                    structJournalHeader, header)
+                if magic != stringJournalHeader:
+                    state = _JOURNAL_INCOMPLETE
+            if state == _JOURNAL_UNDO:
+                with open(filename, "r+b") as fp:
+                    while True:
+                        region = journal.read(sizeJournalRegion)
+                        if len(region) != sizeJournalRegion:
+                            break
+                        start, length = struct.unpack(structJournalRegion,
+                                                      region)
+                        position = journal.tell()
+                        fp.seek(start)
+                        _copy_range(journal, position, fp, length)
+                        journal.seek(position + length)
+                    fp.truncate(size)
+                    _fsync(fp)
+                result = "rollback"
+            elif state == _JOURNAL_REDO:
+                move, done, saved = struct.unpack(
+                    structJournalCheckpoint,
+                    journal.read(sizeJournalCheckpoint))
+                count, end, directory_length = struct.unpack(
+                    structJournalMoves, journal.read(sizeJournalMoves))
+                moves = []
+                for _ in range(count):
+                    src, dst, length, header_length = struct.unpack(
+                        structJournalMove, journal.read(sizeJournalMove))
+                    moves.append((src, dst, length,
+                                  journal.read(header_length)))
+                directory = journal.read(directory_length)
+                self.scratch = journal.tell()
+                with open(filename, "r+b") as fp:
+                    self.redo(fp, moves, move, done, saved)
+                    fp.seek(end)
+                    fp.write(directory)
+                    fp.truncate()
+                    _fsync(fp)
+                result = "rollforward"
+            elif state in (_JOURNAL_CLONE, _JOURNAL_CLONE_READY):
+                clone_path = os.fsdecode(journal.read())
+                try:
+                    st = os.stat(filename)
+                    unchanged = (st.st_size, st.st_mtime_ns) == (size, mtime_ns)
+                except FileNotFoundError:
+                    unchanged = False
+                if not os.path.exists(clone_path):
+                    # already swapped in, or never written
+                    pass
+                elif state == _JOURNAL_CLONE_READY and unchanged:
+                    os.replace(clone_path, filename)
+                    _fsync_dir(os.path.dirname(os.path.abspath(filename)))
+                    result = "rollforward"
+                else:
+                    os.unlink(clone_path)
+                    result = "rollback"
+        self.remove()
+        return result
+
+
+class _Layout:
+    """
+    Index of where each member of an archive, including those removed but
+    not yet committed, lives in the archive's file. Extents are taken from
+    the members' local headers (which may differ from the central directory)
+    and held in arrays sorted by offset.
+
+    Members are indexed on demand by update(), so removals and renames,
+    which don't move data until committed, leave the index valid and new
+    members are appended as they are written after all the others.
+    """
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.starts = array.array('Q')
+        self.ends = array.array('Q')
+        self.header_lengths = array.array('L')
+        self.infos = []
+        # ZipInfo -> position in the arrays
+        self.positions = {}
+
+    def update(self):
+        """Index any members not yet in the index"""
+        archive = self.archive
+        added = [zinfo for zinfo in archive.filelist + archive.removed_filelist
+                 if zinfo not in self.positions]
+        if not added:
+            return
+        added.sort(key=operator.attrgetter('header_offset'))
+        for zinfo in added:
+            header = archive._local_header(zinfo)
+            self.starts.append(zinfo.header_offset)
+            self.ends.append(zinfo.header_offset +
+                             archive._member_extent(zinfo, header))
+            self.header_lengths.append(len(header))
+            self.infos.append(zinfo)
+        if len(self.starts) > len(added) and \
+                self.starts[-len(added) - 1] > self.starts[-len(added)]:
+            # not simply appended after the existing members
+            self._sort()
+        else:
+            for i in range(len(self.infos) - len(added), len(self.infos)):
+                self.positions[self.infos[i]] = i
+
+    def _sort(self):
+        order = sorted(range(len(self.starts)), key=self.starts.__getitem__)
+        self.starts = array.array('Q', (self.starts[i] for i in order))
+        self.ends = array.array('Q', (self.ends[i] for i in order))
+        self.header_lengths = array.array(
+            'L', (self.header_lengths[i] for i in order))
+        self.infos = [self.infos[i] for i in order]
+        self.positions = {zinfo: i for i, zinfo in enumerate(self.infos)}
+
+    def extent(self, zinfo):
+        """Return the (start, end) offsets of the member zinfo"""
+        i = self.positions[zinfo]
+        return self.starts[i], self.ends[i]
+
+    def header_length(self, zinfo):
+        """Return the length of the local header of the member zinfo"""
+        return self.header_lengths[self.positions[zinfo]]
+
+    def discard(self, zinfos):
+        """Drop the members zinfos from the index, e.g. once their removal
+        has been committed without moving any data"""
+        zinfos = set(zinfos) & self.positions.keys()
+        if not zinfos:
+            return
+        keep = [i for i, zinfo in enumerate(self.infos) if zinfo not in zinfos]
+        self.starts = array.array('Q', (self.starts[i] for i in keep))
+        self.ends = array.array('Q', (self.ends[i] for i in keep))
+        self.header_lengths = array.array(
+            'L', (self.header_lengths[i] for i in keep))
+        self.infos = [self.infos[i] for i in keep]
+        self.positions = {zinfo: i for i, zinfo in enumerate(self.infos)}
+
+    def gaps(self, start_dir, ignore=()):
+        """Return (start, end) for each run of bytes before start_dir that
+        doesn't belong to any member, other than those in ignore"""
+        ignore = set(ignore)
+        gaps = []
+        current = 0
+        for start, end, zinfo in zip(self.starts, self.ends, self.infos):
+            if zinfo in ignore:
+                continue
+            if start > current:
+                gaps.append((current, min(start, start_dir)))
+            current = max(current, end)
+            if current >= start_dir:
+                break
+        if current < start_dir:
+            gaps.append((current, start_dir))
+        return [gap for gap in gaps if gap[0] < gap[1]]
+
+
+class CommitStats:
+    """
+    What a commit() did, passed to the commit_hook and kept as the
+    archive's last_commit_stats.
+
+    Attributes:
+      commit_mode (str): the commit mode asked for.
+      path (str): how the changes were written: "renames" (only the central
+        directory and local headers were rewritten), "append", "inplace",
+        "clone-rename" (a clone renamed over the archive), "clone-stream"
+        (a clone copied back over the archive's file) or "memory" (a clone
+        made in memory copied back over a BytesIO archive).
+      compacted (bool): whether the archive was compacted, by compact() or
+        by an append commit exceeding compact_threshold.
+      phases (dict): seconds spent in each phase, in the order they ran.
+      seconds (float): the total time taken.
+      bytes_read, bytes_written (int): data read and written, including by
+        verification.
+      members (int): members in the archive once committed.
+      removed, renamed, added (int): the changes committed.
+      duplicates (list): with dedup, the names of each set of members found
+        with identical contents.
+    """
+
+    def __init__(self, commit_mode):
+        self.commit_mode = commit_mode
+        self.path = None
+        self.compacted = False
+        self.phases = {}
+        self.seconds = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.members = 0
+        self.removed = 0
+        self.renamed = 0
+        self.added = 0
+        self.duplicates = None
+
+    def __repr__(self):
+        return ("<CommitStats path={!r} seconds={:.6f} bytes_read={} "
+                "bytes_written={} members={}>".format(
+                    self.path, self.seconds, self.bytes_read,
+                    self.bytes_written, self.members))
+
+
+MemberCheck = collections.namedtuple('MemberCheck', 'name ok stage error')
+MemberCheck.__doc__ = """The result of one check made by verify_report():
+the member name, whether it passed, the stage ("structure" or "crc") and,
+if it failed, why"""
+
+
+class VerifyReport:
+    """The result of ZipFileExtended.verify_report(), a MemberCheck for each
+    check made, structure checks (in archive order) before CRC checks."""
+
+    def __init__(self, level):
+        self.level = level
+        self.checks = []
+
+    @property
+    def ok(self):
+        return all(check.ok for check in self.checks)
+
+    @property
+    def bad(self):
+        """The failed checks"""
+        return [check for check in self.checks if not check.ok]
+
+    @property
+    def first_bad(self):
+        """The name of the first bad member, as returned by verify()"""
+        for check in self.checks:
+            if not check.ok:
+                return check.name
+        return None
+
+    def __repr__(self):
+        return "<VerifyReport level={!r} checked={} bad={}>".format(
+            self.level, len(self.checks), len(self.bad))
+
+
+class ZipBatch:
+    """
+    A set of changes to a ZipFileExtended that are applied in one go, see
+    ZipFileExtended.batch(). Bookkeeping is hash based so the cost of
+    applying a batch is linear in the size of the archive and the batch.
+    """
+
+    def __init__(self, archive, commit_mode=None, verify=VERIFY_STRUCTURE):
+        self.archive = archive
+        self.commit_mode = commit_mode
+        self.verify = verify
+        self.removes = set()
+        self.renames = {}
+        self.writes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.commit()
+
+    def _getinfo(self, zinfo_or_arcname):
+        if isinstance(zinfo_or_arcname, zipfile.ZipInfo):
+            zinfo_or_arcname = zinfo_or_arcname.filename
+        return self.archive.getinfo(zinfo_or_arcname)
+
+    def remove(self, zinfo_or_arcname):
+        """Remove a member from the archive"""
+        zinfo = self._getinfo(zinfo_or_arcname)
+        self.renames.pop(zinfo, None)
+        self.removes.add(zinfo)
+
+    def rename(self, zinfo_or_arcname, filename):
+        """Rename a member in the archive"""
+        zinfo = self._getinfo(zinfo_or_arcname)
+        if zinfo in self.removes:
+            raise KeyError(
+                "There is no item named %r in the archive" % zinfo.filename)
+        self.renames[zinfo] = _clean_filename(filename)
+
+    def writestr(self, zinfo_or_arcname, data, compress_type=None):
+        """Add a member to the archive from data, see ZipFile.writestr()"""
+        self.writes.append(("writestr", zinfo_or_arcname, data, compress_type))
+
+    def write(self, filename, arcname=None, compress_type=None):
+        """Add a member to the archive from a file, see ZipFile.write()"""
+        self.writes.append(("write", filename, arcname, compress_type))
+
+    def replace(self, zinfo_or_arcname, data, compress_type=None):
+        """Replace the contents of a member with data"""
+        zinfo = self._getinfo(zinfo_or_arcname)
+        self.remove(zinfo)
+        self.writestr(zinfo.filename, data, compress_type)
+
+    def commit(self):
+        """Apply the changes in this batch to the archive and commit them"""
+        archive = self.archive
+        if not archive.fp:
+            raise RuntimeError(
+                "Attempt to modify to ZIP archive that was already closed")
+        archive._removecheck()
+
+        with archive._lock:
+            if self.removes:
+                archive.filelist = [zinfo for zinfo in archive.filelist
+                                if zinfo not in self.removes]
+                for zinfo in self.removes:
+                    del archive.NameToInfo[zinfo.filename]
+                archive.removed_filelist.extend(self.removes)
+            # drop all the old names first so members can swap names
+            for zinfo in self.renames:
+                del archive.NameToInfo[zinfo.filename]
+            for zinfo, filename in self.renames.items():
+                if filename in archive.NameToInfo:
+                    import warnings
+                    warnings.warn('Duplicate name: %r' % filename, stacklevel=3)
+                zinfo.filename = filename
+                archive.NameToInfo[filename] = zinfo
+            for method, *args in self.writes:
+                getattr(archive, method)(*args)
+            archive._didModify = True
+            archive.requires_commit = True
+
+            self.removes = set()
+            self.renames = {}
+            self.writes = []
+            archive.commit(self.commit_mode, self.verify)
+
+
+class AsyncZipFileExtended:
+    """
+    asyncio facade over a ZipFileExtended. Every call that reads or writes
+    the archive's file, or (de)compresses data, runs in a bounded thread
+    pool so the event loop is never blocked.
+
+        async with await AsyncZipFileExtended.open("archive.zip", "a") as zip:
+            data = await zip.read("member")
+            await zip.rename("member", "renamed")
+            await zip.commit()
+
+    Reads may run concurrently with each other. Changes to the archive
+    (remove, rename, write, commit, ...) run one at a time, and commit(),
+    clone() and close() wait for any reads in progress to finish.
+    """
+
+    def __init__(self, archive, executor=None, max_workers=4):
+        """
+        Args:
+          archive (ZipFileExtended): the archive to wrap.
+          executor (Executor, optional): where blocking calls run, by default
+            a thread pool of max_workers threads owned by this object and shut
+            down by close().
+          max_workers (int, optional): size of the default thread pool.
+        """
+        self.archive = archive
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+            self._owns_executor = True
+        else:
+            self._owns_executor = False
+        self._executor = executor
+        # held by changes; commit-like operations also wait for readers
+        self._write_lock = asyncio.Lock()
+        self._readers = 0
+        self._no_readers = asyncio.Condition()
+
+    @classmethod
+    async def open(cls, file, *args, executor=None, max_workers=4, **kwargs):
+        """Open a ZipFileExtended, taking the same arguments, without
+        blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        pool = executor
+        if pool is None:
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers)
+        try:
+            archive = await loop.run_in_executor(
+                pool, functools.partial(ZipFileExtended, file, *args, **kwargs))
+        except BaseException:
+            if executor is None:
+                pool.shutdown(wait=False)
+            raise
+        self = cls(archive, executor=pool)
+        self._owns_executor = executor is None
+        return self
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs))
+
+    async def _read(self, func, *args, **kwargs):
+        """Run a read of the archive, alongside any other reads"""
+        async with self._no_readers:
+            self._readers += 1
+        try:
+            return await self._run(func, *args, **kwargs)
+        finally:
+            async with self._no_readers:
+                self._readers -= 1
+                self._no_readers.notify_all()
+
+    async def _change(self, func, *args, exclusive=False, **kwargs):
+        """Run a change to the archive, one at a time, and if exclusive once
+        all reads have finished"""
+        async with self._write_lock:
+            if exclusive:
+                async with self._no_readers:
+                    await self._no_readers.wait_for(lambda: not self._readers)
+                    return await self._run(func, *args, **kwargs)
+            return await self._run(func, *args, **kwargs)
+
+    # In memory lookups, these don't touch the archive's file
+
+    def namelist(self):
+        return self.archive.namelist()
+
+    def infolist(self):
+        return self.archive.infolist()
+
+    def getinfo(self, name):
+        return self.archive.getinfo(name)
+
+    # Reads
+
+    async def read(self, name, pwd=None):
+        """Return the decompressed bytes of the member name"""
+        return await self._read(self.archive.read, name, pwd)
+
+    async def read_compressed(self, name, pwd=None):
+        """Return the compressed bytes of the member name, see
+        ZipFileExtended.read_compressed()"""
+        return await self._read(self.archive.read_compressed, name, pwd)
+
+    async def testzip(self):
+        return await self._read(self.archive.testzip)
+
+    async def verify(self, level=VERIFY_FULL, members=None):
+        return await self._read(self.archive.verify, level, members)
+
+    async def iter_chunks(self, name, pwd=None, chunk_size=COPY_BUFSIZE):
+        """Asynchronously iterate over the decompressed data of the member
+        name in chunks of at most chunk_size bytes"""
+        async for chunk in self._iter(self.archive.open, (name, "r", pwd),
+                                      chunk_size):
+            yield chunk
+
+    async def iter_compressed_chunks(self, name, chunk_size=COPY_BUFSIZE):
+        """Asynchronously iterate over the compressed data of the member name,
+        exactly as stored, in chunks of at most chunk_size bytes"""
+        async for chunk in self._iter(self.archive.open_compressed, (name,),
+                                      chunk_size):
+            yield chunk
+
+    async def _iter(self, opener, args, chunk_size):
+        async with self._no_readers:
+            self._readers += 1
+        try:
+            fp = await self._run(opener, *args)
+            try:
+                while True:
+                    chunk = await self._run(fp.read, chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                await self._run(fp.close)
+        finally:
+            async with self._no_readers:
+                self._readers -= 1
+                self._no_readers.notify_all()
+
+    # Changes
+
+    async def remove(self, zinfo_or_arcname):
+        await self._change(self.archive.remove, zinfo_or_arcname)
+
+    async def rename(self, zinfo_or_arcname, filename):
+        await self._change(self.archive.rename, zinfo_or_arcname, filename)
+
+    async def writestr(self, zinfo_or_arcname, data, *args, **kwargs):
+        await self._change(self.archive.writestr, zinfo_or_arcname, data,
+                           *args, exclusive=True, **kwargs)
+
+    async def write(self, filename, *args, **kwargs):
+        await self._change(self.archive.write, filename, *args,
+                           exclusive=True, **kwargs)
+
+    async def write_compressed(self, zinfo, data, *args, **kwargs):
+        await self._change(self.archive.write_compressed, zinfo, data, *args,
+                           exclusive=True, **kwargs)
+
+    async def replace(self, zinfo_or_arcname, data, *args, **kwargs):
+        await self._change(self.archive.replace, zinfo_or_arcname, data,
+                           *args, exclusive=True, **kwargs)
+
+    async def commit(self, commit_mode=None, verify=VERIFY_STRUCTURE,
+                     dedup=None, compact=False):
+        """Commit outstanding changes, see ZipFileExtended.commit()"""
+        await self._change(self.archive.commit, commit_mode, verify, dedup,
+                           compact, exclusive=True)
+
+    async def compact(self, verify=VERIFY_STRUCTURE):
+        """Compact the archive, see ZipFileExtended.compact()"""
+        await self._change(self.archive.compact, verify, exclusive=True)
+
+    async def clone(self, file, *args, **kwargs):
+        """Clone the archive, see ZipFileExtended.clone(). Returns the
+        (synchronous) ZipFileExtended clone."""
+        return await self._change(self.archive.clone, file, *args,
+                                  exclusive=True, **kwargs)
+
+    async def close(self):
+        """Close the archive, committing any outstanding changes, and shut
+        down the thread pool if it was created here"""
+        try:
+            await self._change(self.archive.close, exclusive=True)
+        finally:
+            if self._owns_executor:
+                self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+
+class _OffsetBuffer(io.BytesIO):
+    """BytesIO standing in for a file from offset base on, e.g. for writing
+    a central directory to memory"""
+
+    def __init__(self, base):
+        super().__init__()
+        self.base = base
+
+    def tell(self):
+        return self.base + super().tell()
+
+
+class _RangeFile(io.RawIOBase):
+    """Read only file-like view onto length bytes of an archive's file from
+    offset start, e.g. the compressed data of a member or a hidden file."""
+
+    def __init__(self, archive, start, length, fd=None):
+        self._archive = archive
+        self.start = start
+        self.length = length
         self._offset = 0
-        while not self._eof:
-            buf += self._read1(self.MAX_N, decompress=decompress)
-        return buf
-
-    end = n + self._offset
-    if end < len(self._readbuffer):
-        buf = self._readbuffer[self._offset:end]
-        self._offset = end
-        return buf
-
-    n = end - len(self._readbuffer)
-    buf = self._readbuffer[self._offset:]
-    self._readbuffer = b''
-    self._offset = 0
-    while n > 0 and not self._eof:
-        data = self._read1(n, decompress=decompress)
-        if n < len(data):
-            self._readbuffer = data
-            self._offset = n
-            buf += data[:n]
+        # if given read with pread() from this descriptor of the archive's
+        # file, without taking the archive's lock
+        self._fd = fd
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._offset
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._offset
+        elif whence == os.SEEK_END:
+            offset += self.length
+        self._offset = min(max(offset, 0), self.length)
+        return self._offset
+
+    def readinto(self, b):
+        with memoryview(b) as view, view.cast('B') as view:
+            n = min(len(view), self.length - self._offset)
+            if n <= 0:
+                return 0
+            if self._fd is not None:
+                data = os.pread(self._fd, n, self.start + self._offset)
+                n = len(data)
+                view[:n] = data
+                self._offset += n
+                return n
+            if self._archive._mmap is not None:
+                start = self.start + self._offset
+                data = self._archive._mmap_view[start:start + n]
+                n = len(data)
+                view[:n] = data
+                self._offset += n
+                return n
+            with self._archive._lock:
+                fp = self._archive.fp
+                fp.seek(self.start + self._offset)
+                if hasattr(fp, 'readinto'):
+                    n = fp.readinto(view[:n])
+                else:
+                    data = fp.read(n)
+                    n = len(data)
+                    view[:n] = data
+        self._offset += n
+        return n
+
+    def readall(self):
+        # read the remainder in one go rather than growing a buffer
+        buf = bytearray(self.length - self._offset)
+        with memoryview(buf) as view:
+            pos = 0
+            while pos < len(buf):
+                n = self.readinto(view[pos:])
+                if not n:
+                    break
+                pos += n
+        del buf[pos:]
+        return bytes(buf)
+
+
+try:
+    # releases the GIL for large buffers, unlike binascii
+    from zlib import crc32 as _crc32
+except ImportError:
+    _crc32 = binascii.crc32
+
+
+def _needs_recompress(zinfo, compress_type, compresslevel):
+    """Should the member zinfo be recompressed to compress_type"""
+    if compress_type is None or zinfo.flag_bits & 0x1:
+        # encrypted members can only be copied
+        return False
+    if zinfo.compress_type != compress_type:
+        return True
+    return compresslevel is not None and compress_type != ZIP_STORED
+
+
+def _recompress(data, from_type, to_type, compresslevel=None):
+    """Return the compressed bytes data, compressed with from_type,
+    recompressed with to_type. Runs in worker processes."""
+    decompressor = zipfile._get_decompressor(from_type)
+    if decompressor is not None:
+        data = decompressor.decompress(data)
+    compressor = zipfile._get_compressor(to_type, compresslevel)
+    if compressor is not None:
+        data = compressor.compress(data) + compressor.flush()
+    return data
+
+
+def _compress_stream(src, dst, compress_type, compresslevel=None,
+                     bufsize=COPY_BUFSIZE):
+    """Compress the bytes, or file-like object, src into dst reading at most
+    bufsize bytes at a time. Returns the CRC and length of the data read."""
+    if not hasattr(src, 'read'):
+        src = io.BytesIO(src)
+    compressor = zipfile._get_compressor(compress_type, compresslevel)
+    crc = 0
+    length = 0
+    while True:
+        chunk = src.read(bufsize)
+        if not chunk:
             break
-        buf += data
-        n -= len(data)
-    return buf
-
-
-def _read1(self, n, decompress=True):
-    # Read up to n compressed bytes with at most one read() system call,
-    # decrypt and decompress them.
-    if self._eof or n <= 0:
-        return b''
-
-    # Read from file.
-    if self._compress_type == ZIP_DEFLATED:
-        ## Handle unconsumed data.
-        data = self._decompressor.unconsumed_tail
-        if n > len(data):
-            data += self._read2(n - len(data))
+        crc = _crc32(chunk, crc)
+        length += len(chunk)
+        if compressor is not None:
+            chunk = compressor.compress(chunk)
+        dst.write(chunk)
+    if compressor is not None:
+        dst.write(compressor.flush())
+    return crc, length
+
+
+def _shard_entry_size(zinfo):
+    """Return the most bytes write_compressed() takes to write zinfo into a
+    new archive: the local header it builds from zinfo (whose extra field,
+    read from the central directory, may differ from the source's local
+    header), the data and any data descriptor, plus the member's central
+    directory record, which may grow a zip64 extra field of up to 28 bytes"""
+    zip64 = zinfo.file_size > ZIP64_LIMIT or \
+        zinfo.compress_size > ZIP64_LIMIT
+    # FileHeader() bumps the version fields
+    header = copy.copy(zinfo).FileHeader(zip64)
+    size = len(header) + zinfo.compress_size
+    if zinfo.flag_bits & 0x08:
+        size += struct.calcsize('<LQQ' if zip64 else '<LLL')
+    filename, _ = zinfo._encodeFilenameFlags()
+    return (size + zipfile.sizeCentralDir + len(filename) +
+            len(zinfo.extra) + len(zinfo.comment) + 28)
+
+
+def _partition(infos, sizes, max_bytes, max_entries, key=None):
+    """Split infos, in order, into lists whose total size (from the sizes
+    dict) is at most max_bytes, allowing for an end of central directory
+    record, and whose length is at most max_entries. With key, members with
+    the same key are gathered, in the order the first of each appears, and
+    kept together where they fit in a list of their own."""
+    overhead = zipfile.sizeEndCentDir + zipfile.sizeEndCentDir64 + \
+        zipfile.sizeEndCentDir64Locator
+    if key is None:
+        groups = [[zinfo] for zinfo in infos]
     else:
-        data = self._read2(n)
-
-    if self._compress_type == ZIP_STORED or not decompress:
-        self._eof = self._compress_left <= 0
-    elif self._compress_type == ZIP_DEFLATED:
-        n = max(n, self.MIN_READ_SIZE)
-        data = self._decompressor.decompress(data, n)
-        self._eof = (self._decompressor.eof or
-                     self._compress_left <= 0 and
-                     not self._decompressor.unconsumed_tail)
-        if self._eof:
-            data += self._decompressor.flush()
+        groups = {}
+        for zinfo in infos:
+            groups.setdefault(key(zinfo), []).append(zinfo)
+        groups = list(groups.values())
+
+    def fits(count, size):
+        return ((max_entries is None or count <= max_entries) and
+                (max_bytes is None or size + overhead <= max_bytes))
+
+    parts = []
+    part, part_size = [], 0
+    for group in groups:
+        group_size = sum(sizes[zinfo] for zinfo in group)
+        if part and not fits(len(part) + len(group), part_size + group_size):
+            parts.append(part)
+            part, part_size = [], 0
+        if fits(len(group), group_size):
+            part.extend(group)
+            part_size += group_size
+            continue
+        # too big for a shard of its own, split between members
+        for zinfo in group:
+            if part and not fits(len(part) + 1, part_size + sizes[zinfo]):
+                parts.append(part)
+                part, part_size = [], 0
+            part.append(zinfo)
+            part_size += sizes[zinfo]
+    if part:
+        parts.append(part)
+    return parts
+
+
+def _concat(endrec):
+    """Return the number of bytes before the archive, which is zero unless
+    the zip was concatenated to another file"""
+    concat = (endrec[zipfile._ECD_LOCATION] - endrec[zipfile._ECD_SIZE] -
+              endrec[zipfile._ECD_OFFSET])
+    if endrec[zipfile._ECD_SIGNATURE] == zipfile.stringEndArchive64:
+        # If Zip64 extension structures are present, account for them
+        concat -= (zipfile.sizeEndCentDir64 + zipfile.sizeEndCentDir64Locator)
+    return concat
+
+
+def _pad8(n):
+    """Round n up to a multiple of 8"""
+    return (n + 7) & ~7
+
+
+def _strip_extra(extra, xids):
+    """Return the extra field without the records whose header id is in
+    xids, e.g. (1,) for the zip64 record (zipfile's own helper is gone from
+    Python 3.12)"""
+    fields = []
+    i = 0
+    while i + 4 <= len(extra):
+        xid, xlen = struct.unpack('<HH', extra[i:i + 4])
+        j = i + 4 + xlen
+        if xid not in xids:
+            fields.append(extra[i:j])
+        i = j
+    return b''.join(fields)
+
+
+def _decode_extra(zinfo, filename_crc):
+    """Decode zinfo's extra field, as ZipFile does when reading the central
+    directory. From Python 3.12 this takes the CRC of the raw filename, to
+    check any unicode path field against."""
+    if zipfile.ZipInfo._decodeExtra.__code__.co_argcount > 1:
+        zinfo._decodeExtra(filename_crc)
     else:
-        data = self._decompressor.decompress(data)
-        self._eof = self._decompressor.eof or self._compress_left <= 0
-
-    data = data[:self._left]
-    self._left -= len(data)
-    if self._left <= 0:
-        self._eof = True
-    # We can only check the crc if we are decompressing
-    if decompress:
-        self._update_crc(data)
-    return data
+        zinfo._decodeExtra()
+
+
+def _name_hash(name):
+    """Stable hash of a member name"""
+    return binascii.crc32(name.encode('utf-8', 'surrogateescape'))
+
+
+def _clean_filename(filename):
+    """Sanitise a new member filename"""
+    # Terminate the file name at the first null byte.  Null bytes in file
+    # names are used as tricks by viruses in archives.
+    null_byte = filename.find(chr(0))
+    if null_byte >= 0:
+        filename = filename[0:null_byte]
+    # This is used to ensure paths in generated ZIP files always use
+    # forward slashes as the directory separator, as required by the
+    # ZIP format specification.
+    if os.sep != "/" and os.sep in filename:
+        filename = filename.replace(os.sep, "/")
+    return filename
+
+
+def _rename_local_header(header, zinfo):
+    """Return a copy of the raw local file header with the filename replaced
+    by that of zinfo"""
+    filename, flag_bits = zinfo._encodeFilenameFlags()
+    fheader = list(struct.unpack(zipfile.structFileHeader,
+                                 header[:zipfile.sizeFileHeader]))
+    extra = header[zipfile.sizeFileHeader +
+                   fheader[zipfile._FH_FILENAME_LENGTH]:]
+    fheader[zipfile._FH_GENERAL_PURPOSE_FLAG_BITS] = (
+        fheader[zipfile._FH_GENERAL_PURPOSE_FLAG_BITS] & ~0x800) | (flag_bits & 0x800)
+    fheader[zipfile._FH_FILENAME_LENGTH] = len(filename)
+    return struct.pack(zipfile.structFileHeader, *fheader) + filename + extra
+
+
+def _copy_stream(src, dst, length, bufsize=COPY_BUFSIZE, progress=None):
+    """Copy length bytes from src to dst reading at most bufsize at a time
+    into a single reused buffer. progress, if given, is called as
+    progress(done, length) after each block."""
+    if isinstance(src, _RangeFile):
+        if src._fd is None:
+            # A view onto an archive, copy the range from the underlying file
+            with src._archive._lock:
+                _copy_range(src._archive.fp, src.start + src._offset, dst,
+                            length, bufsize, progress)
+            src._offset += length
+            return
+        # read with its own descriptor, without the archive's lock, letting
+        # the kernel copy as much as it can
+        try:
+            dst_fd = dst.fileno()
+            dst.flush()
+            dst_pos = dst.tell()
+        except (AttributeError, OSError, ValueError):
+            dst_fd = None
+        if dst_fd is not None:
+            copied = _kernel_copy(src._fd, src.start + src._offset, dst_fd,
+                                  dst_pos, length)
+            if copied == length:
+                dst.seek(dst_pos + copied)
+                src._offset += copied
+                if progress is not None:
+                    progress(length, length)
+                return
+            # copy it all again, through the buffer
+            dst.seek(dst_pos)
+    readinto = getattr(src, 'readinto', None)
+    buf = bytearray(min(bufsize, length))
+    done = 0
+    with memoryview(buf) as view:
+        while done < length:
+            n = min(len(buf), length - done)
+            if readinto is not None:
+                n = readinto(view[:n])
+                chunk = view[:n]
+            else:
+                chunk = src.read(n)
+                n = len(chunk)
+            if not n:
+                raise zipfile.BadZipFile("Unexpected end of archive")
+            dst.write(chunk)
+            done += n
+            if progress is not None:
+                progress(done, length)
+
+
+def _copy_range(src, src_pos, dst, length, bufsize=COPY_BUFSIZE,
+                progress=None):
+    """Copy length bytes starting at offset src_pos of src to the current
+    position of dst, leaving dst positioned after the copied bytes.
+
+    Where both src and dst are real files the data is moved by the kernel,
+    using copy_file_range() (which can share extents on filesystems that
+    support reflinks) or sendfile(). A BytesIO source is written out
+    directly from its buffer. Otherwise the data is copied in blocks of at
+    most bufsize bytes. progress, if given, is called as
+    progress(done, length) as the copy proceeds.
+    """
+    if isinstance(src, io.BytesIO) and src is not dst:
+        with src.getbuffer() as view, \
+             view[src_pos:src_pos + length] as chunk:
+            if len(chunk) != length:
+                raise zipfile.BadZipFile("Unexpected end of archive")
+            dst.write(chunk)
+        src.seek(src_pos + length)
+        if progress is not None:
+            progress(length, length)
+        return
+    try:
+        src_fd = src.fileno()
+        dst_fd = dst.fileno()
+        dst_pos = dst.tell()
+    except (AttributeError, OSError, ValueError):
+        src_fd = dst_fd = None
+    if src_fd is not None and length > 0:
+        # make sure the kernel sees everything buffered by python so far
+        src.flush()
+        dst.flush()
+        copied = _kernel_copy(src_fd, src_pos, dst_fd, dst_pos, length)
+        dst.seek(dst_pos + copied)
+        src_pos += copied
+        if progress is not None and copied:
+            progress(copied, length)
+    else:
+        copied = 0
+    if length > copied:
+        src.seek(src_pos)
+        if progress is not None and copied:
+            report = progress
+            progress = lambda done, total: report(copied + done, length)
+        _copy_stream(src, dst, length - copied, bufsize, progress)
+
+
+def _fsync(fp):
+    """Flush fp through to disk, if it is a real file"""
+    fp.flush()
+    try:
+        os.fsync(fp.fileno())
+    except (AttributeError, OSError, ValueError):
+        pass
+
+
+def _fsync_dir(path):
+    """Flush the directory path's entries through to disk, where the
+    platform allows it"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _kernel_copy(src_fd, src_pos, dst_fd, dst_pos, length):
+    """Copy up to length bytes between file descriptors without passing
+    them through userspace. Returns the number of bytes copied, which is
+    less than length if the kernel was unable to copy everything."""
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < length:
+                n = os.copy_file_range(src_fd, dst_fd, length - copied,
+                                       src_pos + copied, dst_pos + copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            # e.g. not supported between these filesystems
+            pass
+    if copied < length and hasattr(os, 'sendfile'):
+        try:
+            os.lseek(dst_fd, dst_pos + copied, os.SEEK_SET)
+            while copied < length:
+                n = os.sendfile(dst_fd, src_fd, src_pos + copied,
+                                length - copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            pass
+    return copied
+
+
+def _move_within(fp, src, dst, length, bufsize=COPY_BUFSIZE):
+    """Move length bytes at offset src in fp to offset dst.
+    Copies front to back so dst must not be greater than src, unless the
+    two don't overlap."""
+    if isinstance(fp, io.BytesIO):
+        with fp.getbuffer() as view:
+            if dst + length <= len(view):
+                # a memmove within the buffer
+                view[dst:dst + length] = view[src:src + length]
+                fp.seek(dst + length)
+                return
+    while length > 0:
+        fp.seek(src)
+        chunk = fp.read(min(bufsize, length))
+        if not chunk:
+            raise zipfile.BadZipFile("Unexpected end of archive")
+        fp.seek(dst)
+        fp.write(chunk)
+        src += len(chunk)
+        dst += len(chunk)
+        length -= len(chunk)
 
 
 def find_mount_point(path):